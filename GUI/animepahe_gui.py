@@ -1,71 +1,622 @@
+import logging
+import os
+import re
+import signal
 import sys
 import subprocess
+from collections import deque
+from logging.handlers import RotatingFileHandler
 from PyQt5.QtWidgets import (
     QApplication, QWidget, QLabel, QPushButton, QVBoxLayout,
     QLineEdit, QListWidget, QMessageBox, QDialog, QHBoxLayout,
-    QRadioButton, QButtonGroup, QGroupBox, QTextEdit, QInputDialog,
-    QProgressBar, QListWidget, QListWidgetItem
+    QRadioButton, QButtonGroup, QGroupBox, QPlainTextEdit, QInputDialog,
+    QProgressBar, QListWidget, QListWidgetItem, QSpinBox, QComboBox, QCheckBox
 )
-from PyQt5.QtCore import QThread, pyqtSignal
+from PyQt5.QtCore import QObject, QThread, QTimer, pyqtSignal
+from pahe.catalog import Catalog
+from pahe.client import Client
+from pahe.events import human_size
+from pahe.metrics import METRIC_EVENTS, MetricsCollector, write_run
+from pahe.queuestore import QueueStore
+from pahe import ratelimit
+from pahe.titleindex import TitleIndex
 
 class DownloadWorker(QThread):
+    """Downloads one job in-process through the pahe client.
+
+    job holds slug, episodes ("1,3,5-8"), resolution, audio, threads (-t)
+    and optionally folder, plus the bandwidth weight and name, and skip,
+    episodes already done. Links are resolved on the client's kept-alive
+    session and handed to a pahe.scheduler process one episode ahead, the
+    way animepahe-dl.sh feeds it, so no bash or curl runs on this path.
+    When a pahe.daemon serves the folder, the job is submitted to it instead
+    and only its events are followed.
+    """
     log_signal = pyqtSignal(str)
     status_signal = pyqtSignal(str)
     done_signal = pyqtSignal(bool)
     progress_signal = pyqtSignal(int)  # Emit progress value (episode count or percentage)
+    stats_signal = pyqtSignal(object)  # Emit speed, ETA and segment counts from the event stream
+    metrics_signal = pyqtSignal(object)  # Emit the phase, retry and episode events, tagged with the job
     
-    def __init__(self, cmd, total_episodes=None):
+    def __init__(self, job, total_episodes=None, client=None):
         super().__init__()
-        self.cmd = cmd
+        self.job = job
         self.total_episodes = total_episodes
+        self.client = client
+        self.stopping = False
+        self.failed = []
+
+    def _warn(self, msg):
+        self.log_signal.emit(f"[WARNING] {msg}")
 
     def run(self):
-        import subprocess
-        import re
-        proc = subprocess.Popen(self.cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1, universal_newlines=True)
+        import shutil
+        import tempfile
+        import threading
+        import time
+        from pahe.client import Client, ClientError, episode_sessions, folder_name, parse_episodes
+        from pahe.events import EVENTS_ENV, EventReader, EventWriter, ProgressTracker, emit_phase
+        client = self.client or Client(".", log=self._warn)
+        job = self.job
+        from pahe.daemon import DaemonClient
+        daemon = DaemonClient.discover(client.root)
+        if daemon is not None:
+            self._run_on_daemon(daemon)
+            return
+        ffmpeg = shutil.which("ffmpeg")
+        try:
+            if not ffmpeg:
+                raise ClientError("ffmpeg command not found!")
+            folder = job.get('folder') or folder_name(client.title(job['slug']) or '')
+            if not folder:
+                raise ClientError("Anime name not found! Refresh the anime list and try again.")
+            started = time.monotonic()
+            sessions = episode_sessions(client.download_source(job['slug'], folder))
+            source_time = time.monotonic() - started
+            episodes = parse_episodes(job['episodes'], list(sessions))
+            if not episodes:
+                raise ClientError("Wrong episode number!")
+        except Exception as e:
+            self.log_signal.emit(f"[ERROR] {e}")
+            self.status_signal.emit("Download failed (see log)")
+            self.done_signal.emit(False)
+            return
+        skip = set(job.get('skip') or ())
+        episodes = [n for n in episodes if str(n) not in skip]
+        if not episodes:
+            self._all_done()
+            return
+        if self.stopping:
+            self._stopped()
+            return
+        # Progress comes from the JSON-lines event file, the log is only shown
+        fd, events_path = tempfile.mkstemp(prefix="animepahe-dl-", suffix=".events")
+        os.close(fd)
+        writer = EventWriter(events_path)
+        emit_phase(writer, "source", source_time, count=len(sessions))
+        engine_path = os.path.dirname(os.path.abspath(__file__))
+        env = dict(os.environ, **{EVENTS_ENV: events_path})
+        env['PYTHONPATH'] = engine_path + (os.pathsep + env['PYTHONPATH'] if env.get('PYTHONPATH') else '')
+        cmd = [sys.executable, "-m", "pahe.scheduler", "-t", str(job['threads']), "--ffmpeg", ffmpeg,
+               "--ffmpeg-args", "-v error", "--referer", client.host, "--cookie", client.cookie,
+               "--weight", str(job.get('weight', 1)), "--name", job.get('name') or job['slug']]
+        # Own process group on POSIX, so stopping reaches the download engine too
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                bufsize=1, universal_newlines=True, env=env, start_new_session=(os.name != 'nt'))
         self.proc = proc  # store for stopping
-        completed_episodes = set()
-        for line in proc.stdout:
-            self.log_signal.emit(line.rstrip())
-            # Only advance progress when we see .mp4 written, 'completed', or 'finished', not just 'Downloading Episode'
-            if self.total_episodes and self.total_episodes > 0:
-                # Look for episode numbers on real completion (mp4 written or similar only)
-                mp4_match = re.search(r'(Episode\s+)?([0-9]+)\.mp4', line)
-                if mp4_match:
-                    ep_num = int(mp4_match.group(2))
-                    if ep_num not in completed_episodes:
-                        completed_episodes.add(ep_num)
-                        self.progress_signal.emit(len(completed_episodes))
-                # increment also on 'Downloading Episode X'
-                ep_start_match = re.search(r"Downloading Episode\s+(\d+)", line)
-                if ep_start_match:
-                    ep_num = int(ep_start_match.group(1))
-                    if ep_num not in completed_episodes:
-                        completed_episodes.add(ep_num)
-                        self.progress_signal.emit(len(completed_episodes))
-                elif re.search(r'completed|finished', line, re.IGNORECASE):
-                    # In ambiguous log cases, just increment
-                    if len(completed_episodes) < self.total_episodes:
-                        self.progress_signal.emit(len(completed_episodes) + 1)
-        proc.wait()
+        log_thread = threading.Thread(target=self._pump_log, args=(proc.stderr,), daemon=True)
+        log_thread.start()
+        feed_thread = threading.Thread(target=self._feed, daemon=True,
+                                       args=(proc, client, folder, sessions, episodes, writer))
+        feed_thread.start()
+        reader = EventReader(events_path)
+        tracker = ProgressTracker(self.total_episodes)
+        try:
+            while True:
+                running = proc.poll() is None
+                events = reader.read()
+                for event in events:
+                    tracker.update(event)
+                    if event.get('type') == 'episode_end':
+                        self.progress_signal.emit(len(tracker.finished))
+                self._forward_metrics(events)
+                if events:
+                    self.stats_signal.emit({
+                        'completed': tracker.completed, 'failed': tracker.failed,
+                        'fraction': tracker.fraction(), 'speed': tracker.speed,
+                        'eta': tracker.eta(), 'share': tracker.share, 'text': tracker.describe(),
+                    })
+                if not running:
+                    break
+                self.msleep(250)
+            log_thread.join()
+            feed_thread.join()
+        finally:
+            writer.close()
+            try:
+                os.remove(events_path)
+            except OSError:
+                pass
+        if self.stopping:
+            self._stopped()
+            return
         # Set progress to max when done
         if self.total_episodes and self.total_episodes > 0:
             self.progress_signal.emit(self.total_episodes)
         else:
             self.progress_signal.emit(100)
-        if proc.returncode == 0:
+        if proc.returncode == 0 and not self.failed:
+            self.status_signal.emit("Download completed!")
+            self.done_signal.emit(True)
+        else:
+            if self.failed:
+                self.log_signal.emit(f"[ERROR] Failed to resolve episode(s) {', '.join(map(str, self.failed))}")
+            self.status_signal.emit("Download failed (see log)")
+            self.done_signal.emit(False)
+
+    def _all_done(self):
+        self.log_signal.emit("[INFO] Every episode is downloaded already")
+        self.progress_signal.emit(self.total_episodes if self.total_episodes else 100)
+        self.status_signal.emit("Download completed!")
+        self.done_signal.emit(True)
+
+    def _stopped(self):
+        self.status_signal.emit("Download stopped by user.")
+        self.done_signal.emit(False)
+
+    def _forward_metrics(self, events):
+        picked = [dict(e, job=self.job.get('name') or self.job['slug'])
+                  for e in events if e.get('type') in METRIC_EVENTS]
+        if picked:
+            self.metrics_signal.emit(picked)
+
+    def _run_on_daemon(self, daemon):
+        """Hand the job to the running pahe.daemon and follow its events"""
+        from pahe.client import format_episodes, parse_episodes
+        from pahe.daemon import DaemonError, event_line
+        from pahe.events import ProgressTracker
+        job = self.job
+        priority = {8: 'High', 1: 'Low'}.get(job.get('weight'), 'Normal')
+        tracker = ProgressTracker(self.total_episodes)
+        state = None
+        spec = job['episodes']
+        if job.get('skip') and '*' not in spec:
+            # "*" stays as it is: the daemon skips videos that are whole
+            numbers = [n for n in parse_episodes(spec, []) if str(n) not in job['skip']]
+            if not numbers:
+                self._all_done()
+                return
+            spec = format_episodes(numbers)
+        try:
+            self.daemon_job = daemon.submit(job['slug'], spec, job.get('resolution'),
+                                            job.get('audio'), priority)['id']
+            self.daemon = daemon
+            self.log_signal.emit(f"[INFO] Download handed to the daemon as job {self.daemon_job}")
+            for event in daemon.events(self.daemon_job):
+                line = event_line(event)
+                if line:
+                    self.log_signal.emit(f"[{'INFO' if line[0] == 'info' else 'WARNING'}] {line[1]}")
+                if event.get('type') == 'job':
+                    state = event.get('state')
+                    continue
+                tracker.update(event)
+                self._forward_metrics([event])
+                if event.get('type') == 'episode_end':
+                    self.progress_signal.emit(len(tracker.finished))
+                self.stats_signal.emit({
+                    'completed': tracker.completed, 'failed': tracker.failed,
+                    'fraction': tracker.fraction(), 'speed': tracker.speed,
+                    'eta': tracker.eta(), 'share': tracker.share, 'text': tracker.describe(),
+                })
+        except DaemonError as e:
+            self.log_signal.emit(f"[ERROR] {e}")
+        if self.stopping:
+            self._stopped()
+            return
+        self.progress_signal.emit(self.total_episodes if self.total_episodes else 100)
+        if state == 'done':
             self.status_signal.emit("Download completed!")
             self.done_signal.emit(True)
         else:
             self.status_signal.emit("Download failed (see log)")
             self.done_signal.emit(False)
 
+    def _feed(self, proc, client, folder, sessions, episodes, events):
+        """Answer each "next" from the scheduler with the next resolved episode"""
+        from pahe.client import ClientError, Prefetcher
+        from pahe.events import timed
+        job = self.job
+        path = os.path.join(os.path.abspath(client.root), folder)
+        ready = False
+
+        def resolve(n):
+            if n not in sessions:
+                raise ClientError(f"Episode {n} not found!")
+            with timed(events, "link", n, count=1):
+                return client.resolve_playlist(job['slug'], sessions[n], job.get('resolution'), job.get('audio'))
+
+        # Links are resolved a few episodes ahead while the current one downloads
+        prefetch = Prefetcher(resolve, episodes).start()
+        try:
+            for n in episodes:
+                if self.stopping:
+                    break
+                if not ready:
+                    if not proc.stdout.readline():
+                        break
+                    ready = True
+                try:
+                    link = prefetch.get(n)
+                except Exception as e:
+                    self._warn(f"Episode {n}: {e}, skip downloading")
+                    events.emit("episode_end", episode=str(n), ok=False, error=str(e))
+                    self.failed.append(n)
+                    continue
+                proc.stdin.write(f"{n}\t{link}\t{os.path.join(path, f'{n}.mp4')}\t{os.path.join(path, str(n))}\n")
+                proc.stdin.flush()
+                ready = False
+        except OSError:
+            pass
+        finally:
+            prefetch.close()
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+
+    def _pump_log(self, stream):
+        for line in stream:
+            self.log_signal.emit(line.rstrip())
+
+    def stop(self):
+        # Ensure the DownloadWorker also tries to kill the proc
+        self.stopping = True
+        try:
+            if getattr(self, 'daemon_job', None) is not None:
+                # The daemon keeps the checkpoints, resubmitting the item resumes it
+                self.daemon.cancel(self.daemon_job)
+            if hasattr(self, 'proc') and self.proc and self.proc.poll() is None:
+                if os.name != 'nt':
+                    # SIGTERM the whole group: the engine saves its checkpoint
+                    # so restarting the item resumes instead of starting over
+                    os.killpg(self.proc.pid, signal.SIGTERM)
+                else:
+                    self.proc.terminate()
+        except Exception:
+            pass
+
+class TaskRunner(QObject):
+    """Runs blocking lookups (list refresh, release lists) off the Qt main thread.
+
+    Tasks are keyed, e.g. "source:<slug>": submitting a key that is still
+    in flight adds the callback to that task instead of starting another.
+    Callbacks run on the main thread as callback(result, error) once the
+    task ends. cancel() drops a callback, or all of them; a task nobody
+    waits for any more is not started, or its result is thrown away. A
+    task that already started keeps its key until it ends, since its
+    function cannot be stopped: submitting the key again joins it, so two
+    runs never write the same files at once.
+    """
+    done_signal = pyqtSignal(object)
+
+    class Task:
+        def __init__(self, key, fn):
+            self.key = key
+            self.fn = fn
+            self.callbacks = []
+            self.future = None
+            self.result = None
+            self.error = None
+
+    def __init__(self, workers=4):
+        super().__init__()
+        from concurrent.futures import ThreadPoolExecutor
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.tasks = {}
+        self.done_signal.connect(self._deliver)
+
+    def submit(self, key, fn, callback=None):
+        """Run fn() in the background; False if key was already in flight"""
+        task = self.tasks.get(key)
+        new = task is None
+        if new:
+            task = self.tasks[key] = self.Task(key, fn)
+            task.future = self.pool.submit(self._run, task)
+        if callback is not None:
+            task.callbacks.append(callback)
+        return new
+
+    def running(self, key):
+        return key in self.tasks
+
+    def cancel(self, key, callback=None):
+        task = self.tasks.get(key)
+        if task is None:
+            return
+        if callback is not None and callback in task.callbacks:
+            task.callbacks.remove(callback)
+        elif callback is None:
+            task.callbacks.clear()
+        if not task.callbacks and task.future.cancel():
+            del self.tasks[key]
+
+    def shutdown(self):
+        for key in list(self.tasks):
+            self.cancel(key)
+        self.pool.shutdown(wait=False)
+
+    def _run(self, task):
+        try:
+            task.result = task.fn()
+        except Exception as e:
+            task.error = e
+        self.done_signal.emit(task)
+
+    def _deliver(self, task):
+        del self.tasks[task.key]
+        for callback in task.callbacks:
+            callback(task.result, task.error)
+
+class QueueRow(QWidget):
+    """One queue entry: description, status and its own progress bar"""
+    def __init__(self, text):
+        super().__init__()
+        layout = QHBoxLayout()
+        layout.setContentsMargins(4, 2, 4, 2)
+        self.label = QLabel(text)
+        self.status = QLabel()
+        self.bar = QProgressBar()
+        self.bar.setMaximumWidth(220)
+        layout.addWidget(self.label, 1)
+        layout.addWidget(self.status)
+        layout.addWidget(self.bar)
+        self.setLayout(layout)
+
+    def update_from(self, item):
+        self.label.setText(item['desc'])
+        stats = item.get('stats') if item['status'] == 'running' else None
+        self.status.setText(f"[{item['priority']}] {item['status']}" + (f" - {stats}" if stats else ""))
+        total = item.get('total') or 0
+        if item['status'] == 'running' and total <= 0:
+            self.bar.setMaximum(0)
+            return
+        self.bar.setMaximum(max(total, 1))
+        self.bar.setValue(item.get('progress', 0) if total > 0 else (1 if item['status'] == 'done' else 0))
+        self.bar.setFormat("%v/%m episodes" if total > 0 else item['status'])
+
+class LogView(QWidget):
+    """Log pane that stays cheap when downloads flood it.
+
+    Lines are collected and written to the view in one batch at most every
+    FLUSH_MS, so a burst of thousands of lines costs one repaint. Only the
+    last MAX_LINES are kept in memory; ticking "Save to file" writes the
+    full history to a rotated animepahe-gui.log.
+    """
+    LEVELS = ['All', 'Warnings', 'Errors']
+    MAX_LINES = 5000
+    FLUSH_MS = 100
+    LOG_FILE = 'animepahe-gui.log'
+    ANSI_RE = re.compile(r'\x1b\[[0-9;]*m')
+
+    def __init__(self):
+        super().__init__()
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        bar = QHBoxLayout()
+        bar.addWidget(QLabel("Log:"))
+        self.level_combo = QComboBox()
+        self.level_combo.addItems(self.LEVELS)
+        self.level_combo.currentIndexChanged.connect(self._refilter)
+        bar.addWidget(self.level_combo)
+        self.file_check = QCheckBox(f"Save to {self.LOG_FILE}")
+        self.file_check.toggled.connect(self.set_file_logging)
+        bar.addWidget(self.file_check)
+        bar.addStretch(1)
+        clear_btn = QPushButton("Clear Log")
+        clear_btn.clicked.connect(self.clear)
+        bar.addWidget(clear_btn)
+        layout.addLayout(bar)
+        self.view = QPlainTextEdit()
+        self.view.setReadOnly(True)
+        self.view.setUndoRedoEnabled(False)
+        self.view.setMaximumBlockCount(self.MAX_LINES)
+        layout.addWidget(self.view)
+        self.setLayout(layout)
+
+        self.lines = deque(maxlen=self.MAX_LINES)  # (level, text)
+        self.pending = []
+        self.file_log = None
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.flush)
+
+    @staticmethod
+    def level_of(text):
+        if '[ERROR]' in text:
+            return 2
+        return 1 if '[WARNING]' in text else 0
+
+    def append(self, text):
+        text = self.ANSI_RE.sub('', text)
+        entry = (self.level_of(text), text)
+        self.lines.append(entry)
+        self.pending.append(entry)
+        if not self.timer.isActive():
+            self.timer.start(self.FLUSH_MS)
+
+    def flush(self):
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        if self.file_log:
+            self.file_log.info('\n'.join(text for _, text in batch))
+        level = self.level_combo.currentIndex()
+        shown = [text for lvl, text in batch if lvl >= level]
+        if not shown:
+            return
+        scrollbar = self.view.verticalScrollBar()
+        follow = scrollbar.value() == scrollbar.maximum()
+        self.view.appendPlainText('\n'.join(shown[-self.MAX_LINES:]))
+        if follow:
+            scrollbar.setValue(scrollbar.maximum())
+
+    def _refilter(self):
+        self.flush()
+        level = self.level_combo.currentIndex()
+        self.view.setPlainText('\n'.join(text for lvl, text in self.lines if lvl >= level))
+        self.view.verticalScrollBar().setValue(self.view.verticalScrollBar().maximum())
+
+    def clear(self):
+        self.flush()
+        self.lines.clear()
+        self.view.clear()
+
+    def set_file_logging(self, enabled):
+        self.flush()
+        if self.file_log:
+            for handler in list(self.file_log.handlers):
+                self.file_log.removeHandler(handler)
+                handler.close()
+            self.file_log = None
+        if enabled:
+            handler = RotatingFileHandler(self.LOG_FILE, maxBytes=5 * 1024 * 1024, backupCount=3, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self.file_log = logging.getLogger('animepahe_gui.log')
+            self.file_log.propagate = False
+            self.file_log.setLevel(logging.INFO)
+            self.file_log.addHandler(handler)
+
+class DownloadManager(QObject):
+    """Runs up to max_parallel queue items at once.
+
+    The thread budget is split evenly between the running slots, so the
+    whole queue never opens more than thread_budget segment connections;
+    each item tunes its own count below its share (-t auto).
+    Pending items are started by priority, then by position in the queue.
+    The priority also weighs each item's share of the bandwidth cap.
+    With a store, the episodes of each item are recorded as they start
+    and end, and an item that is started again skips the ones done.
+    """
+    PRIORITIES = ['High', 'Normal', 'Low']
+    WEIGHTS = {'High': 8, 'Normal': 4, 'Low': 1}
+
+    log_signal = pyqtSignal(str)
+    item_changed = pyqtSignal(object)
+    metrics_signal = pyqtSignal(object)
+    finished = pyqtSignal()
+
+    def __init__(self, items, build_job, max_parallel=2, thread_budget=16, client=None, store=None):
+        super().__init__()
+        self.items = items
+        self.build_job = build_job
+        self.client = client
+        self.store = store
+        self.max_parallel = max_parallel
+        self.thread_budget = thread_budget
+        self.workers = {}
+        self.running = False
+
+    def threads_per_item(self):
+        return max(1, self.thread_budget // max(1, self.max_parallel))
+
+    def start(self):
+        self.running = True
+        self._fill()
+
+    def _next_item(self):
+        pending = [(self.PRIORITIES.index(it['priority']), i, it)
+                   for i, it in enumerate(self.items) if it['status'] == 'pending']
+        return min(pending, key=lambda p: p[:2])[2] if pending else None
+
+    def _fill(self):
+        while self.running and len(self.workers) < self.max_parallel:
+            item = self._next_item()
+            if item is None:
+                break
+            self._launch(item)
+        if not self.workers:
+            self.running = False
+            self.finished.emit()
+
+    def _launch(self, item):
+        job = self.build_job(item, self.threads_per_item())
+        done = item.setdefault('done', [])
+        job['skip'] = list(done)
+        item['done_before'] = len(done)
+        total = item['total'] - len(done) if item['total'] > 0 else item['total']
+        worker = DownloadWorker(job, total_episodes=total, client=self.client)
+        tag = item['label']
+        worker.log_signal.connect(lambda line, tag=tag: self.log_signal.emit(f"[{tag}] {line}"))
+        worker.progress_signal.connect(lambda value, item=item: self._progress(item, value))
+        worker.stats_signal.connect(lambda stats, item=item: self._stats(item, stats))
+        worker.metrics_signal.connect(self.metrics_signal.emit)
+        worker.metrics_signal.connect(lambda events, item=item: self._episodes(item, events))
+        worker.done_signal.connect(lambda ok, item=item: self._finished(item, ok))
+        self.workers[id(item)] = worker
+        item['status'] = 'running'
+        item['progress'] = len(done)
+        self.item_changed.emit(item)
+        worker.start()
+
+    def _progress(self, item, value):
+        item['progress'] = item.get('done_before', 0) + value if item['total'] > 0 else value
+        self.item_changed.emit(item)
+
+    def _episodes(self, item, events):
+        for event in events:
+            if event.get('type') == 'episode_end' and event.get('ok') and str(event['episode']) not in item['done']:
+                item['done'].append(str(event['episode']))
+            if self.store is not None and item.get('id') is not None:
+                self.store.episode_event(item['id'], event)
+
+    def _stats(self, item, stats):
+        item['stats'] = stats['text']
+        self.item_changed.emit(item)
+
+    def _finished(self, item, success):
+        if self.workers.pop(id(item), None) is None:
+            return  # stopped, see stop()
+        item['stats'] = ''
+        if item['status'] == 'running':
+            item['status'] = 'done' if success else 'failed'
+        self.item_changed.emit(item)
+        self._fill()
+
+    def is_active(self, item):
+        return id(item) in self.workers
+
+    def stop(self):
+        self.running = False
+        workers = list(self.workers.values())
+        self.workers.clear()
+        for worker in workers:
+            worker.stop()
+        # Wait so the engines save their checkpoints before the next start
+        for worker in workers:
+            worker.wait()
+        for item in self.items:
+            if item['status'] == 'running':
+                item['status'] = 'stopped'
+                item['stats'] = ''
+                self.item_changed.emit(item)
+
 class AnimepaheGui(QWidget):
+    log_signal = pyqtSignal(str)
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Animepahe Downloader GUI")
         self.layout = QVBoxLayout()
         self.state_reset()
+        self.catalog = Catalog(".")
+        # One kept-alive session for every lookup and download; it also
+        # warns from background threads, so its log goes through a signal
+        self.log_signal.connect(self.log)
+        self.client = Client(".", log=lambda msg: self.log_signal.emit(f"[WARNING] {msg}"))
+        # Network lookups run here so the window never waits on them
+        self.tasks = TaskRunner()
+        self.metadata_key = None
 
         # --- Refresh anime list ---
         self.refresh_btn = QPushButton("Refresh Anime List")
@@ -97,7 +648,14 @@ class AnimepaheGui(QWidget):
         self.search_input.setEnabled(False)
         self.layout.addWidget(self.search_input)
         self.search_btn = QPushButton("Search Anime")
-        self.search_btn.clicked.connect(self.search_title)
+        self.search_btn.clicked.connect(lambda: self.search_title())
+        # Search as you type, once typing pauses briefly
+        self.title_index = TitleIndex("anime.list")
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(150)
+        self.search_timer.timeout.connect(lambda: self.search_title(quiet=True))
+        self.search_input.textChanged.connect(self.search_timer.start)
         self.search_btn.setEnabled(False)
         self.layout.addWidget(self.search_btn)
         self.results_list = QListWidget()
@@ -157,6 +715,8 @@ class AnimepaheGui(QWidget):
         self.progress_bar.setMinimum(0)
         self.progress_bar.setMaximum(100)
         self.layout.addWidget(self.progress_bar)
+        self.stats_label = QLabel("")
+        self.layout.addWidget(self.stats_label)
         # --- Stop button ---
         self.stop_btn = QPushButton("Stop Download")
         self.stop_btn.clicked.connect(self.stop_download)
@@ -164,14 +724,42 @@ class AnimepaheGui(QWidget):
         self.layout.addWidget(self.stop_btn)
 
         # --- Log ---
-        self.log_output = QTextEdit()
-        self.log_output.setReadOnly(True)
-        self.layout.addWidget(self.log_output)
+        self.log_view = LogView()
+        self.layout.addWidget(self.log_view)
 
         # --- Queue controls ---
         self.queue_list = QListWidget()
         self.layout.addWidget(QLabel("Download Queue"))
         self.layout.addWidget(self.queue_list)
+        qopt_layout = QHBoxLayout()
+        qopt_layout.addWidget(QLabel("Priority:"))
+        self.priority_combo = QComboBox()
+        self.priority_combo.addItems(DownloadManager.PRIORITIES)
+        self.priority_combo.setCurrentText('Normal')
+        qopt_layout.addWidget(self.priority_combo)
+        qopt_layout.addWidget(QLabel("Parallel items:"))
+        self.parallel_spin = QSpinBox()
+        self.parallel_spin.setRange(1, 8)
+        self.parallel_spin.setValue(2)
+        qopt_layout.addWidget(self.parallel_spin)
+        qopt_layout.addWidget(QLabel("Total threads:"))
+        self.budget_spin = QSpinBox()
+        self.budget_spin.setRange(1, 128)
+        self.budget_spin.setValue(16)
+        qopt_layout.addWidget(self.budget_spin)
+        qopt_layout.addWidget(QLabel("Bandwidth limit:"))
+        # Shared with every running download, including the terminal script's
+        self.rate_input = QLineEdit(ratelimit.read_limit() or '')
+        self.rate_input.setPlaceholderText("e.g. 4M or 08:00-23:00=1M,4M; blank for none")
+        self.rate_input.editingFinished.connect(self.set_bandwidth_limit)
+        qopt_layout.addWidget(self.rate_input)
+        self.move_up_btn = QPushButton("Move Up")
+        self.move_up_btn.clicked.connect(lambda: self.move_queue_item(-1))
+        qopt_layout.addWidget(self.move_up_btn)
+        self.move_down_btn = QPushButton("Move Down")
+        self.move_down_btn.clicked.connect(lambda: self.move_queue_item(1))
+        qopt_layout.addWidget(self.move_down_btn)
+        self.layout.addLayout(qopt_layout)
         qbtn_layout = QHBoxLayout()
         self.add_to_queue_btn = QPushButton("Add to Queue")
         self.add_to_queue_btn.clicked.connect(self.add_to_queue)
@@ -186,12 +774,38 @@ class AnimepaheGui(QWidget):
         self.clear_queue_btn.clicked.connect(self.clear_queue)
         qbtn_layout.addWidget(self.clear_queue_btn)
         self.layout.addLayout(qbtn_layout)
+        self.bandwidth_label = QLabel("")
+        self.layout.addWidget(self.bandwidth_label)
+        self.bandwidth_timer = QTimer(self)
+        self.bandwidth_timer.timeout.connect(self._update_bandwidth)
+        self.bandwidth_timer.start(2000)
+
+        # --- Statistics ---
+        # Time, bytes and items per phase of every download of this session
+        self.metrics = MetricsCollector()
+        metrics_box = QGroupBox("Statistics")
+        metrics_layout = QHBoxLayout()
+        self.metrics_label = QLabel("No download yet.")
+        self.metrics_label.setStyleSheet("font-family: monospace")
+        metrics_layout.addWidget(self.metrics_label, 1)
+        self.metrics_reset_btn = QPushButton("Reset")
+        self.metrics_reset_btn.clicked.connect(self.reset_metrics)
+        metrics_layout.addWidget(self.metrics_reset_btn)
+        metrics_box.setLayout(metrics_layout)
+        self.layout.addWidget(metrics_box)
 
         self.queue = []
-        self.queue_active_index = -1
         self.downloading_queue = False
+        # The queue outlives the window: entries, their episodes and whether it was running
+        self.queue_store = QueueStore(".")
+        self.manager = DownloadManager(self.queue, self._queue_job, client=self.client, store=self.queue_store)
+        self.manager.log_signal.connect(self.log)
+        self.manager.item_changed.connect(self._queue_item_changed)
+        self.manager.metrics_signal.connect(self._add_metrics)
+        self.manager.finished.connect(self._queue_finished)
 
         self.setLayout(self.layout)
+        self._restore_queue()
 
     def state_reset(self):
         self.session_key = None
@@ -202,43 +816,37 @@ class AnimepaheGui(QWidget):
         self.max_ep = None
 
     def log(self, txt):
-        self.log_output.append(txt)
-        self.log_output.ensureCursorVisible()
+        self.log_view.append(txt)
+
+    def closeEvent(self, event):
+        if self.manager.workers:
+            # The store still says the queue is running, the next start resumes it
+            self.manager.stop()
+        self.tasks.shutdown()
+        super().closeEvent(event)
 
     def refresh_anime_list(self):
-        import os
+        # Asks the site whether the list changed, downloads it only if so
+        if not self.tasks.submit('refresh', lambda: self.client.update_anime_list(max_age=0),
+                                 self._anime_list_refreshed):
+            return
+        self.refresh_btn.setEnabled(False)
         self.status_label.setText("[INFO] Refreshing anime list...")
-        self.log("[INFO] Running animepahe-dl.sh to generate/update anime.list...")
-        
-        # Run animepahe-dl.sh which will generate anime.list
-        # The script generates the list first, then tries to use fzf (which we can ignore)
-        # We check if anime.list exists after running, regardless of return code
-        proc = subprocess.run(
-            ["C:\\Program Files\\Git\\bin\\bash.exe", "animepahe-dl.sh"],
-            stdout=subprocess.PIPE, 
-            stderr=subprocess.PIPE,
-            timeout=60  # Timeout after 60 seconds if something hangs
-        )
-        
-        # Check if anime.list was created/updated
-        # Note: The script might error at fzf stage, but list is already generated by then
-        if os.path.exists("anime.list"):
-            # Count lines to show how many entries
-            try:
-                with open("anime.list", encoding="utf-8") as f:
-                    line_count = sum(1 for _ in f)
-                self.status_label.setText(f"Anime list refreshed successfully! ({line_count} entries)")
-                self.log(f"[INFO] Anime list updated with {line_count} entries!")
-            except Exception as e:
-                self.status_label.setText("Anime list refreshed (could not count entries)")
-                self.log(f"[INFO] Anime list updated! (Error counting: {e})")
-        else:
-            # List wasn't created, show error
+        self.log("[INFO] Updating anime.list...")
+
+    def _anime_list_refreshed(self, result, error):
+        self.refresh_btn.setEnabled(True)
+        if error is not None:
             self.status_label.setText("Error: Failed to generate anime.list")
-            error_msg = proc.stderr.decode(errors='ignore') if proc.stderr else "Unknown error"
-            if not error_msg.strip():
-                error_msg = proc.stdout.decode(errors='ignore') if proc.stdout else "No error message available"
-            self.log(f"[ERROR] Failed to refresh list: {error_msg}")
+            self.log(f"[ERROR] Failed to refresh list: {error}")
+            return
+        line_count, state = result
+        if state != 'updated':
+            self.status_label.setText(f"Anime list is up to date. ({line_count} entries)")
+            self.log(f"[INFO] Anime list unchanged, {line_count} entries")
+            return
+        self.status_label.setText(f"Anime list refreshed successfully! ({line_count} entries)")
+        self.log(f"[INFO] Anime list updated with {line_count} entries!")
 
     def toggle_key_mode(self):
         if self.key_mode_manual.isChecked():
@@ -252,47 +860,23 @@ class AnimepaheGui(QWidget):
             self.search_btn.setEnabled(True)
             self.results_list.setEnabled(True)
 
-    def search_title(self):
+    def search_title(self, quiet=False):
         keyword = self.search_input.text().strip()
         if not keyword:
-            QMessageBox.warning(self, "Missing Input", "Please enter a keyword.")
+            if not quiet:
+                QMessageBox.warning(self, "Missing Input", "Please enter a keyword.")
             return
-        self.results_items = []   # keep (key, title, full_line) for selection
-        results = []
-        try:
-            import re
-            with open("anime.list", encoding="utf-8") as f:
-                for line in f:
-                    if keyword.lower() in line.lower():
-                        # Format: [key] Title - extract key and title separately
-                        m = re.match(r"\[([a-zA-Z0-9-]+)\]\s*(.*)", line.strip())
-                        if m:
-                            key = m.group(1).strip()
-                            raw_title = m.group(2).strip()
-                            # Only show title, never the key
-                            title = raw_title if raw_title else line.strip()
-                            self.results_items.append((key, title, line.strip()))
-                            results.append(title)
-                        else:
-                            # Fallback: if regex doesn't match, show full line but try to extract key
-                            fallback_key = re.search(r"\[([a-zA-Z0-9-]+)\]", line.strip())
-                            if fallback_key:
-                                key = fallback_key.group(1)
-                                # Try to remove the key part from display
-                                display = re.sub(r"\[([a-zA-Z0-9-]+)\]\s*", "", line.strip(), count=1)
-                                title = display if display else line.strip()
-                            else:
-                                key = None
-                                title = line.strip()
-                            self.results_items.append((key, title, line.strip()))
-                            results.append(title)
-        except FileNotFoundError:
+        import os
+        if not os.path.exists("anime.list"):
             self.status_label.setText("anime.list not found! Please refresh first.")
             return
+        # Ranked, one entry per slug; only the title is shown, never the key
+        matches = self.title_index.search(keyword)
+        self.results_items = [(key, title, f"[{key}] {title}") for key, title in matches]
         self.results_list.clear()
-        if results:
-            self.results_list.addItems(results)
-            self.status_label.setText(f"Found {len(results)} results. Select one to continue.")
+        if matches:
+            self.results_list.addItems([title for _, title in matches])
+            self.status_label.setText(f"Found {len(matches)} results. Select one to continue.")
         else:
             self.status_label.setText("No matches found.")
 
@@ -313,108 +897,81 @@ class AnimepaheGui(QWidget):
             self.log(f"[KEY] Using extracted key: {self.session_key}")
             self.metadata_fetch()
 
-    def metadata_fetch(self):
-        import os, json, re
+    def metadata_fetch(self, then=None):
+        """Show the episode range of the session key, then call then().
+
+        Known folders are looked up at once; otherwise the release list is
+        fetched in the background and a newer selection supersedes it.
+        """
         if not self.session_key:
             if not self.session_key_input.text().strip():
                 self.status_label.setText("Session key required.")
                 return
             self.session_key = self.session_key_input.text().strip()
+        slug = self.session_key
+        if self.metadata_key is not None:
+            self.tasks.cancel(f"source:{self.metadata_key[0]}", self.metadata_key[1])
+            self.metadata_key = None
         self.metadata_label.setText("Fetching metadata...")
-        # Determine intended folder directory for this session_key/title
-        folder = None
-        # Try to use the best title (from search or manual)
-        if self.selected_line:
-            line = self.selected_line
-            m = re.match(r"\[([a-zA-Z0-9-]+)\] *(.*)", line)
+        entry = self._local_source(slug, self.selected_line)
+        if entry is not None:
+            self._show_metadata(entry)
+            if then:
+                then()
+            return
+
+        def fetched(entry, error):
+            self.metadata_key = None
+            if error is not None:
+                self.log(f"[ERROR] Failed to fetch episode list: {error}")
+            if entry is None:
+                self.metadata_label.setText("[ERROR] Could not find metadata folder.")
+                return
+            self._show_metadata(entry)
+            if then:
+                then()
+
+        # If we get here, metadata doesn't exist - fetch the release list
+        self.metadata_key = (slug, fetched)
+        selected = self.selected_line
+        self.tasks.submit(f"source:{slug}", lambda: self._fetch_source(slug, selected), fetched)
+
+    def _local_source(self, slug, selected_line):
+        import os, re
+        # Indexed lookup by slug, the source is re-parsed only if it changed
+        entry = self.catalog.lookup(slug)
+        if entry is None and selected_line:
+            # Folders written before sources recorded their slug: try the
+            # folder named after the selected title
+            m = re.match(r"\[([a-zA-Z0-9-]+)\] *(.*)", selected_line)
             if m:
                 folder_candidate = m.group(2).strip()
                 # Use only safe characters for folder name
                 folder_candidate = re.sub(r'[^a-zA-Z0-9 _\-\(\)\+]', '_', folder_candidate)
                 if os.path.isdir(folder_candidate):
-                    folder = folder_candidate
-        # Otherwise, search for any existing folders matching session_key
-        if not folder:
-            # Use <something> directory where .source.json contains this session_key
-            for d in os.listdir('.'):
-                if os.path.isdir(d):
-                    src = os.path.join(d, '.source.json')
-                    if os.path.exists(src):
-                        try:
-                            with open(src, encoding="utf-8") as sf:
-                                jdata = json.load(sf)
-                                # check slug/key in either top-level or nested data
-                                found = False
-                                if 'episodes' in jdata:
-                                    found = any(str(self.session_key) == str(e.get('session') or e.get('id') or '') for e in jdata['episodes'])
-                                if not found and 'data' in jdata:
-                                    found = any(str(self.session_key) == str(e.get('session') or e.get('id') or '') for e in jdata['data'])
-                                if found:
-                                    folder = d
-                                    break
-                        except Exception:
-                            pass
-        anime_folder = folder
-        source_file = os.path.join(anime_folder, '.source.json') if anime_folder else None
-        if anime_folder and os.path.exists(source_file):
-            # Reuse present metadata
-            try:
-                with open(source_file, encoding="utf-8") as sf:
-                    data = json.load(sf)
-                    ep_field = 'episodes' if 'episodes' in data else 'data' if 'data' in data else None
-                    if ep_field:
-                        eps = [int(e['episode']) for e in data[ep_field] if 'episode' in e]
-                        min_ep = min(eps)
-                        max_ep = max(eps)
-                        self.metadata_label.setText(f"Episodes available: {min_ep}-{max_ep}")
-                        self.anime_folder = anime_folder
-                        self.min_ep = min_ep
-                        self.max_ep = max_ep
-                        self.mode_box.setEnabled(True)
-                        self.download_btn.setEnabled(True)
-                        self.auto_mode_radio.toggled.connect(self.toggle_manual_fields)
-                        self.manual_mode_radio.toggled.connect(self.toggle_manual_fields)
-                        return
-            except Exception as e:
-                self.metadata_label.setText(f"[ERROR] Failed to parse metadata: {e}")
-                self.log(f"[META] {e}")
-                return
-        # If we get here, metadata doesn't exist - run fetch
-        proc = subprocess.run(
-            ["C:\\Program Files\\Git\\bin\\bash.exe", "animepahe-dl.sh", "-s", self.session_key, "-e", "1", "-r", "360", "-o", "jpn", "-t", "1", "-l"],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        )
-        # Now search for correct folder again (it should exist after fetch)
-        dirs = [d for d in os.listdir('.') if os.path.isdir(d) and not d.startswith('animepahe-dl')]
-        dirs.sort(key=os.path.getmtime, reverse=True)
-        anime_folder = None
-        for d in dirs:
-            src = os.path.join(d, '.source.json')
-            if os.path.exists(src):
-                with open(src, encoding="utf-8") as sf:
-                    try:
-                        jdata = json.load(sf)
-                        ep_field = 'episodes' if 'episodes' in jdata else 'data' if 'data' in jdata else None
-                        found = False
-                        if ep_field:
-                            found = any(str(self.session_key) == str(e.get('session') or e.get('id') or '') for e in jdata[ep_field])
-                        if found:
-                            eps = [int(e['episode']) for e in jdata[ep_field] if 'episode' in e]
-                            min_ep = min(eps)
-                            max_ep = max(eps)
-                            self.metadata_label.setText(f"Episodes available: {min_ep}-{max_ep}")
-                            self.anime_folder = d
-                            self.min_ep = min_ep
-                            self.max_ep = max_ep
-                            self.mode_box.setEnabled(True)
-                            self.download_btn.setEnabled(True)
-                            self.auto_mode_radio.toggled.connect(self.toggle_manual_fields)
-                            self.manual_mode_radio.toggled.connect(self.toggle_manual_fields)
-                            return
-                    except Exception as e:
-                        continue
-        self.metadata_label.setText("[ERROR] Could not find metadata folder.")
-        self.log(proc.stderr.decode(errors='ignore'))
+                    entry = self.catalog.index_folder(folder_candidate, slug)
+        return entry
+
+    def _show_metadata(self, entry):
+        self.metadata_label.setText(f"Episodes available: {entry.min_ep}-{entry.max_ep}")
+        self.anime_folder = entry.folder
+        self.min_ep = entry.min_ep
+        self.max_ep = entry.max_ep
+        self.mode_box.setEnabled(True)
+        self.download_btn.setEnabled(True)
+        self.auto_mode_radio.toggled.connect(self.toggle_manual_fields)
+        self.manual_mode_radio.toggled.connect(self.toggle_manual_fields)
+
+    def _fetch_source(self, slug, selected_line):
+        # Runs on a TaskRunner thread, touches no widget
+        from pahe.client import ClientError, folder_name
+        m = re.match(r"\[([a-zA-Z0-9-]+)\] *(.*)", selected_line or '')
+        title = (m.group(2).strip() if m else None) or self.client.title(slug)
+        if not title:
+            raise ClientError(f"Anime {slug} not found in anime.list")
+        folder = folder_name(title)
+        self.client.download_source(slug, folder)
+        return self.catalog.index_folder(folder, slug)
 
     def toggle_manual_fields(self):
         manual = self.manual_mode_radio.isChecked()
@@ -429,9 +986,9 @@ class AnimepaheGui(QWidget):
                 return
             self.session_key = self.session_key_input.text().strip()
         if not self.anime_folder:
-            self.metadata_fetch()
-            if not self.anime_folder:
-                return
+            # Carries on once the episode list is there
+            self.metadata_fetch(then=self.start_download)
+            return
         auto = self.auto_mode_radio.isChecked()
         min_ep = self.min_ep
         max_ep = self.max_ep
@@ -448,16 +1005,17 @@ class AnimepaheGui(QWidget):
                 self.status_label.setText("Invalid episode list!")
                 return
         self.log(f"[START] Downloading {ep_val} (res: {res_val if res_val else 'auto'}, audio: {audio_val})")
-        cmd = ["C:\\Program Files\\Git\\bin\\bash.exe", "animepahe-dl.sh", "-s", str(self.session_key), "-e", ep_val, "-o", audio_val, "-t", "16"]
-        if res_val:
-            cmd.extend(["-r", res_val])
-        
+        job = {'slug': str(self.session_key), 'folder': self.anime_folder, 'episodes': ep_val,
+               'resolution': res_val, 'audio': audio_val, 'threads': 'auto',
+               'weight': DownloadManager.WEIGHTS['Normal'], 'name': self._short_title(self.selected_line)}
+
         # Calculate total episodes for progress tracking
         total_eps = self._count_episodes(ep_val, min_ep, max_ep)
         
         self.download_btn.setEnabled(False)
         self.progress_bar.setVisible(True)
         self.progress_bar.setValue(0)
+        self.stats_label.setText("")
         if total_eps > 0:
             self.progress_bar.setMaximum(total_eps)
             self.progress_bar.setFormat("Downloading: %p% (%v/%m episodes)")
@@ -467,10 +1025,12 @@ class AnimepaheGui(QWidget):
             self.progress_bar.setFormat("Downloading...")
         
         self.stop_btn.setEnabled(True)
-        self.worker = DownloadWorker(cmd, total_episodes=total_eps)
+        self.worker = DownloadWorker(job, total_episodes=total_eps, client=self.client)
         self.worker.log_signal.connect(self.log)
         self.worker.status_signal.connect(self.status_label.setText)
         self.worker.progress_signal.connect(self._update_progress)
+        self.worker.stats_signal.connect(self._update_stats)
+        self.worker.metrics_signal.connect(self._add_metrics)
         self.worker.done_signal.connect(self._download_finished)
         self.worker.start()
         # Display only title, not session key
@@ -496,17 +1056,21 @@ class AnimepaheGui(QWidget):
         keyval = self.session_key or self.session_key_input.text().strip()
         titleval = self.selected_line or self.anime_title or keyval
         auto = self.auto_mode_radio.isChecked()
-        min_ep = self.min_ep or 1
-        max_ep = self.max_ep or 1
+        # The range is only known once this key's metadata was fetched;
+        # otherwise it is fetched in the background below
+        known = keyval == self.session_key and self.min_ep is not None and self.max_ep is not None
+        min_ep = self.min_ep if known else None
+        max_ep = self.max_ep if known else None
+        all_eps = f"{min_ep}-{max_ep}" if known else '*'
         if auto:
-            ep_val = f"{min_ep}-{max_ep}"
+            ep_val = all_eps
             res_val = None
             audio_val = 'jpn'
         else:
-            ep_val = self.episode_input.text().strip() or f"{min_ep}-{max_ep}"
+            ep_val = self.episode_input.text().strip() or all_eps
             res_val = self.resolution_input.text().strip()
             audio_val = self.audio_input.text().strip() or 'jpn'
-            valid = self.check_episode_valid(ep_val, min_ep, max_ep)
+            valid = ep_val == '*' or not known or self.check_episode_valid(ep_val, min_ep, max_ep)
             if not valid:
                 self.status_label.setText("Invalid episode list!")
                 return
@@ -516,81 +1080,239 @@ class AnimepaheGui(QWidget):
             'episodes': ep_val,
             'audio': audio_val,
             'resolution': res_val,
+            'folder': self.anime_folder if known else None,
+            'auto': ep_val == '*',
             'min_ep': min_ep,
-            'max_ep': max_ep
+            'max_ep': max_ep,
+            'priority': self.priority_combo.currentText(),
+            'status': 'pending',
+            'progress': 0,
+            'total': self._count_episodes(ep_val, min_ep, max_ep),
+            'label': self._short_title(titleval) or keyval,
         }
+        item['desc'] = self._queue_desc(item)
+        item['done'] = []
+        item['id'] = self.queue_store.add(**self._stored_fields(item))
+        item['saved'] = item['status']
         self.queue.append(item)
-        desc = f"{titleval if titleval else keyval}: Ep {ep_val} | Audio: {audio_val} | Res: {res_val if res_val else 'auto'}"
-        self.queue_list.addItem(desc)
+        self._add_queue_row(item)
         self.status_label.setText(f"Item added to queue. Queue length: {len(self.queue)}")
+        if not known:
+            self._prefetch_queue_item(item)
+        if self.downloading_queue:
+            self.manager.start()
+
+    def _stored_fields(self, item):
+        return {'slug': item['session_key'], 'title': item['display_title'], 'label': item['label'],
+                'episodes': item['episodes'], 'audio': item['audio'], 'resolution': item['resolution'],
+                'folder': item['folder'], 'auto': item['auto'], 'min_ep': item['min_ep'], 'max_ep': item['max_ep'],
+                'priority': item['priority'], 'state': item['status']}
+
+    def _restore_queue(self):
+        """Show the queue of the last session, and resume it if it was downloading then"""
+        def number(v):
+            return int(v) if v is not None and float(v).is_integer() else v
+
+        self.queue_store.recover()
+        for row in self.queue_store.items():
+            item = {
+                'id': row['id'],
+                'session_key': row['slug'],
+                'display_title': row['title'],
+                'episodes': row['episodes'],
+                'audio': row['audio'],
+                'resolution': row['resolution'],
+                'folder': row['folder'],
+                'auto': bool(row['auto']),
+                'min_ep': number(row['min_ep']),
+                'max_ep': number(row['max_ep']),
+                'priority': row['priority'],
+                'status': row['state'],
+                'label': row['label'] or row['slug'],
+                'done': row['done'],
+            }
+            item['total'] = self._count_episodes(item['episodes'], item['min_ep'], item['max_ep'])
+            item['progress'] = len(item['done'])
+            item['desc'] = self._queue_desc(item)
+            item['saved'] = item['status']
+            self.queue.append(item)
+            self._add_queue_row(item)
+            if item['min_ep'] is None and item['status'] == 'pending':
+                self._prefetch_queue_item(item)
+        if not self.queue:
+            return
+        self.log(f"[INFO] Restored {len(self.queue)} queue entries from the last session")
+        unfinished = any(item['status'] in ('pending', 'stopped', 'failed') for item in self.queue)
+        if self.queue_store.get_flag('downloading') == '1' and unfinished:
+            self.log("[INFO] Resuming the queue downloads")
+            QTimer.singleShot(0, self.start_queue_downloads)
+
+    def _queue_desc(self, item):
+        episodes = 'all' if item['episodes'] == '*' else item['episodes']
+        return (f"{item['display_title'] or item['session_key']}: Ep {episodes} | Audio: {item['audio']}"
+                f" | Res: {item['resolution'] if item['resolution'] else 'auto'}")
+
+    def _prefetch_queue_item(self, item):
+        slug = item['session_key']
+
+        def fetched(entry, error):
+            if entry is None:
+                # Still downloadable, the range is looked up when it starts
+                self.log(f"[WARNING] [{item['label']}] Could not fetch episode list: {error or 'no episodes'}")
+                return
+            if not any(it is item for it in self.queue):
+                return
+            item['min_ep'], item['max_ep'] = entry.min_ep, entry.max_ep
+            if self.manager.is_active(item) or item['status'] != 'pending':
+                self.queue_store.update(item['id'], min_ep=entry.min_ep, max_ep=entry.max_ep)
+                return
+            item['folder'] = entry.folder
+            if item['auto']:
+                item['episodes'] = f"{entry.min_ep}-{entry.max_ep}"
+            elif not self.check_episode_valid(item['episodes'], entry.min_ep, entry.max_ep):
+                item['status'] = 'invalid'
+                self.log(f"[WARNING] [{item['label']}] Episodes {item['episodes']} not in {entry.min_ep}-{entry.max_ep}")
+            item['total'] = self._count_episodes(item['episodes'], entry.min_ep, entry.max_ep)
+            item['desc'] = self._queue_desc(item)
+            self.queue_store.update(item['id'], **self._stored_fields(item))
+            item['saved'] = item['status']
+            self._queue_item_changed(item)
+
+        selected = item['display_title']
+        self.tasks.submit(f"source:{slug}", lambda: self._fetch_source(slug, selected), fetched)
+
+    def _short_title(self, title):
+        # Queue rows and log prefixes show the title only, never the key
+        if not title:
+            return None
+        import re
+        m = re.match(r'\[([a-zA-Z0-9-]+)\]\s*(.*)', title)
+        if m and m.group(2).strip():
+            return m.group(2).strip()
+        return title.strip()
+
+    def _add_queue_row(self, item, row=None):
+        list_item = QListWidgetItem()
+        widget = QueueRow(item['desc'])
+        widget.update_from(item)
+        list_item.setSizeHint(widget.sizeHint())
+        if row is None:
+            self.queue_list.addItem(list_item)
+        else:
+            self.queue_list.insertItem(row, list_item)
+        self.queue_list.setItemWidget(list_item, widget)
+        item['row'] = widget
+
+    def _queue_item_changed(self, item):
+        if item.get('row') is not None:
+            item['row'].update_from(item)
+        # Progress ticks land here too, only state changes are written
+        status = item['status']
+        if status == item.get('saved') or item.get('id') is None:
+            return
+        if status == 'running':
+            self.queue_store.started(item['id'])
+        elif status in ('done', 'failed', 'stopped'):
+            self.queue_store.finished(item['id'], status)
+        else:
+            self.queue_store.update(item['id'], state=status)
+        item['saved'] = status
+
+    def move_queue_item(self, delta):
+        row = self.queue_list.currentRow()
+        target = row + delta
+        if row < 0 or not 0 <= target < len(self.queue):
+            return
+        item = self.queue.pop(row)
+        self.queue.insert(target, item)
+        self.queue_store.reorder([it['id'] for it in self.queue])
+        self.queue_list.takeItem(row)
+        self._add_queue_row(item, target)
+        self.queue_list.setCurrentRow(target)
 
     def remove_selected_queue_item(self):
         row = self.queue_list.currentRow()
         if row >= 0:
+            if self.manager.is_active(self.queue[row]):
+                self.status_label.setText("Cannot remove an item that is downloading.")
+                return
             self.queue_list.takeItem(row)
+            self.queue_store.remove(self.queue[row]['id'])
             del self.queue[row]
             self.status_label.setText(f"Removed from queue. Queue length: {len(self.queue)}")
 
     def clear_queue(self):
+        if self.manager.workers:
+            self.status_label.setText("Stop the queue before clearing it.")
+            return
         self.queue_list.clear()
-        self.queue = []
+        # Keep the same list object, the manager holds a reference to it
+        self.queue.clear()
+        self.queue_store.clear()
         self.status_label.setText("Queue cleared.")
 
     def start_queue_downloads(self):
         if self.downloading_queue or not self.queue:
             return
+        for item in self.queue:
+            # Stopped or failed items resume from their checkpoints
+            if item['status'] in ('stopped', 'failed'):
+                item['status'] = 'pending'
+                self._queue_item_changed(item)
         self.downloading_queue = True
+        self.queue_store.set_flag('downloading', '1')
         self.status_label.setText("Starting batch downloads...")
-        self.queue_active_index = -1
-        self._start_queue_item()
+        self.manager.max_parallel = self.parallel_spin.value()
+        self.manager.thread_budget = self.budget_spin.value()
+        self.stop_btn.setEnabled(True)
+        self.manager.start()
 
-    def _start_queue_item(self):
-        # Move to the next queued download
-        self.queue_active_index += 1
-        if self.queue_active_index >= len(self.queue):
-            self.downloading_queue = False
-            self.status_label.setText("All queue downloads finished.")
+    def _queue_job(self, item, threads):
+        return {'slug': str(item['session_key']), 'folder': item.get('folder'), 'episodes': item['episodes'],
+                'resolution': item['resolution'], 'audio': item['audio'], 'threads': f"auto:{min(2, threads)}-{threads}",
+                'weight': DownloadManager.WEIGHTS[item['priority']], 'name': item['label']}
+
+    def set_bandwidth_limit(self):
+        spec = self.rate_input.text().strip()
+        if spec == (ratelimit.read_limit() or ''):
             return
-        item = self.queue[self.queue_active_index]
-        # Try to show only title and not key for queue as well
-        display_title = item.get('display_title')
-        if display_title:
-            import re
-            m = re.match(r'\[([a-zA-Z0-9-]+)\]\s*(.*)', display_title)
-            if m and m.group(2).strip():
-                display_title = m.group(2).strip()
-        else:
-            display_title = '(Untitled)'
-        self.current_title_label.setText(f"Now Downloading: {display_title}")
-        cmd = ["C:\\Program Files\\Git\\bin\\bash.exe", "animepahe-dl.sh", "-s", str(item['session_key']), "-e", item['episodes'], "-o", item['audio'], "-t", "16"]
-        if item['resolution']:
-            cmd.extend(["-r", item['resolution']])
-        total_eps = self._count_episodes(item['episodes'], item['min_ep'], item['max_ep'])
-        self.progress_bar.setVisible(True)
-        self.progress_bar.setValue(0)
-        if total_eps > 0:
-            self.progress_bar.setMaximum(total_eps)
-            self.progress_bar.setFormat("Queue Download: %p% (%v/%m episodes)")
-        else:
-            self.progress_bar.setMaximum(0)
-            self.progress_bar.setFormat("Queue Download: ...")
-        self.stop_btn.setEnabled(True)
-        self.worker = DownloadWorker(cmd, total_episodes=total_eps)
-        self.worker.log_signal.connect(self.log)
-        self.worker.status_signal.connect(self.status_label.setText)
-        self.worker.progress_signal.connect(self._update_progress)
-        self.worker.done_signal.connect(self._queue_item_finished)
-        self.worker.start()
+        try:
+            ratelimit.write_limit(spec)
+        except (ValueError, OSError) as e:
+            self.status_label.setText(f"Invalid bandwidth limit: {e}")
+            return
+        self.log(f"[INFO] Bandwidth limit {spec or 'removed'}")
+        self._update_bandwidth()
+
+    def _update_bandwidth(self):
+        """Show the cap in effect and what each running download gets of it"""
+        downloads = ratelimit.members()
+        spec = ratelimit.read_limit()
+        if not downloads and not spec:
+            self.bandwidth_label.setText("")
+            return
+        try:
+            cap = ratelimit.RateSchedule(spec).rate() if spec else None
+        except ValueError:
+            cap = None
+        used = sum(e.get('used', 0) for e in downloads.values())
+        text = f"Bandwidth: {human_size(used)}/s of {human_size(cap) + '/s' if cap else 'unlimited'}"
+        shares = [f"{e.get('name', '?')} {human_size(e['share'])}/s"
+                  for e in sorted(downloads.values(), key=lambda e: -(e.get('share') or 0)) if e.get('share')]
+        self.bandwidth_label.setText(text + (" | " + ", ".join(shares) if shares else ""))
 
     def stop_download(self):
+        stopped = False
         if hasattr(self, 'worker') and self.worker.isRunning():
-            # Ensure the DownloadWorker also tries to kill the proc
-            try:
-                if hasattr(self.worker, 'proc') and self.worker.proc and self.worker.proc.poll() is None:
-                    self.worker.proc.terminate()
-            except Exception:
-                pass
-            self.worker.terminate()
+            self.worker.stop()
+            self.worker.wait()
+            stopped = True
+        if self.manager.workers:
+            self.manager.stop()
+            self.downloading_queue = False
+            self.queue_store.set_flag('downloading', '0')
+            stopped = True
+        if stopped:
             self.stop_btn.setEnabled(False)
             self.status_label.setText("Download stopped by user.")
 
@@ -634,8 +1356,32 @@ class AnimepaheGui(QWidget):
             # The bar will pulse automatically in indeterminate mode
             pass
 
+    def _update_stats(self, stats):
+        """Show speed, ETA and segment counts of the running download"""
+        self.stats_label.setText(stats['text'])
+
+    def _add_metrics(self, events):
+        for event in events:
+            self.metrics.update(event)
+        self.metrics_label.setText(self.metrics.describe() or "No download yet.")
+
+    def reset_metrics(self):
+        self.metrics = MetricsCollector()
+        self.metrics_label.setText("No download yet.")
+
+    def _save_metrics(self):
+        # ANIMEPAHE_DL_METRICS names a directory for run summaries
+        try:
+            path = write_run(self.metrics)
+        except OSError as e:
+            self.log(f"[WARNING] Could not write metrics: {e}")
+            return
+        if path:
+            self.log(f"[INFO] Statistics saved to {path}")
+
     def _download_finished(self, success):
         """Handle download completion"""
+        self._save_metrics()
         self.download_btn.setEnabled(True)
         self.stop_btn.setEnabled(False)
         if success:
@@ -646,13 +1392,19 @@ class AnimepaheGui(QWidget):
         # Keep progress bar visible for a moment, then hide after a delay
         # For now, just keep it visible so user can see final status
 
-    def _queue_item_finished(self, success):
-        self.stop_btn.setEnabled(False)
-        if success:
-            self.progress_bar.setFormat("Completed: 100%")
+    def _queue_finished(self):
+        if not self.downloading_queue:
+            return
+        self.downloading_queue = False
+        self.queue_store.set_flag('downloading', '0')
+        self._save_metrics()
+        if not (hasattr(self, 'worker') and self.worker.isRunning()):
+            self.stop_btn.setEnabled(False)
+        failed = sum(1 for item in self.queue if item['status'] == 'failed')
+        if failed:
+            self.status_label.setText(f"All queue downloads finished, {failed} failed.")
         else:
-            self.progress_bar.setFormat("Failed")
-        self._start_queue_item()
+            self.status_label.setText("All queue downloads finished.")
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
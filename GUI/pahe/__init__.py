@@ -0,0 +1,10 @@
+"""Python side of animepahe-dl.
+
+The bash script stays the terminal front end; the modules in this package
+take over the hot paths (segment download, decryption, muxing) so a run no
+longer spawns a curl/openssl process per segment. pahe.client covers the
+site lookups, so the GUI drives the package without the script,
+pahe.daemon can keep all of it running for both of them, and
+pahe.workqueue shares the episodes of a library between several hosts.
+pahe.queuestore keeps the GUI's download queue across restarts.
+"""
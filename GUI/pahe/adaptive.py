@@ -0,0 +1,133 @@
+"""Adaptive segment concurrency for -t auto.
+
+AdaptiveLimiter gates every segment request. A fixed pool of `maximum`
+workers runs, but only `limit` of them may have a request in flight. The
+limit is re-evaluated every `interval` seconds from the requests that
+completed in that window, AIMD style:
+
+- 429/503 answers or more than 5% failed requests: multiply by 0.75
+- throughput gained from the last increase: slow start doubles the
+  limit until the first cut, then it grows by one
+- no gain, or latency up without more throughput: step back by one and
+  hold there for a few windows before probing again
+
+Every change is logged with its reason and emitted as a "concurrency"
+event (see pahe.events).
+"""
+import threading
+import time
+
+from .console import print_info
+from .events import EventWriter, human_size
+
+DEFAULT_MIN = 2
+DEFAULT_MAX = 32
+THROTTLE_STATUS = (429, 503)
+
+
+def parse_threads(value):
+    """Parse -t: "16", "auto" or "auto:MIN-MAX".
+
+    Returns (minimum, maximum, auto); a fixed number gives (n, n, False).
+    """
+    value = str(value).strip().lower()
+    if value.isdigit() and int(value) > 0:
+        return int(value), int(value), False
+    if value == "auto":
+        return DEFAULT_MIN, DEFAULT_MAX, True
+    if value.startswith("auto:"):
+        lo, sep, hi = value[5:].partition("-")
+        if sep and lo.isdigit() and hi.isdigit() and 0 < int(lo) <= int(hi):
+            return int(lo), int(hi), True
+    raise ValueError(f"invalid thread count {value!r}, expected a number, auto or auto:MIN-MAX")
+
+
+class AdaptiveLimiter:
+    def __init__(self, minimum=DEFAULT_MIN, maximum=DEFAULT_MAX, initial=None, interval=2.0, hold=3,
+                 log=print_info, events=None):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(self.maximum, max(self.minimum, initial or 4))
+        self.interval = interval
+        self.hold = hold
+        self.log = log
+        self.events = events or EventWriter()
+        self.history = []  # (time, old limit, new limit, reason)
+        self._cond = threading.Condition()
+        self._inflight = 0
+        self._closed = False
+        self._slow_start = True
+        self._holding = 0
+        self._last = None  # (limit, throughput, latency) of the previous window
+        self._reset_window(time.monotonic())
+
+    def _reset_window(self, now):
+        self._started = now
+        self._count = 0
+        self._bytes = 0
+        self._failed = 0
+        self._throttled = 0
+        self._latency = 0.0
+
+    def acquire(self):
+        """Wait for a free slot; False once the limiter is closed"""
+        with self._cond:
+            while not self._closed and self._inflight >= self.limit:
+                self._cond.wait()
+            if self._closed:
+                return False
+            self._inflight += 1
+            return True
+
+    def release(self, nbytes=0, latency=0.0, status=None):
+        """Record one finished request; status None means it failed without an answer"""
+        with self._cond:
+            self._inflight -= 1
+            self._count += 1
+            self._bytes += nbytes
+            self._latency += latency
+            if status in THROTTLE_STATUS:
+                self._throttled += 1
+            elif status is None or status >= 400:
+                self._failed += 1
+            now = time.monotonic()
+            if now - self._started >= self.interval and self._count >= min(self.limit, 4):
+                self._adjust(now)
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def _adjust(self, now):
+        elapsed = now - self._started
+        throughput = self._bytes / elapsed
+        latency = self._latency / self._count
+        old = self.limit
+        speed = f"{human_size(throughput)}/s"
+        if self._throttled or self._failed > 0.05 * self._count:
+            new = max(self.minimum, int(old * 0.75))
+            reason = f"{self._throttled} throttled and {self._failed} failed of {self._count} requests"
+            self._slow_start = False
+            self._holding = self.hold
+        elif self._holding:
+            self._holding -= 1
+            new, reason = old, None
+        elif self._last and self._last[0] < old and throughput < self._last[1] * 1.05:
+            # The last increase bought nothing: back off and stay there a while
+            new = max(self.minimum, old - 1)
+            worse = " with higher latency" if latency > self._last[2] * 1.5 else ""
+            reason = f"no gain at {old}{worse}, {speed}"
+            self._slow_start = False
+            self._holding = self.hold
+        else:
+            new = min(self.maximum, old * 2 if self._slow_start else old + 1)
+            reason = f"{'slow start' if self._slow_start else 'probing'}, {speed}"
+        self._last = (old, throughput, latency)
+        self._reset_window(now)
+        if new != old:
+            self.limit = new
+            self.history.append((time.time(), old, new, reason))
+            self.log(f"Concurrency {old} -> {new}: {reason}")
+            self.events.emit("concurrency", limit=new, previous=old, reason=reason, speed=round(throughput, 1))
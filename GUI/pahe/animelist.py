@@ -0,0 +1,164 @@
+"""anime.list store: one "[slug] Title" line per anime, kept compact.
+
+download_anime_list used to rewrite the list from the /anime page on every
+run and search_anime_by_name appended to it, so the same slug piled up.
+Both now merge into it by slug (a newer title replaces the older one) and
+the list is written atomically. .anime.list.json next to it records the
+page's ETag and Last-Modified and when it was last checked: within
+ANIMEPAHE_DL_LIST_TTL seconds (default a day) the list is used as it is,
+after that Client.update_anime_list asks for the page conditionally and
+only a changed page is downloaded and merged.
+
+    python -m pahe.animelist add < lines    merge "[slug] Title" lines
+    python -m pahe.animelist compact        drop duplicate slugs
+    python -m pahe.animelist status
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+
+ANIME_LIST_FILE = "anime.list"
+META_FILE = ".anime.list.json"
+TTL_ENV = "ANIMEPAHE_DL_LIST_TTL"
+DEFAULT_TTL = 24 * 3600
+
+_LINE_RE = re.compile(r"^\[([a-zA-Z0-9-]+)\]\s*(.*?)\s*$")
+
+
+def list_ttl():
+    """Seconds a checked list stays fresh, ANIMEPAHE_DL_LIST_TTL"""
+    try:
+        return max(0, int(os.environ.get(TTL_ENV, DEFAULT_TTL)))
+    except ValueError:
+        return DEFAULT_TTL
+
+
+def parse_line(line):
+    """Return (slug, title) for an anime.list line, or None"""
+    m = _LINE_RE.match(line.strip())
+    if not m or not m.group(2):
+        return None
+    return m.group(1), m.group(2)
+
+
+def parse_lines(lines):
+    """(slug, title) of each "[slug] Title" line"""
+    for line in lines:
+        entry = parse_line(line)
+        if entry:
+            yield entry
+
+
+def read_list(path):
+    """{slug: title} of anime.list, the last title of a slug wins"""
+    try:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            return dict(parse_lines(f))
+    except OSError:
+        return {}
+
+
+def _file_mode():
+    """Mode of a newly created file under the current umask"""
+    mask = os.umask(0)
+    os.umask(mask)
+    return 0o666 & ~mask
+
+
+def write_list(path, entries):
+    # Same line format as download_anime_list, trailing spaces included
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".anime.list.")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.writelines(f"[{slug}] {title}   \n" for slug, title in entries.items())
+        # mkstemp creates it 0600, the list is as readable as any other file
+        os.chmod(tmp, _file_mode())
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def merge(path, entries):
+    """Merge (slug, title) pairs into the list; returns ({slug: title}, changed).
+
+    The file is only rewritten when a slug is new, a title changed or it
+    held duplicates.
+    """
+    old = read_list(path)
+    merged = dict(old)
+    merged.update(entries)
+    changed = merged != old
+    if not changed:
+        try:
+            with open(path, encoding="utf-8", errors="replace") as f:
+                changed = sum(1 for _ in f) != len(merged)
+        except OSError:
+            changed = bool(merged)
+    if changed:
+        write_list(path, merged)
+    return merged, changed
+
+
+def read_meta(root="."):
+    try:
+        with open(os.path.join(root, META_FILE), encoding="utf-8") as f:
+            meta = json.load(f)
+        return meta if isinstance(meta, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def write_meta(root, url, headers):
+    """Record a check of url, with the validators of its answer"""
+    meta = {"url": url, "checked": time.time(),
+            "etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified")}
+    fd, tmp = tempfile.mkstemp(dir=root or ".", prefix=".anime.list.")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp, os.path.join(root, META_FILE))
+
+
+def is_fresh(meta, url, max_age):
+    return meta.get("url") == url and time.time() - (meta.get("checked") or 0) < max_age
+
+
+def conditional_headers(meta, url):
+    """If-None-Match / If-Modified-Since for the page recorded in meta"""
+    headers = {}
+    if meta.get("url") == url:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+    return headers
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="pahe.animelist", description="Maintain anime.list")
+    parser.add_argument("--root", default=".", help="library directory (default: .)")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("add", help='merge "[slug] Title" lines from stdin')
+    sub.add_parser("compact", help="rewrite the list with one line per slug")
+    sub.add_parser("status", help="entries and last check")
+    args = parser.parse_args(argv)
+
+    path = os.path.join(args.root, ANIME_LIST_FILE)
+    if args.cmd == "add":
+        merge(path, list(parse_lines(sys.stdin)))
+    elif args.cmd == "compact":
+        print(f"{len(merge(path, [])[0])} entries")
+    else:
+        meta = read_meta(args.root)
+        checked = meta.get("checked")
+        age = f"checked {int(time.time() - checked)}s ago" if checked else "never checked"
+        print(f"{len(read_list(path))} entries, {age}, fresh for {list_ttl()}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
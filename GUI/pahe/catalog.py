@@ -0,0 +1,147 @@
+"""Library catalog: anime slug -> metadata folder and episode range.
+
+Finding an anime's folder used to mean json-loading every */.source.json.
+The catalog is a small SQLite file (.catalog.db in the library root) that
+answers it with one indexed lookup. Entries are keyed by the .source.json
+mtime, so a folder is only parsed again after download_source rewrote it.
+
+    python -m pahe.catalog lookup <slug>     # prints folder, min_ep, max_ep
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+
+CATALOG_FILE = ".catalog.db"
+SOURCE_FILE = ".source.json"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS anime (
+    slug TEXT PRIMARY KEY,
+    folder TEXT NOT NULL,
+    source_mtime REAL NOT NULL,
+    min_ep REAL,
+    max_ep REAL
+);
+CREATE INDEX IF NOT EXISTS anime_folder ON anime (folder);
+"""
+
+
+def _number(v):
+    n = float(v)
+    return int(n) if n.is_integer() else n
+
+
+def read_source(path):
+    """Return (slug or None, [episode, ...]) from a .source.json"""
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    field = "episodes" if "episodes" in data else "data"
+    eps = [_number(e["episode"]) for e in data.get(field) or [] if "episode" in e]
+    return data.get("slug"), eps
+
+
+class CatalogEntry:
+    def __init__(self, slug, folder, min_ep, max_ep):
+        self.slug = slug
+        self.folder = folder
+        self.min_ep = _number(min_ep) if min_ep is not None else None
+        self.max_ep = _number(max_ep) if max_ep is not None else None
+
+
+class Catalog:
+    def __init__(self, root=".", path=None):
+        self.root = root
+        self.path = path or os.path.join(root, CATALOG_FILE)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def _source_mtime(self, folder):
+        try:
+            return os.stat(os.path.join(self.root, folder, SOURCE_FILE)).st_mtime
+        except OSError:
+            return None
+
+    def index_folder(self, folder, slug=None):
+        """(Re)read folder's .source.json into the catalog.
+
+        slug is needed for sources written before download_source started
+        recording it; returns the CatalogEntry or None.
+        """
+        mtime = self._source_mtime(folder)
+        if mtime is None:
+            return None
+        try:
+            src_slug, eps = read_source(os.path.join(self.root, folder, SOURCE_FILE))
+        except (OSError, ValueError, KeyError):
+            return None
+        slug = src_slug or slug
+        if not slug or not eps:
+            return None
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM anime WHERE folder = ? AND slug != ?", (folder, slug))
+            self._db.execute("INSERT OR REPLACE INTO anime VALUES (?, ?, ?, ?, ?)",
+                             (slug, folder, mtime, min(eps), max(eps)))
+        return CatalogEntry(slug, folder, min(eps), max(eps))
+
+    def lookup(self, slug):
+        """CatalogEntry for slug, re-parsing its source only if it changed"""
+        with self._lock:
+            row = self._db.execute("SELECT folder, source_mtime, min_ep, max_ep FROM anime WHERE slug = ?",
+                                   (slug,)).fetchone()
+        if row is None:
+            return None
+        folder, mtime, min_ep, max_ep = row
+        cur = self._source_mtime(folder)
+        if cur is None:
+            with self._lock, self._db:
+                self._db.execute("DELETE FROM anime WHERE slug = ?", (slug,))
+            return None
+        if cur != mtime:
+            return self.index_folder(folder, slug)
+        return CatalogEntry(slug, folder, min_ep, max_ep)
+
+    def scan(self):
+        """Index folders that are new or changed since the last scan.
+
+        Only stats unchanged folders, it does not parse their JSON.
+        """
+        with self._lock:
+            known = dict(self._db.execute("SELECT folder, source_mtime FROM anime"))
+        for d in os.listdir(self.root):
+            mtime = self._source_mtime(d)
+            if mtime is not None and known.get(d) != mtime:
+                self.index_folder(d)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="pahe.catalog", description="Look up anime folders in the library catalog")
+    parser.add_argument("--root", default=".", help="library directory (default: .)")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("lookup", help="print folder, first and last episode of a slug")
+    p.add_argument("slug")
+    sub.add_parser("scan", help="index new or changed folders")
+    args = parser.parse_args(argv)
+
+    catalog = Catalog(args.root)
+    if args.cmd == "scan":
+        catalog.scan()
+        return 0
+    entry = catalog.lookup(args.slug)
+    if entry is None:
+        catalog.scan()
+        entry = catalog.lookup(args.slug)
+    if entry is None:
+        return 1
+    print(f"{entry.folder}\t{entry.min_ep}\t{entry.max_ep}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
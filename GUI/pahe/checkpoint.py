@@ -0,0 +1,94 @@
+"""Per-episode checkpoint manifest.
+
+Kept as checkpoint.json in the episode's scratch directory, it records
+which segments were fully downloaded (and their size) and which were
+decrypted, so an interrupted episode only fetches what is missing when it
+is run again.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+CHECKPOINT_FILE = "checkpoint.json"
+
+
+def playlist_fingerprint(playlist):
+    """Identify a playlist by its segment list, ignoring expiring URL tokens"""
+    h = hashlib.sha1()
+    for s in playlist.segments:
+        h.update(f"{s.sequence}:{s.name}\n".encode())
+    return h.hexdigest()
+
+
+class Checkpoint:
+    def __init__(self, outdir, playlist, save_interval=0.5):
+        self.path = os.path.join(outdir, CHECKPOINT_FILE)
+        self.outdir = outdir
+        self.fingerprint = playlist_fingerprint(playlist)
+        self.save_interval = save_interval
+        self.segments = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._saved_at = 0.0
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        # A different playlist (other resolution/audio) invalidates everything
+        if data.get("playlist") == self.fingerprint:
+            self.segments = data.get("segments", {})
+
+    def _file_size(self, name):
+        try:
+            return os.path.getsize(os.path.join(self.outdir, name))
+        except OSError:
+            return -1
+
+    def is_downloaded(self, name, suffix=".encrypted"):
+        """True if the encrypted segment is on disk with the recorded size"""
+        entry = self.segments.get(name)
+        return bool(entry) and entry.get("size") == self._file_size(name + suffix)
+
+    def is_decrypted(self, name):
+        entry = self.segments.get(name)
+        return bool(entry) and entry.get("decrypted") is not None \
+            and entry["decrypted"] == self._file_size(name)
+
+    def mark_downloaded(self, name, size):
+        with self._lock:
+            self.segments[name] = {"size": size, "decrypted": None}
+            self._touch()
+
+    def mark_decrypted(self, name, size):
+        with self._lock:
+            self.segments.setdefault(name, {"size": None})["decrypted"] = size
+            self._touch()
+
+    def _touch(self):
+        self._dirty = True
+        if time.monotonic() - self._saved_at >= self.save_interval:
+            self._save()
+
+    def _save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"playlist": self.fingerprint, "segments": self.segments}, f)
+        os.replace(tmp, self.path)
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+    def flush(self):
+        with self._lock:
+            if self._dirty:
+                self._save()
+
+    def summary(self):
+        downloaded = sum(1 for e in self.segments.values() if e.get("size") is not None)
+        decrypted = sum(1 for e in self.segments.values() if e.get("decrypted") is not None)
+        return downloaded, decrypted
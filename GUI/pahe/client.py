@@ -0,0 +1,395 @@
+"""animepahe client over one kept-alive session.
+
+The Python counterpart of the script's get()-based lookups: the anime
+list, search, release pages, the play page's download buttons and kwik
+playlist resolution all go through a single Session holding the
+__ddg2_ cookie, so a GUI action costs a request on an open connection
+instead of a bash and a curl process plus DNS and a TLS handshake.
+
+Files are written in the script's formats (anime.list, <anime>/.source.json,
+.playlist.cache), so the GUI and animepahe-dl.sh share one library.
+
+    python -m pahe.client search "one punch"
+    python -m pahe.client source <slug>
+    python -m pahe.client resolve <slug> 1-3 -r 1080 -o jpn
+
+Links of a range are resolved a few episodes ahead of the one being
+downloaded (Prefetcher, ANIMEPAHE_DL_PREFETCH).
+"""
+import argparse
+import json
+import os
+import random
+import re
+import string
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+from . import animelist, kwik
+from .animelist import ANIME_LIST_FILE
+from .catalog import SOURCE_FILE, _number
+from .console import print_warn
+from .session import HttpError, Session
+
+DEFAULT_HOST = "https://animepahe.si"
+PAGE_JOBS = 8
+PREFETCH_JOBS = 2
+
+_ANIME_LINK_RE = re.compile(r'/anime/([a-zA-Z0-9-]+)" title="([^"]*)"')
+_BUTTON_RE = re.compile(r"<button\b[^>]*\bdata-src=[^>]*>")
+_ATTR_RE = re.compile(r'data-([\w-]+)="([^"]*)"')
+
+
+class ClientError(Exception):
+    pass
+
+
+def host_url():
+    """ANIMEPAHE_DL_HOST as in animepahe-dl.sh, e.g. bench/fakepahe.py"""
+    return os.environ.get("ANIMEPAHE_DL_HOST", DEFAULT_HOST).rstrip("/")
+
+
+def make_cookie():
+    """A fresh __ddg2_ cookie, as set_cookie does"""
+    return "__ddg2_=" + "".join(random.choices(string.ascii_letters + string.digits, k=16))
+
+
+def folder_name(title):
+    """Library folder of an anime, the script's _ANIME_NAME"""
+    return re.sub(r"[^a-zA-Z0-9 ,+\-)(]", "_", title.rstrip())
+
+
+def parse_episodes(spec, available):
+    """Episode numbers of an -e string like "1,3,5-8" or "*", sorted and unique.
+
+    "*" means first to last of `available`, ranges count up in steps of
+    one as the script's seq does.
+    """
+    numbers = set()
+    for part in str(spec).split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "*" in part:
+            if not available:
+                continue
+            part = f"{min(available)}-{max(available)}"
+        first, sep, last = part.partition("-")
+        try:
+            if sep:
+                n, last = float(first), float(last)
+                while n <= last:
+                    numbers.add(_number(n))
+                    n += 1
+            else:
+                numbers.add(_number(first))
+        except ValueError:
+            raise ClientError(f"wrong episode number {part!r}")
+    return sorted(numbers)
+
+
+def format_episodes(numbers):
+    """The -e string of episode numbers, "1-3,5" for [1, 2, 3, 5]"""
+    parts = []
+    for n in sorted(numbers):
+        if parts and n == parts[-1][1] + 1:
+            parts[-1][1] = n
+        else:
+            parts.append([n, n])
+    return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in parts)
+
+
+def pick_link(links, resolution=None, audio=None, log=print_warn):
+    """The kwik link get_episode_link would choose among the play page buttons.
+
+    Audio, then resolution narrow the non-AV1 buttons down, each falling
+    back with a warning when nothing matches; the last match wins.
+    """
+    links = [link for link in links if link.get("av1") == "0"]
+    chosen = []
+    if audio:
+        chosen = [link for link in links if link.get("audio") == audio]
+        if not chosen:
+            log("Selected audio language is not available, fallback to default.")
+    if resolution:
+        chosen = [link for link in chosen or links if link.get("resolution") == str(resolution)]
+        if not chosen:
+            log("Selected video resolution is not available, fallback to default")
+    chosen = chosen or [link for link in links if "kwik" in link["src"]]
+    return chosen[-1]["src"] if chosen else None
+
+
+class Client:
+    """animepahe lookups on one Session, safe to share between threads.
+
+    root is the library directory the script lives in: anime.list, the
+    anime folders and the playlist cache are read and written there.
+    """
+
+    def __init__(self, root=".", host=None, cookie=None, log=print_warn, cache_ttl=None):
+        self.root = root
+        self.host = (host or host_url()).rstrip("/")
+        self.cookie = cookie or make_cookie()
+        self.log = log
+        self.session = Session(cookie=self.cookie, referer=self.host)
+        if cache_ttl is None:
+            cache_ttl = int(os.environ.get("ANIMEPAHE_DL_CACHE_TTL", kwik.DEFAULT_TTL))
+        self.cache = kwik.PlaylistCache(os.path.join(root, kwik.CACHE_FILE), cache_ttl) if cache_ttl > 0 else None
+
+    def close(self):
+        self.session.close()
+
+    def _json(self, url):
+        resp = self.session.fetch(url)
+        try:
+            return json.loads(resp.text())
+        except ValueError:
+            raise ClientError(f"unexpected answer from {url}")
+
+    # --- Anime list and search ---
+
+    def update_anime_list(self, max_age=None, force=False):
+        """Bring anime.list up to date; returns (entries, "fresh"|"unchanged"|"updated").
+
+        A list checked less than max_age seconds ago (ANIMEPAHE_DL_LIST_TTL
+        by default) is used as it is. Otherwise the /anime page is asked for
+        with the ETag and Last-Modified of the last answer and merged into
+        the list only if it changed; force skips both.
+        """
+        path = os.path.join(self.root, ANIME_LIST_FILE)
+        url = f"{self.host}/anime"
+        meta = {} if force or not os.path.exists(path) else animelist.read_meta(self.root)
+        if max_age is None:
+            max_age = animelist.list_ttl()
+        if animelist.is_fresh(meta, url, max_age):
+            return len(animelist.read_list(path)), "fresh"
+        resp = self.session.get(url, headers=animelist.conditional_headers(meta, url))
+        if resp.status == 304:
+            entries, state = animelist.read_list(path), "unchanged"
+        elif 200 <= resp.status < 300:
+            found = _ANIME_LINK_RE.findall(resp.text())
+            if not found:
+                raise ClientError("the anime list page has no entry")
+            entries, changed = animelist.merge(path, found)
+            state = "updated" if changed else "unchanged"
+        else:
+            raise HttpError(resp.status, url)
+        animelist.write_meta(self.root, url, resp.headers)
+        return len(entries), state
+
+    def refresh_anime_list(self, max_age=0):
+        """Check anime.list against the site like download_anime_list, returns the entry count"""
+        return self.update_anime_list(max_age)[0]
+
+    def search(self, query, remember=True):
+        """[(slug, title), ...] matching query; remember merges them into anime.list"""
+        data = self._json(f"{self.host}/api?m=search&q={quote(query)}")
+        found = [(str(a["session"]), a["title"]) for a in data.get("data") or []]
+        if found and remember:
+            animelist.merge(os.path.join(self.root, ANIME_LIST_FILE), found)
+        return found
+
+    def title(self, slug):
+        """Title of slug from anime.list, refreshing the list once if it is missing"""
+        for attempt in range(2):
+            title = None
+            try:
+                with open(os.path.join(self.root, ANIME_LIST_FILE), encoding="utf-8") as f:
+                    for line in f:
+                        if line.startswith(f"[{slug}]"):
+                            title = line[len(slug) + 2:].strip()
+            except OSError:
+                pass
+            if title or attempt:
+                return title
+            self.refresh_anime_list()
+
+    # --- Release list ---
+
+    def release_page(self, slug, page=1):
+        return self._json(f"{self.host}/api?m=release&id={slug}&sort=episode_asc&page={page}")
+
+    def download_source(self, slug, folder):
+        """Fetch the release list into <folder>/.source.json like download_source.
+
+        An existing source of the same slug is reused: only the page holding
+        its last episode and later ones are fetched again, concurrently.
+        Returns the list of episode entries.
+        """
+        folder_path = os.path.join(self.root, folder)
+        os.makedirs(folder_path, exist_ok=True)
+        src = os.path.join(folder_path, SOURCE_FILE)
+        first, keep = 1, []
+        try:
+            with open(src, encoding="utf-8") as f:
+                old = json.load(f)
+            per, data = old.get("per_page") or 0, old.get("data") or []
+            if old.get("slug") == slug and per > 0 and data and not os.environ.get("ANIMEPAHE_DL_FULL_REFRESH"):
+                first = (len(data) - 1) // per + 1
+                keep = data[:(first - 1) * per]
+        except (OSError, ValueError, AttributeError):
+            pass
+
+        head = self.release_page(slug, first)
+        pages = [head]
+        last = head.get("last_page") or 1
+        if last > first:
+            with ThreadPoolExecutor(max_workers=PAGE_JOBS) as pool:
+                pages += pool.map(lambda p: self.release_page(slug, p), range(first + 1, last + 1))
+        data = keep + [e for page in pages for e in page.get("data") or []]
+        tmp = f"{src}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            # Record the slug, so the library catalog maps it to this folder
+            json.dump({"data": data, "per_page": head.get("per_page"), "slug": slug}, f)
+        os.replace(tmp, src)
+        return data
+
+    # --- Episode links ---
+
+    def episode_links(self, slug, session):
+        """Download buttons of an episode's play page, as dicts of their data-* attributes"""
+        html = self.session.fetch(f"{self.host}/play/{slug}/{session}").text()
+        return [dict(_ATTR_RE.findall(tag)) for tag in _BUTTON_RE.findall(html)]
+
+    def playlist_link(self, episode_link):
+        """m3u8 link of a kwik page"""
+        html = self.session.fetch(episode_link).text()
+        try:
+            return kwik.playlist_link(html)
+        except kwik.UnpackError as e:
+            raise ClientError(f"cannot resolve {episode_link}: {e}")
+
+    def resolve_playlist(self, slug, session, resolution=None, audio=None):
+        """m3u8 link of an episode session, through the playlist cache"""
+        key = f"{session}|{resolution or ''}|{audio or ''}"
+        link = self.cache.get(key) if self.cache else None
+        if link:
+            return link
+        episode_link = pick_link(self.episode_links(slug, session), resolution, audio, self.log)
+        if not episode_link or "/" not in episode_link:
+            raise ClientError("wrong download link or episode not found")
+        link = self.playlist_link(episode_link)
+        if self.cache:
+            self.cache.put(key, link)
+        return link
+
+
+def prefetch_ahead():
+    """ANIMEPAHE_DL_PREFETCH: episodes resolved past the current one (default 3, 0 disables)"""
+    value = os.environ.get("ANIMEPAHE_DL_PREFETCH", "")
+    return int(value) if value.isdigit() else 3
+
+
+class Prefetcher:
+    """Resolves links ahead of a known download order.
+
+    get(key) returns resolve(key) and makes sure the `ahead` keys after it
+    are being resolved in the background, `jobs` at a time, so the next
+    episode's play page and kwik lookups are done by the time it starts.
+    Errors are raised by the get() of their key.
+    """
+
+    def __init__(self, resolve, keys, ahead=None, jobs=PREFETCH_JOBS):
+        self.resolve = resolve
+        self.keys = list(keys)
+        self.ahead = prefetch_ahead() if ahead is None else ahead
+        self._index = {k: i for i, k in enumerate(self.keys)}
+        self._futures = {}
+        self._submitted = 0
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max(1, jobs))
+
+    def _fill(self, upto):
+        with self._lock:
+            while self._submitted < min(upto, len(self.keys)):
+                key = self.keys[self._submitted]
+                self._futures[key] = self._pool.submit(self.resolve, key)
+                self._submitted += 1
+
+    def start(self):
+        """Begin resolving the first keys before anyone asks for them"""
+        self._fill(self.ahead + 1)
+        return self
+
+    def get(self, key):
+        i = self._index[key]
+        self._fill(i + self.ahead + 1)
+        with self._lock:
+            future = self._futures.pop(key, None)
+        if future is None:
+            return self.resolve(key)
+        return future.result()
+
+    def close(self):
+        with self._lock:
+            for future in self._futures.values():
+                future.cancel()
+            self._futures.clear()
+        self._pool.shutdown(wait=False)
+
+
+def episode_sessions(data):
+    """{episode number: session} of .source.json entries"""
+    return {_number(e["episode"]): str(e["session"]) for e in data if "episode" in e and e.get("session")}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="pahe.client", description="Query animepahe without a browser")
+    parser.add_argument("--root", default=".", help="library directory (default: .)")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("list", help="refresh anime.list when it is stale")
+    p.add_argument("--max-age", type=int, help=f"seconds a checked list stays fresh (default: ${animelist.TTL_ENV} "
+                                               f"or {animelist.DEFAULT_TTL})")
+    p.add_argument("--force", action="store_true", help="download the page even if it did not change")
+    p = sub.add_parser("search", help="print [slug] title lines matching a name")
+    p.add_argument("query")
+    p = sub.add_parser("source", help="fetch the release list into <anime>/.source.json")
+    p.add_argument("slug")
+    p = sub.add_parser("resolve", help="print the m3u8 link of episodes")
+    p.add_argument("slug")
+    p.add_argument("episodes", help='episode numbers, e.g. "1,3,5-8" or "*"')
+    p.add_argument("-r", "--resolution")
+    p.add_argument("-o", "--audio")
+    args = parser.parse_args(argv)
+
+    client = Client(args.root)
+    try:
+        if args.cmd == "list":
+            count, state = client.update_anime_list(args.max_age, args.force)
+            print(f"{count} entries ({state})")
+            return 0
+        if args.cmd == "search":
+            for slug, title in client.search(args.query):
+                print(f"[{slug}] {title}")
+            return 0
+        title = client.title(args.slug)
+        if not title:
+            raise ClientError(f"anime {args.slug} not found")
+        data = client.download_source(args.slug, folder_name(title))
+        if args.cmd == "source":
+            print(f"{folder_name(title)}: {len(data)} episodes")
+            return 0
+        sessions = episode_sessions(data)
+        episodes = []
+        for n in parse_episodes(args.episodes, list(sessions)):
+            if n in sessions:
+                episodes.append(n)
+            else:
+                print_warn(f"Episode {n} not found!")
+        prefetch = Prefetcher(lambda n: client.resolve_playlist(args.slug, sessions[n], args.resolution, args.audio),
+                              episodes).start()
+        try:
+            for n in episodes:
+                print(f"{n}\t{prefetch.get(n)}", flush=True)
+        finally:
+            prefetch.close()
+    except Exception as e:
+        print_warn(str(e))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
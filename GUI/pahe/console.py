@@ -0,0 +1,17 @@
+import sys
+
+
+def print_info(msg):
+    """Same format as print_info in animepahe-dl.sh"""
+    print(f"\033[32m[INFO]\033[0m {msg}", file=sys.stderr, flush=True)
+
+
+def print_warn(msg):
+    """Same format as print_warn in animepahe-dl.sh"""
+    print(f"\033[33m[WARNING]\033[0m {msg}", file=sys.stderr, flush=True)
+
+
+def print_error(msg):
+    """Same format as print_error in animepahe-dl.sh, exits with status 1"""
+    print(f"\033[31m[ERROR]\033[0m {msg}", file=sys.stderr, flush=True)
+    sys.exit(1)
@@ -0,0 +1,104 @@
+"""AES-128 segment decryption, done in-process instead of one openssl per file.
+
+The cryptography package is used when installed; otherwise each segment is
+piped through the openssl binary, which still runs on the pool below so it
+overlaps with the download.
+"""
+import os
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+
+class DecryptError(Exception):
+    pass
+
+
+def _unpad(data):
+    n = data[-1] if data else 0
+    if not 1 <= n <= 16 or data[-n:] != bytes([n]) * n:
+        raise DecryptError("bad padding, wrong key or IV?")
+    return data[:-n]
+
+
+def decrypt(data, key, iv):
+    """Decrypt AES-128-CBC data with PKCS#7 padding"""
+    if Cipher is not None:
+        d = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+        return _unpad(d.update(data) + d.finalize())
+    openssl = os.environ.get("ANIMEPAHE_DL_OPENSSL") or shutil.which("openssl")
+    if not openssl:
+        raise DecryptError("install the cryptography package or openssl to decrypt segments")
+    proc = subprocess.run([openssl, "aes-128-cbc", "-d", "-K", key.hex(), "-iv", iv.hex()],
+                          input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise DecryptError(proc.stderr.decode(errors="ignore").strip() or "openssl failed")
+    return proc.stdout
+
+
+class Decryptor:
+    """Decrypts segments on a pool sized to the host's cores.
+
+    Keys are fetched once per #EXT-X-KEY URI and shared by every segment
+    that uses them.
+    """
+
+    def __init__(self, session, workers=None):
+        self.session = session
+        self.workers = workers or os.cpu_count() or 1
+        self._keys = {}
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def key_for(self, segment):
+        k = segment.key
+        if k is None:
+            return None
+        if k.method != "AES-128":
+            raise DecryptError(f"unsupported encryption method {k.method}")
+        with self._lock:
+            if k.uri not in self._keys:
+                self._keys[k.uri] = self.session.fetch(k.uri).data
+            return self._keys[k.uri]
+
+    def decrypt_segment(self, segment, data):
+        key = self.key_for(segment)
+        return data if key is None else decrypt(data, key, segment.iv)
+
+    def decrypt_file(self, segment, src, dst):
+        """Decrypt src into dst and remove src"""
+        with open(src, "rb") as f:
+            data = self.decrypt_segment(segment, f.read())
+        tmp = dst + ".part"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, dst)
+        os.remove(src)
+        return dst
+
+    def _decrypt_timed(self, segment, src, dst, on_time):
+        started = time.monotonic()
+        self.decrypt_file(segment, src, dst)
+        on_time(time.monotonic() - started)
+        return dst
+
+    def submit(self, segment, src, dst, on_time=None):
+        """Decrypt on the pool; on_time(seconds) is told how long it took"""
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=self.workers)
+        if on_time is not None:
+            return self._pool.submit(self._decrypt_timed, segment, src, dst, on_time)
+        return self._pool.submit(self.decrypt_file, segment, src, dst)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
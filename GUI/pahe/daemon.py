@@ -0,0 +1,702 @@
+"""Long-running download daemon with a local JSON API.
+
+One process owns the download engine for a library: a single Scheduler
+whose -t segment workers, kept-alive connections, adaptive concurrency
+and bandwidth share serve every job, and one pahe.client with its anime
+list, release lists and playlist cache kept warm between jobs. Episodes
+of all jobs go through the same pool, higher priority jobs first, so the
+host's concurrency holds however many jobs are submitted.
+
+The API listens on 127.0.0.1 and is found through <root>/.daemon.json,
+which holds its URL and an access token sent as X-Pahe-Token (or as
+"Authorization: Bearer <token>", for scrapers):
+
+    GET  /status                      daemon settings and job counts
+    GET  /jobs                        every job
+    POST /jobs                        {"slug", "episodes", "resolution", "audio", "priority"}
+    GET  /jobs/<id>
+    POST /jobs/<id>/pause|resume|cancel
+    GET  /jobs/<id>/events?since=N[&follow=1]
+                                      pahe.events of the job as JSON lines, from
+                                      the Nth on; follow streams until it ends
+    GET  /jobs/<id>/metrics           per-phase figures of the job (pahe.metrics)
+    GET  /metrics                     Prometheus text of every job since start
+    POST /shutdown
+
+The GUI and animepahe-dl.sh hand their downloads to a running daemon and
+only follow its events. Pausing or cancelling keeps the episodes'
+checkpoints, so a resumed or resubmitted job carries on where it stopped.
+
+    python -m pahe.daemon serve [--root .] [-t auto] [--port 0]
+    python -m pahe.daemon submit <slug> -e 1-12 -r 1080 -o jpn [--priority High] [--follow]
+    python -m pahe.daemon list | show <id> | follow <id> | pause <id> | resume <id> | cancel <id> | stop
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import secrets
+import shlex
+import signal
+import socketserver
+import sys
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from .client import Client, ClientError, Prefetcher, episode_sessions, folder_name, parse_episodes
+from .console import print_info, print_warn
+from .engine import limiter_for, thread_arg
+from .events import ProgressTracker, emit_phase, timed
+from .metrics import MetricsCollector
+from .ratelimit import Bandwidth, add_arguments as add_rate_arguments
+from .scheduler import Scheduler
+from .session import Session
+
+DAEMON_FILE = ".daemon.json"
+TOKEN_HEADER = "X-Pahe-Token"
+PRIORITIES = ("High", "Normal", "Low")
+FINAL_STATES = ("done", "failed", "cancelled")
+MAX_EVENTS = 20000
+KEEPALIVE = 15.0
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Job:
+    """One submitted download and the events of its episodes.
+
+    Events are kept in memory, the oldest dropped past MAX_EVENTS; their
+    index keeps counting, so followers resume with ?since=.
+    """
+
+    def __init__(self, id, slug, episodes, resolution=None, audio=None, priority="Normal", on_event=None):
+        self.id = id
+        self.slug = slug
+        self.spec = episodes
+        self.resolution = resolution or None
+        self.audio = audio or None
+        self.priority = priority
+        self.on_event = on_event
+        self.state = "queued"
+        self.error = None
+        self.folder = None
+        self.numbers = []
+        self.names = {}     # episode as events name it -> number
+        self.pending = deque()
+        self.inflight = {}  # episode -> scheduler Episode, None while its link is resolved
+        self.results = {}   # episode -> ok
+        self.prepared = False
+        self.prefetch = None
+        self.created = time.time()
+        self.tracker = ProgressTracker()
+        self._events = []
+        self._base = 0
+        self._cond = threading.Condition()
+
+    def emit(self, type, **fields):
+        self._record({"type": type, "t": time.time(), **fields})
+
+    def set_state(self, state, error=None):
+        """Change state and emit the "job" event that tells followers, atomically"""
+        self._record({"type": "job", "t": time.time(), "id": self.id, "state": state, "error": error}, state)
+
+    def _record(self, event, state=None):
+        with self._cond:
+            if state is not None:
+                self.state, self.error = state, event["error"]
+            self._events.append(event)
+            if len(self._events) > MAX_EVENTS:
+                drop = len(self._events) // 2
+                del self._events[:drop]
+                self._base += drop
+            self.tracker.update(event)
+            self._cond.notify_all()
+        if self.on_event:
+            self.on_event(self, event)
+
+    def read(self, since=0, timeout=None):
+        """(events from index since, next index), waiting up to timeout for new ones"""
+        with self._cond:
+            if timeout and self._base + len(self._events) <= since and self.state not in FINAL_STATES:
+                self._cond.wait(timeout)
+            start = max(since, self._base)
+            return self._events[start - self._base:], self._base + len(self._events)
+
+    def to_dict(self):
+        t = self.tracker
+        return {
+            "id": self.id, "slug": self.slug, "folder": self.folder, "episodes": self.spec,
+            "resolution": self.resolution, "audio": self.audio, "priority": self.priority,
+            "state": self.state, "error": self.error, "created": self.created,
+            "total": len(self.numbers), "completed": t.completed, "failed": t.failed,
+            "pending": len(self.pending) + len(self.inflight), "fraction": t.fraction(),
+            "speed": t.speed, "text": t.describe(),
+        }
+
+
+class Broadcast:
+    """Event sink for engine-wide events (concurrency, bandwidth): every running job gets them"""
+
+    def __init__(self, daemon):
+        self.daemon = daemon
+
+    def emit(self, type, **fields):
+        for job in self.daemon.jobs_in("running"):
+            job.emit(type, **fields)
+
+
+class Daemon:
+    """Runs jobs on one Scheduler.
+
+    The scheduler asks for an episode whenever it has room (on_ready);
+    the dispatcher thread answers with the next pending episode of the
+    highest priority running job, oldest job first, its link resolved
+    through the job's Prefetcher.
+    """
+
+    def __init__(self, root=".", threads=(2, 32, True), lookahead=2, stream=False, ffmpeg="ffmpeg",
+                 ffmpeg_args=(), rate=None, weight=1.0):
+        self.root = os.path.abspath(root)
+        self.threads = threads
+        self.jobs = {}
+        self._ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self._slots = threading.Semaphore(0)
+        self._closed = False
+        self.metrics = MetricsCollector()
+        self.client = Client(self.root, log=print_warn)
+        self.session = Session(cookie=self.client.cookie, referer=self.client.host, verify=False)
+        self.events = Broadcast(self)
+        limiter = limiter_for(threads)
+        if limiter is not None:
+            limiter.events = self.events
+        self.bandwidth = Bandwidth(rate, weight, f"daemon {self.root}", events=self.events).start()
+        self.scheduler = Scheduler(self.session, threads[1], lookahead, stream, ffmpeg, ffmpeg_args,
+                                   on_ready=self._slot_free, events=self.events, limiter=limiter,
+                                   bucket=self.bandwidth.bucket)
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+
+    def start(self):
+        self._dispatcher.start()
+        self.scheduler.start()
+        return self
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._slots.release()
+        self.scheduler.close(abort=True)
+        for job in self.jobs_in("running", "queued", "paused"):
+            if job.prefetch:
+                job.prefetch.close()
+        self.bandwidth.close()
+
+    def jobs_in(self, *states):
+        with self._cond:
+            return [job for job in self.jobs.values() if job.state in states]
+
+    def job(self, id):
+        job = self.jobs.get(str(id))
+        if job is None:
+            raise ApiError(404, f"no job {id}")
+        return job
+
+    # --- jobs ---
+
+    def submit(self, slug, episodes="*", resolution=None, audio=None, priority="Normal"):
+        if not slug:
+            raise ApiError(400, "slug is required")
+        if priority not in PRIORITIES:
+            raise ApiError(400, f"priority must be one of {', '.join(PRIORITIES)}")
+        job = Job(str(next(self._ids)), str(slug), str(episodes or "*"), resolution, audio, priority,
+                  on_event=self._job_event)
+        with self._cond:
+            self.jobs[job.id] = job
+        threading.Thread(target=self._prepare, args=(job,), daemon=True).start()
+        return job
+
+    def _prepare(self, job):
+        """Find the anime, update its release list and work out the episodes"""
+        try:
+            title = self.client.title(job.slug)
+            if not title:
+                raise ClientError(f"anime {job.slug} not found")
+            job.folder = folder_name(title)
+            started = time.monotonic()
+            sessions = episode_sessions(self.client.download_source(job.slug, job.folder))
+            emit_phase(job, "source", time.monotonic() - started, count=len(sessions))
+            numbers = parse_episodes(job.spec, list(sessions))
+            missing = [n for n in numbers if n not in sessions]
+            numbers = [n for n in numbers if n in sessions]
+            if not numbers:
+                raise ClientError("Wrong episode number!")
+        except Exception as e:
+            with self._cond:
+                # Cancelled while it was being prepared: that stays the outcome
+                if job.state != "cancelled":
+                    self._set_state(job, "failed", str(e))
+            return
+
+        def resolve(n):
+            with timed(job, "link", str(n), count=1):
+                return self.client.resolve_playlist(job.slug, sessions[n], job.resolution, job.audio)
+
+        with self._cond:
+            job.numbers = numbers
+            job.names = {str(n): n for n in numbers + missing}
+            job.pending.extend(numbers)
+            job.prefetch = Prefetcher(resolve, numbers)
+        for n in missing:
+            job.emit("episode_end", episode=str(n), ok=False, error=f"Episode {n} not found!")
+        with self._cond:
+            job.prepared = True
+            if job.state == "queued":
+                job.prefetch.start()
+                self._set_state(job, "running")
+
+    def pause(self, id):
+        job = self.job(id)
+        with self._cond:
+            if job.state not in ("queued", "running"):
+                raise ApiError(409, f"job {id} is {job.state}")
+            self._set_state(job, "paused")
+            self._take_back(job)
+
+    def resume(self, id):
+        job = self.job(id)
+        with self._cond:
+            if job.state != "paused":
+                raise ApiError(409, f"job {id} is {job.state}")
+            self._set_state(job, "running" if job.prepared else "queued")
+            self._check_done(job)
+
+    def cancel(self, id):
+        job = self.job(id)
+        with self._cond:
+            if job.state in FINAL_STATES:
+                raise ApiError(409, f"job {id} is {job.state}")
+            self._set_state(job, "cancelled")
+            self._take_back(job)
+            if job.prefetch:
+                job.prefetch.close()
+
+    def _take_back(self, job):
+        """Stop job's episodes in the scheduler and queue them again, in order"""
+        episodes = [ep for ep in job.inflight.values() if ep is not None]
+        left = set(job.pending) | set(job.inflight)
+        job.inflight.clear()
+        job.pending = deque(n for n in job.numbers if n in left)
+        for ep in episodes:
+            self.scheduler.cancel(ep)
+
+    def _set_state(self, job, state, error=None):
+        with self._cond:
+            job.set_state(state, error)
+            self._cond.notify_all()
+        print_info(f"Job {job.id} ({job.folder or job.slug}): {state}" + (f", {error}" if error else ""))
+
+    def _job_event(self, job, event):
+        self.metrics.update(dict(event, job=job.id))
+        if event["type"] != "episode_end" or event.get("cancelled"):
+            return
+        n = job.names.get(event.get("episode"))
+        with self._cond:
+            job.results[n] = bool(event.get("ok"))
+            job.inflight.pop(n, None)
+            if n in job.pending:
+                # Finished while it was being paused
+                job.pending.remove(n)
+            self._check_done(job)
+
+    def _check_done(self, job):
+        if job.state == "running" and job.prepared and not job.pending and not job.inflight:
+            failed = sorted(n for n, ok in job.results.items() if not ok)
+            if failed:
+                self._set_state(job, "failed", f"episode(s) {', '.join(map(str, failed))} failed")
+            else:
+                self._set_state(job, "done")
+
+    # --- dispatch ---
+
+    def _slot_free(self):
+        self._slots.release()
+
+    def _next_job(self):
+        running = [job for job in self.jobs.values() if job.state == "running" and job.pending]
+        if not running:
+            return None
+        return min(running, key=lambda job: (PRIORITIES.index(job.priority), int(job.id)))
+
+    def _dispatch(self):
+        while self._slots.acquire() and not self._closed:
+            while not self._closed:
+                with self._cond:
+                    while not self._closed and self._next_job() is None:
+                        self._cond.wait()
+                    if self._closed:
+                        return
+                    job = self._next_job()
+                    n = job.pending.popleft()
+                    job.inflight[n] = None
+                try:
+                    link = job.prefetch.get(n)
+                except Exception as e:
+                    print_warn(f"Episode {n}: {e}, skip downloading")
+                    job.emit("episode_end", episode=str(n), ok=False, error=str(e))
+                    continue
+                with self._cond:
+                    if job.state != "running" or n not in job.inflight:
+                        # Paused or cancelled meanwhile: the slot is still free
+                        continue
+                    path = os.path.join(self.root, job.folder)
+                    job.inflight[n] = self.scheduler.submit(str(n), link, os.path.join(path, f"{n}.mp4"),
+                                                            os.path.join(path, str(n)), events=job)
+                break
+
+    def status(self):
+        minimum, maximum, auto = self.threads
+        with self._cond:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job.state] = counts.get(job.state, 0) + 1
+        return {"root": self.root, "pid": os.getpid(), "threads": f"auto:{minimum}-{maximum}" if auto else maximum,
+                "jobs": counts}
+
+
+class _Server(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = "pahe-daemon"
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _reply(self, status, body, content_type="application/json"):
+        data = body.encode("utf-8") if isinstance(body, str) else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def _handle(self, method):
+        try:
+            token = self.headers.get(TOKEN_HEADER) or self.headers.get("Authorization", "").partition("Bearer ")[2]
+            # As bytes: compare_digest refuses str with non-ASCII characters
+            if not secrets.compare_digest(token.encode(), self.server.token.encode()):
+                raise ApiError(401, "bad token")
+            parts = urlsplit(self.path)
+            query = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                body = json.loads(self.rfile.read(length) or b"{}") if length else {}
+            except ValueError:
+                raise ApiError(400, "body is not JSON")
+            result = self._route(method, [p for p in parts.path.split("/") if p], query, body)
+            if result is not None:
+                self._reply(200, result)
+        except ApiError as e:
+            self._reply(e.status, {"error": str(e)})
+        except Exception as e:
+            print_warn(f"API error: {e}")
+            self._reply(500, {"error": str(e)})
+
+    def _route(self, method, path, query, body):
+        d = self.server.daemon
+        if method == "GET" and path == ["status"]:
+            return d.status()
+        if method == "GET" and path == ["metrics"]:
+            self._reply(200, d.metrics.prometheus(), "text/plain; version=0.0.4")
+            return None
+        if method == "POST" and path == ["shutdown"]:
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+            return {"ok": True}
+        if path[:1] != ["jobs"]:
+            raise ApiError(404, f"no route {method} {self.path}")
+        if len(path) == 1:
+            if method == "GET":
+                return [job.to_dict() for job in list(d.jobs.values())]
+            if method == "POST":
+                return d.submit(body.get("slug"), body.get("episodes"), body.get("resolution"),
+                                body.get("audio"), body.get("priority") or "Normal").to_dict()
+        elif len(path) == 2 and method == "GET":
+            return d.job(path[1]).to_dict()
+        elif len(path) == 3 and method == "POST" and path[2] in ("pause", "resume", "cancel"):
+            getattr(d, path[2])(path[1])
+            return d.job(path[1]).to_dict()
+        elif len(path) == 3 and method == "GET" and path[2] == "metrics":
+            d.job(path[1])
+            return d.metrics.summary(path[1]) or {}
+        elif len(path) == 3 and method == "GET" and path[2] == "events":
+            self._events(d.job(path[1]), int(query.get("since") or 0), query.get("follow") == "1")
+            return None
+        raise ApiError(404, f"no route {method} {self.path}")
+
+    def _events(self, job, since, follow):
+        if not follow:
+            events, _ = job.read(since)
+            self._reply(200, events)
+            return
+        # HTTP/1.0: the stream simply ends when the connection closes
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        try:
+            while True:
+                events, since = job.read(since, KEEPALIVE)
+                lines = "".join(json.dumps(e) + "\n" for e in events) or "\n"
+                self.wfile.write(lines.encode("utf-8"))
+                self.wfile.flush()
+                if job.state in FINAL_STATES and not job.read(since)[0]:
+                    return
+        except OSError:
+            pass
+
+
+def serve(daemon, port=0):
+    """Serve the API until /shutdown or SIGTERM; writes and removes <root>/.daemon.json"""
+    server = _Server(("127.0.0.1", port), _Handler)
+    server.daemon = daemon
+    server.token = secrets.token_hex(16)
+    path = os.path.join(daemon.root, DAEMON_FILE)
+    info = {"url": f"http://127.0.0.1:{server.server_address[1]}", "pid": os.getpid(), "token": server.token}
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(info, f)
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown, daemon=True).start())
+    print_info(f"Daemon for {daemon.root} listening on {info['url']}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.close()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    return 0
+
+
+class DaemonError(Exception):
+    pass
+
+
+class DaemonClient:
+    """Thin client of a running daemon"""
+
+    def __init__(self, url, token, timeout=30):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.token = token
+        self.timeout = timeout
+
+    @classmethod
+    def discover(cls, root="."):
+        """Client of the daemon serving root, None if none is running"""
+        try:
+            with open(os.path.join(root, DAEMON_FILE), encoding="utf-8") as f:
+                info = json.load(f)
+            client = cls(info["url"], info["token"], timeout=5)
+            client.status()
+        except (OSError, ValueError, KeyError, DaemonError):
+            return None
+        client.timeout = 30
+        return client
+
+    def _open(self, method, path, body=None, timeout=None):
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=timeout or self.timeout)
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        headers = {TOKEN_HEADER: self.token, "Content-Type": "application/json"}
+        try:
+            conn.request(method, path, body=data, headers=headers)
+            return conn, conn.getresponse()
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            raise DaemonError(f"daemon unreachable: {e}")
+
+    def _call(self, method, path, body=None):
+        conn, resp = self._open(method, path, body)
+        try:
+            result = json.loads(resp.read() or b"null")
+        except ValueError:
+            raise DaemonError(f"bad answer from daemon ({resp.status})")
+        finally:
+            conn.close()
+        if resp.status != 200:
+            raise DaemonError(result.get("error") if isinstance(result, dict) else f"HTTP {resp.status}")
+        return result
+
+    def status(self):
+        return self._call("GET", "/status")
+
+    def jobs(self):
+        return self._call("GET", "/jobs")
+
+    def job(self, id):
+        return self._call("GET", f"/jobs/{id}")
+
+    def submit(self, slug, episodes="*", resolution=None, audio=None, priority="Normal"):
+        return self._call("POST", "/jobs", {"slug": slug, "episodes": episodes, "resolution": resolution,
+                                            "audio": audio, "priority": priority})
+
+    def pause(self, id):
+        return self._call("POST", f"/jobs/{id}/pause")
+
+    def resume(self, id):
+        return self._call("POST", f"/jobs/{id}/resume")
+
+    def cancel(self, id):
+        return self._call("POST", f"/jobs/{id}/cancel")
+
+    def shutdown(self):
+        return self._call("POST", "/shutdown")
+
+    def events(self, id, since=0):
+        """Yield the job's events as they come, until it is done, failed or cancelled"""
+        conn, resp = self._open("GET", f"/jobs/{id}/events?since={since}&follow=1", timeout=KEEPALIVE * 4)
+        try:
+            if resp.status != 200:
+                raise DaemonError(f"HTTP {resp.status} following job {id}")
+            for line in resp:
+                if line.strip():
+                    yield json.loads(line)
+        except (OSError, http.client.HTTPException) as e:
+            raise DaemonError(f"lost the daemon: {e}")
+        finally:
+            conn.close()
+
+
+def event_line(event):
+    """(level, text) to log for an event, the script's wording; None for quiet ones"""
+    kind = event.get("type")
+    ep = event.get("episode")
+    if kind == "episode_start":
+        return "info", f"Downloading Episode {ep}..."
+    if kind == "episode_end" and not event.get("cancelled"):
+        if event.get("skipped"):
+            return "info", f"Episode {ep} is already downloaded, skip"
+        if event.get("ok"):
+            return "info", f"Episode {ep} finished: {event.get('output')}"
+        return "warn", f"Episode {ep} failed: {event.get('error')}"
+    if kind == "job":
+        text = f"Job {event.get('id')} {event.get('state')}" + (f": {event['error']}" if event.get("error") else "")
+        return ("warn" if event.get("state") in ("failed", "cancelled") else "info"), text
+    return None
+
+
+def follow(client, id):
+    """Print a job's progress until it ends; True if it finished without failures"""
+    state = None
+    for event in client.events(id):
+        line = event_line(event)
+        if line:
+            (print_info if line[0] == "info" else print_warn)(line[1])
+        if event.get("type") == "job":
+            state = event.get("state")
+    return state == "done"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="pahe.daemon", description="Download daemon and its client")
+    parser.add_argument("--root", default=".", help="library directory (default: .)")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("serve", help="run the daemon for --root")
+    p.add_argument("-t", "--threads", type=thread_arg, default=thread_arg("auto"),
+                   help="segment connections of all jobs together: a number, auto or auto:MIN-MAX")
+    p.add_argument("--lookahead", type=int, default=2, help="episodes in flight beside the current one")
+    p.add_argument("--stream", action="store_true", help="pipe segments into ffmpeg, no segment files")
+    p.add_argument("--ffmpeg", default="ffmpeg")
+    p.add_argument("--ffmpeg-args", default="-v error", help="extra ffmpeg output options")
+    p.add_argument("--port", type=int, default=0, help="API port on 127.0.0.1 (default: any free one)")
+    add_rate_arguments(p)
+    p = sub.add_parser("submit", help="queue a download")
+    p.add_argument("slug")
+    p.add_argument("-e", "--episodes", default="*", help='e.g. "1,3,5-8" (default: all)')
+    p.add_argument("-r", "--resolution")
+    p.add_argument("-o", "--audio")
+    p.add_argument("--priority", choices=PRIORITIES, default="Normal")
+    p.add_argument("--follow", action="store_true", help="show progress until the job ends, Ctrl-C cancels it")
+    for name, text in (("show", "print a job as JSON"), ("follow", "show a job's progress until it ends"),
+                       ("pause", "pause a job"), ("resume", "resume a paused job"), ("cancel", "cancel a job")):
+        sub.add_parser(name, help=text).add_argument("id")
+    p = sub.add_parser("list", help="list the jobs")
+    p.add_argument("--json", action="store_true")
+    sub.add_parser("ping", help="exit 0 if a daemon serves --root")
+    sub.add_parser("stop", help="shut the daemon down")
+    args = parser.parse_args(argv)
+
+    if args.cmd == "serve":
+        existing = DaemonClient.discover(args.root)
+        if existing is not None:
+            print_warn(f"A daemon already serves {os.path.abspath(args.root)}")
+            return 1
+        daemon = Daemon(args.root, args.threads, args.lookahead, args.stream, args.ffmpeg,
+                        shlex.split(args.ffmpeg_args), args.rate, args.weight or 1.0).start()
+        return serve(daemon, args.port)
+
+    client = DaemonClient.discover(args.root)
+    if client is None:
+        if args.cmd != "ping":
+            print_warn(f"No daemon serves {os.path.abspath(args.root)}, start one with: python -m pahe.daemon serve")
+        return 1
+    try:
+        if args.cmd == "ping":
+            return 0
+        if args.cmd == "stop":
+            client.shutdown()
+            return 0
+        if args.cmd == "list":
+            jobs = client.jobs()
+            if args.json:
+                print(json.dumps(jobs, indent=1))
+                return 0
+            for job in jobs:
+                print(f"{job['id']:>4} {job['state']:<9} [{job['priority']}] {job['folder'] or job['slug']} "
+                      f"Ep {job['episodes']}: {job['completed']}/{job['total']} {job['text']}")
+            return 0
+        if args.cmd == "submit":
+            job = client.submit(args.slug, args.episodes, args.resolution, args.audio, args.priority)
+            if not args.follow:
+                print(job["id"])
+                return 0
+            print_info(f"Job {job['id']} submitted")
+            try:
+                return 0 if follow(client, job["id"]) else 1
+            except KeyboardInterrupt:
+                client.cancel(job["id"])
+                return 130
+        if args.cmd == "follow":
+            return 0 if follow(client, args.id) else 1
+        if args.cmd == "show":
+            print(json.dumps(client.job(args.id), indent=1))
+            return 0
+        job = getattr(client, args.cmd)(args.id)
+        print_info(f"Job {job['id']}: {job['state']}")
+        return 0
+    except DaemonError as e:
+        print_warn(str(e))
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
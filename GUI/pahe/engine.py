@@ -0,0 +1,336 @@
+"""Pooled HLS segment downloader.
+
+Replaces the xargs/bash/curl fan-out of download_segments: segments are
+fetched by a fixed pool of threads, each reusing its own kept-alive
+connection, instead of one process and one TLS handshake per segment.
+With --decrypt every segment is handed to the decryption pool as soon as
+it lands, replacing decrypt_segments. With --stream nothing but the final
+video is written: segments are decrypted in memory and piped to ffmpeg in
+playlist order. Progress is reported through pahe.events when
+ANIMEPAHE_DL_EVENTS is set. -t auto lets pahe.adaptive tune the number of
+requests in flight, and --rate caps the bandwidth (pahe.ratelimit).
+
+Usage from animepahe-dl.sh:
+
+    python -m pahe.engine -t 16 --decrypt --base-url <m3u8 url> \
+        --referer <url> --cookie "__ddg2_=..." <playlist file> <output dir>
+"""
+import argparse
+import os
+import shlex
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .adaptive import AdaptiveLimiter, parse_threads
+from .checkpoint import Checkpoint
+from .console import print_info, print_warn
+from .crypto import Decryptor
+from .events import EpisodeProgress, EventWriter, timed
+from .hls import parse_playlist
+from .mux import FfmpegPipe, ReorderBuffer
+from .ratelimit import add_arguments as add_rate_arguments, bandwidth_for
+from .retry import Cancelled, DownloadFailed, Retrier
+from .session import HttpError, Session
+
+
+def thread_number(playlist, threads):
+    """Cap the number of workers by the number of segments, as get_thread_number does"""
+    return max(1, min(threads, len(playlist.segments)))
+
+
+def expected_size(resp, have=0):
+    """Final file size announced by the server, or None if unknown"""
+    if resp.headers.get("Content-Encoding"):
+        return None
+    if resp.status == 206:
+        total = (resp.headers.get("Content-Range") or "").rsplit("/", 1)[-1]
+        return int(total) if total.isdigit() else None
+    length = resp.headers.get("Content-Length")
+    return int(length) if length and length.isdigit() else None
+
+
+def thread_arg(value):
+    """argparse type for -t: a number, auto or auto:MIN-MAX"""
+    try:
+        return parse_threads(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def limiter_for(threads):
+    """AdaptiveLimiter for a parsed -t, None when it is a fixed number"""
+    minimum, maximum, auto = threads
+    return AdaptiveLimiter(minimum, maximum) if auto else None
+
+
+class SegmentDownloader:
+    """Downloads segments on `threads` workers.
+
+    With a limiter (pahe.adaptive) `threads` is only the ceiling: each
+    request waits for one of the limiter's slots. Failed requests are
+    retried per `retrier` (pahe.retry), which all workers share so that
+    one host's circuit breaker pauses all of them. With a bucket
+    (pahe.ratelimit.TokenBucket) every body is read at the bucket's pace.
+    """
+
+    def __init__(self, session, threads=1, log=print_warn, limiter=None, retrier=None, bucket=None):
+        self.session = session
+        self.threads = threads
+        self.log = log
+        self.limiter = limiter
+        self.retrier = retrier or Retrier()
+        self.retrier.breaker.log = self.retrier.breaker.log or log
+        self.bucket = bucket
+        self.stop_event = threading.Event()
+
+    def cancel(self):
+        """Stop starting new segments and abandon retries"""
+        self.stop_event.set()
+        if self.limiter is not None:
+            self.limiter.close()
+
+    def _throttle(self, nbytes):
+        self.bucket.consume(nbytes, self.stop_event)
+
+    def _get(self, segment, headers=None):
+        throttle = self._throttle if self.bucket is not None else None
+        if self.limiter is None:
+            return self.session.get(segment.uri, headers=headers, throttle=throttle)
+        if not self.limiter.acquire():
+            raise Cancelled()
+        started = time.monotonic()
+        resp = None
+        try:
+            resp = self.session.get(segment.uri, headers=headers, throttle=throttle)
+            return resp
+        finally:
+            self.limiter.release(len(resp.data) if resp else 0, time.monotonic() - started,
+                                 resp.status if resp else None)
+
+    def _check_cancelled(self):
+        if self.stop_event.is_set():
+            raise Cancelled()
+
+    def _retrying(self, segment, on_retry):
+        def report(exc, attempt, delay):
+            self.log(f"Download was aborted ({exc}). Retry {attempt}/{self.retrier.policy.attempts - 1} "
+                     f"in {delay:.1f}s...")
+            if on_retry:
+                on_retry(segment, exc)
+        return report
+
+    def download_segment(self, segment, path, on_retry=None):
+        """Download one segment to path, resuming a partial file like curl -C -
+
+        Returns the size of the complete file, checked against the size the
+        server announced. on_retry(segment, exc) is told about every failed
+        attempt; DownloadFailed is raised once the retry policy gives up.
+        """
+
+        def attempt():
+            self._check_cancelled()
+            have = os.path.getsize(path) if os.path.exists(path) else 0
+            headers = {"Range": f"bytes={have}-"} if have else None
+            resp = self._get(segment, headers)
+            if resp.status == 416 and have:
+                return have
+            if resp.status not in (200, 206):
+                raise HttpError(resp.status, segment.uri)
+            with open(path, "ab" if resp.status == 206 else "wb") as f:
+                f.write(resp.data)
+            size = os.path.getsize(path)
+            expected = expected_size(resp, have)
+            if expected is not None and size != expected:
+                if size > expected:
+                    os.remove(path)
+                raise IOError(f"got {size} of {expected} bytes")
+            return size
+
+        return self.retrier.call(attempt, segment.uri, self._retrying(segment, on_retry), self.stop_event)
+
+    def fetch_segment(self, segment, on_retry=None):
+        """Download one segment into memory"""
+
+        def attempt():
+            self._check_cancelled()
+            resp = self._get(segment)
+            if not 200 <= resp.status < 300:
+                raise HttpError(resp.status, segment.uri)
+            return resp.data
+
+        return self.retrier.call(attempt, segment.uri, self._retrying(segment, on_retry), self.stop_event)
+
+    def download(self, playlist, outdir, suffix=".encrypted", on_segment=None, checkpoint=None, progress=None):
+        """Download every segment of playlist into outdir.
+
+        on_segment(segment, path) is called from the worker thread as soon
+        as a segment is complete. With a checkpoint, segments it already
+        records are not fetched again: decrypted ones are skipped and
+        downloaded ones go straight to on_segment. progress, an
+        EpisodeProgress, counts every segment and the bytes fetched for it.
+        """
+        os.makedirs(outdir, exist_ok=True)
+
+        def work(segment):
+            if self.stop_event.is_set():
+                return None
+            path = os.path.join(outdir, segment.name + suffix)
+            on_retry = progress.retry if progress else None
+            received, seconds = 0, None
+            started = time.monotonic()
+            if checkpoint is not None:
+                if checkpoint.is_decrypted(segment.name):
+                    if progress:
+                        progress.segment_done(0)
+                    return path
+                if not checkpoint.is_downloaded(segment.name, suffix):
+                    received = self.download_segment(segment, path, on_retry)
+                    seconds = time.monotonic() - started
+                    checkpoint.mark_downloaded(segment.name, received)
+            else:
+                received = self.download_segment(segment, path, on_retry)
+                seconds = time.monotonic() - started
+            if on_segment:
+                on_segment(segment, path)
+            if progress:
+                progress.segment_done(received, seconds)
+            return path
+
+        with ThreadPoolExecutor(max_workers=thread_number(playlist, self.threads)) as pool:
+            try:
+                return list(pool.map(work, playlist.segments))
+            except BaseException:
+                self.cancel()
+                raise
+
+    def stream(self, playlist, decryptor, pipe, max_bytes, progress=None):
+        """Download, decrypt and write every segment to pipe in playlist order"""
+        buf = ReorderBuffer(pipe.write, max_bytes)
+        writer = threading.Thread(target=buf.drain, args=(len(playlist.segments),), daemon=True)
+        writer.start()
+
+        def work(segment):
+            started = time.monotonic()
+            data = self.fetch_segment(segment, progress.retry if progress else None)
+            if progress:
+                progress.segment_done(len(data), time.monotonic() - started)
+            started = time.monotonic()
+            data = decryptor.decrypt_segment(segment, data)
+            if progress:
+                progress.decrypted(time.monotonic() - started)
+            buf.put(segment.index, data)
+
+        try:
+            with ThreadPoolExecutor(max_workers=thread_number(playlist, self.threads)) as pool:
+                for _ in pool.map(work, playlist.segments):
+                    pass
+        except BaseException as e:
+            buf.fail(e)
+            raise
+        finally:
+            writer.join()
+        if buf.error is not None:
+            raise buf.error
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="pahe.engine", description=__doc__.splitlines()[0])
+    parser.add_argument("playlist", help="m3u8 playlist file")
+    parser.add_argument("outdir", help="directory for the downloaded segments")
+    parser.add_argument("-t", "--threads", type=thread_arg, default=(1, 1, False),
+                        help="connections: a number, auto or auto:MIN-MAX")
+    parser.add_argument("--base-url", help="playlist URL, to resolve relative segment URIs")
+    parser.add_argument("--referer")
+    parser.add_argument("--cookie")
+    parser.add_argument("--decrypt", action="store_true",
+                        help="decrypt segments as they complete, keeping only the clear .ts files")
+    parser.add_argument("--stream", metavar="OUTPUT",
+                        help="mux straight into OUTPUT through ffmpeg, without segment files")
+    parser.add_argument("--ffmpeg", default="ffmpeg", help="ffmpeg binary for --stream")
+    parser.add_argument("--ffmpeg-args", default="", help="extra ffmpeg output options for --stream")
+    parser.add_argument("--buffer-mb", type=int, default=64,
+                        help="memory cap of the --stream reorder buffer (default: 64)")
+    parser.add_argument("--episode", help="episode number for progress events (default: name of outdir)")
+    add_rate_arguments(parser)
+    args = parser.parse_args(argv)
+    bandwidth = bandwidth_for(args)
+    try:
+        return _download(args, bandwidth)
+    except DownloadFailed as e:
+        print_warn(f"Segment failed, giving up: {e}")
+        return 1
+    finally:
+        bandwidth.close()
+
+
+def _download(args, bandwidth):
+    with open(args.playlist, encoding="utf-8") as f:
+        playlist = parse_playlist(f.read(), args.base_url)
+    if not playlist.segments:
+        print_warn("No segment found in playlist!")
+        return 1
+
+    # Stopping from the GUI or Ctrl-C must leave a usable checkpoint behind
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(143))
+
+    session = Session(cookie=args.cookie, referer=args.referer, verify=False)
+    minimum, maximum, auto = args.threads
+    downloader = SegmentDownloader(session, maximum, limiter=limiter_for(args.threads),
+                                   bucket=bandwidth.bucket)
+    if auto:
+        print_info(f"Downloading {len(playlist.segments)} segments with {minimum}-{maximum} adaptive connections")
+    else:
+        print_info(f"Downloading {len(playlist.segments)} segments with {thread_number(playlist, maximum)} connections")
+    decryptor = Decryptor(session)
+    episode = args.episode or os.path.basename(os.path.normpath(args.outdir))
+    events = EventWriter()
+    progress = EpisodeProgress(events, episode, len(playlist.segments))
+    if args.stream:
+        pipe = FfmpegPipe(args.stream, args.ffmpeg, shlex.split(args.ffmpeg_args))
+        try:
+            downloader.stream(playlist, decryptor, pipe, args.buffer_mb * 1024 * 1024, progress)
+        except BaseException:
+            pipe.abort()
+            raise
+        progress.decrypt_finished()
+        # What ffmpeg still needs once the last segment is written
+        with timed(events, "mux", episode):
+            pipe.close()
+        return 0
+
+    checkpoint = Checkpoint(args.outdir, playlist)
+    downloaded, decrypted = checkpoint.summary()
+    if downloaded:
+        print_info(f"Resume from checkpoint: {downloaded} segments downloaded, {decrypted} decrypted")
+    if not args.decrypt:
+        try:
+            downloader.download(playlist, args.outdir, checkpoint=checkpoint, progress=progress)
+        finally:
+            checkpoint.flush()
+        return 0
+
+    pending = []
+
+    def decrypt(segment, path):
+        dst = os.path.join(args.outdir, segment.name)
+        future = decryptor.submit(segment, path, dst, progress.decrypted)
+        future.add_done_callback(
+            lambda f: f.exception() is None and checkpoint.mark_decrypted(segment.name, os.path.getsize(dst)))
+        pending.append(future)
+
+    try:
+        downloader.download(playlist, args.outdir, on_segment=decrypt, checkpoint=checkpoint, progress=progress)
+        for f in pending:
+            f.result()
+        progress.decrypt_finished()
+    finally:
+        decryptor.shutdown()
+        checkpoint.flush()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
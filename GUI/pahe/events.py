@@ -0,0 +1,341 @@
+"""Machine-readable progress events.
+
+When ANIMEPAHE_DL_EVENTS names a file, animepahe-dl.sh and the pahe
+modules append one JSON object per line to it:
+
+    {"type": "episode_start", "episode": "3", "t": 1700000000.0}
+    {"type": "segments", "episode": "3", "total": 412, "done": 0}
+    {"type": "progress", "episode": "3", "done": 57, "total": 412, "bytes": 61734912, "speed": 5242880.0}
+    {"type": "retry", "episode": "3", "segment": "seg-58.ts", "error": "..."}
+    {"type": "episode_end", "episode": "3", "ok": true}
+    {"type": "concurrency", "limit": 12, "previous": 8, "reason": "probing, 9.5 MB/s", "speed": 9961472.0}
+    {"type": "bandwidth", "cap": 4194304.0, "share": 3145728.0, "weight": 4.0}
+    {"type": "phase", "phase": "segments", "episode": "3", "seconds": 41.2, "bytes": 61734912, "count": 412,
+     "retries": 2, "latency": {"bounds": [0.05, ...], "counts": [3, ...], "sum": 35.1}}
+
+"bytes" counts what this run received and "speed" is bytes per second over
+the last few seconds. "share" is the part of the bandwidth cap this run may
+use, null when there is no cap. A "phase" event closes one stage of the
+work (PHASES) with its wall time, bytes and item count; an episode's
+"segments" phase also carries the per-segment latency histogram, and
+"decrypt" the time spent in the decryption pool. pahe.metrics folds them
+into per-episode and per-job figures. EventReader tails the file and
+ProgressTracker folds the events into overall progress, speed and ETA for
+consumers such as the GUI's DownloadWorker.
+"""
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+
+EVENTS_ENV = "ANIMEPAHE_DL_EVENTS"
+# source: release list pages, link: play page and kwik, playlist: the m3u8,
+# segments: fetching them, decrypt, mux: ffmpeg, verify: ffprobe/inventory
+PHASES = ("source", "link", "playlist", "segments", "decrypt", "mux", "verify")
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class EventWriter:
+    def __init__(self, path=None):
+        self.path = path if path is not None else os.environ.get(EVENTS_ENV)
+        self._lock = threading.Lock()
+        self._file = open(self.path, "a", encoding="utf-8") if self.path else None
+
+    def emit(self, type, **fields):
+        if self._file is None:
+            return
+        line = json.dumps({"type": type, "t": time.time(), **fields})
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class ThroughputMeter:
+    """Bytes per second over a sliding window"""
+
+    def __init__(self, window=5.0):
+        self.window = window
+        self._samples = deque()
+        self._lock = threading.Lock()
+
+    def add(self, nbytes, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._samples.append((now, nbytes))
+            while self._samples and now - self._samples[0][0] > self.window:
+                self._samples.popleft()
+
+    def rate(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            while self._samples and now - self._samples[0][0] > self.window:
+                self._samples.popleft()
+            if not self._samples:
+                return 0.0
+            span = max(now - self._samples[0][0], 1.0)
+            return sum(n for _, n in self._samples) / span
+
+
+def emit_phase(events, phase, seconds, episode=None, **fields):
+    if episode is not None:
+        fields["episode"] = str(episode)
+    events.emit("phase", phase=phase, seconds=round(seconds, 3), **fields)
+
+
+@contextmanager
+def timed(events, phase, episode=None, **fields):
+    """Time the block and emit its phase event; the block may add to the yielded fields"""
+    started = time.monotonic()
+    try:
+        yield fields
+    except BaseException:
+        fields["ok"] = False
+        raise
+    finally:
+        emit_phase(events, phase, time.monotonic() - started, episode, **fields)
+
+
+class LatencyHistogram:
+    """Counts of values per LATENCY_BUCKETS bound, the last count is above them all"""
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect_left(self.bounds, value)] += 1
+            self.sum += value
+
+    def merge(self, data):
+        """Add a to_dict() of the same bounds"""
+        if tuple(data.get("bounds") or ()) != self.bounds:
+            return
+        with self._lock:
+            for i, n in enumerate(data.get("counts") or ()):
+                self.counts[i] += n
+            self.sum += data.get("sum") or 0.0
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th value, None when empty or above the last bound"""
+        total = self.count
+        if not total:
+            return None
+        seen = 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if seen >= q * total:
+                return bound
+        return None
+
+    def to_dict(self):
+        with self._lock:
+            return {"bounds": list(self.bounds), "counts": list(self.counts), "sum": round(self.sum, 3)}
+
+
+class EpisodeProgress:
+    """Segment and byte counters of one episode, reported as events.
+
+    progress events are rate limited to `interval` seconds, except the one
+    for the last segment. The last segment also closes the "segments" phase;
+    decrypt times are added up until decrypt_finished() reports them.
+    """
+
+    def __init__(self, events, episode, total, done=0, meter=None, interval=0.25):
+        self.events = events
+        self.episode = str(episode)
+        self.total = total
+        self.done = done
+        self.bytes = 0
+        self.meter = meter or ThroughputMeter()
+        self.interval = interval
+        self.latency = LatencyHistogram()
+        self.fetched = 0
+        self.retries = 0
+        self.decrypt_seconds = 0.0
+        self.decrypt_count = 0
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._sent = 0.0
+        events.emit("segments", episode=self.episode, total=total, done=done)
+
+    def segment_done(self, nbytes, seconds=None):
+        """Count one segment; seconds is how long fetching it took, None if it was not fetched"""
+        self.meter.add(nbytes)
+        if seconds is not None:
+            self.latency.observe(seconds)
+        with self._lock:
+            self.done += 1
+            self.bytes += nbytes
+            self.fetched += seconds is not None
+            last = self.done == self.total
+            now = time.monotonic()
+            if not last and now - self._sent < self.interval:
+                return
+            self._sent = now
+            done, received = self.done, self.bytes
+        self.events.emit("progress", episode=self.episode, done=done, total=self.total,
+                         bytes=received, speed=round(self.meter.rate(), 1))
+        if last:
+            emit_phase(self.events, "segments", now - self.started, self.episode, bytes=received,
+                       count=self.fetched, retries=self.retries, latency=self.latency.to_dict())
+
+    def retry(self, segment, exc):
+        with self._lock:
+            self.retries += 1
+        self.events.emit("retry", episode=self.episode, segment=segment.name, error=str(exc))
+
+    def decrypted(self, seconds):
+        with self._lock:
+            self.decrypt_seconds += seconds
+            self.decrypt_count += 1
+
+    def decrypt_finished(self):
+        """Emit the "decrypt" phase: seconds spent decrypting, summed over the pool"""
+        with self._lock:
+            seconds, count = self.decrypt_seconds, self.decrypt_count
+        if count:
+            emit_phase(self.events, "decrypt", seconds, self.episode, count=count)
+
+
+class EventReader:
+    """Incrementally reads the events appended to a file"""
+
+    def __init__(self, path, offset=0):
+        self.path = path
+        self._pos = offset
+        self._partial = ""
+
+    def read(self):
+        """Return the events appended since the last call"""
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                f.seek(self._pos)
+                chunk = f.read()
+                self._pos = f.tell()
+        except OSError:
+            return []
+        lines = (self._partial + chunk).split("\n")
+        self._partial = lines.pop()
+        events = []
+        for line in lines:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                continue
+        return events
+
+
+class ProgressTracker:
+    """Overall progress of one run, folded from its events"""
+
+    def __init__(self, total_episodes=None):
+        self.total_episodes = total_episodes
+        self.started = time.monotonic()
+        self.active = {}    # episode -> {"done", "total", "bytes", "speed"}
+        self.finished = {}  # episode -> ok
+        self.retries = 0
+        self.concurrency = None
+        self.share = None
+        self.cap = None
+        self._bytes = 0
+
+    def update(self, event):
+        kind = event.get("type")
+        ep = event.get("episode")
+        if kind == "episode_start":
+            # An episode can start again after it was cancelled
+            self.finished.pop(ep, None)
+            self.active[ep] = {"done": 0, "total": 0, "bytes": 0, "speed": 0.0}
+        elif kind in ("segments", "progress"):
+            state = self.active.setdefault(ep, {"done": 0, "total": 0, "bytes": 0, "speed": 0.0})
+            for field in ("done", "total", "bytes", "speed"):
+                if field in event:
+                    state[field] = event[field]
+        elif kind == "retry":
+            self.retries += 1
+        elif kind == "concurrency":
+            self.concurrency = event.get("limit")
+        elif kind == "bandwidth":
+            self.share = event.get("share")
+            self.cap = event.get("cap")
+        elif kind == "episode_end":
+            state = self.active.pop(ep, None)
+            if state:
+                self._bytes += state["bytes"]
+            self.finished[ep] = bool(event.get("ok"))
+
+    @property
+    def completed(self):
+        return sum(1 for ok in self.finished.values() if ok)
+
+    @property
+    def failed(self):
+        return sum(1 for ok in self.finished.values() if not ok)
+
+    @property
+    def received(self):
+        return self._bytes + sum(s["bytes"] for s in self.active.values())
+
+    @property
+    def speed(self):
+        return sum(s["speed"] for s in self.active.values())
+
+    def fraction(self):
+        """Share of the run that is done, counting partial episodes; None if unknown"""
+        if not self.total_episodes:
+            return None
+        partial = sum(s["done"] / s["total"] for s in self.active.values() if s["total"])
+        return min(1.0, (len(self.finished) + partial) / self.total_episodes)
+
+    def eta(self):
+        """Seconds left at the pace so far, or None"""
+        f = self.fraction()
+        if not f:
+            return None
+        return (time.monotonic() - self.started) * (1 - f) / f
+
+    def describe(self):
+        """One status line such as: Episode 3: 57/412 segments | 5.0 MB/s of 6.0 MB/s | ETA 3:20"""
+        parts = [f"Episode {ep}: {s['done']}/{s['total']} segments"
+                 for ep, s in self.active.items() if s["total"]]
+        if self.speed:
+            limit = f" of {human_size(self.share)}/s" if self.share and self.active else ""
+            parts.append(f"{human_size(self.speed)}/s{limit}")
+        if self.concurrency and self.active:
+            parts.append(f"{self.concurrency} connections")
+        eta = self.eta()
+        if eta is not None and self.active:
+            parts.append(f"ETA {human_duration(eta)}")
+        if not parts and self.finished:
+            parts.append(f"{self.completed} episodes finished, {human_size(self.received)} received")
+        if self.retries:
+            parts.append(f"{self.retries} retries")
+        return " | ".join(parts)
+
+
+def human_size(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:.1f} {unit}" if unit != "B" else f"{int(n)} B"
+        n /= 1024
+
+
+def human_duration(seconds):
+    m, s = divmod(int(seconds), 60)
+    h, m = divmod(m, 60)
+    return f"{h}:{m:02d}:{s:02d}" if h else f"{m}:{s:02d}"
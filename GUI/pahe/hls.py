@@ -0,0 +1,96 @@
+import re
+from urllib.parse import urljoin
+
+_ATTR_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+def parse_attributes(text):
+    """Parse an attribute list such as METHOD=AES-128,URI="...",IV=0x..."""
+    return {k: v.strip('"') for k, v in _ATTR_RE.findall(text)}
+
+
+class Key:
+    def __init__(self, method, uri=None, iv=None):
+        self.method = method
+        self.uri = uri
+        self.iv = iv  # bytes, or None to derive from the media sequence number
+
+
+class Segment:
+    def __init__(self, index, uri, duration, sequence, key=None):
+        self.index = index
+        self.uri = uri
+        self.duration = duration
+        self.sequence = sequence
+        self.key = key
+
+    @property
+    def name(self):
+        """File name used on disk, same as ${url##*/} in animepahe-dl.sh"""
+        return self.uri.split("?", 1)[0].rstrip("/").rsplit("/", 1)[-1]
+
+    @property
+    def iv(self):
+        if self.key is None:
+            return None
+        if self.key.iv is not None:
+            return self.key.iv
+        # RFC 8216 5.2: without an IV attribute the media sequence number
+        # is used as the IV, big-endian in a 16-byte buffer.
+        return self.sequence.to_bytes(16, "big")
+
+
+class Playlist:
+    def __init__(self, segments, media_sequence=0):
+        self.segments = segments
+        self.media_sequence = media_sequence
+
+    @property
+    def duration(self):
+        return sum(s.duration for s in self.segments)
+
+    @property
+    def keys(self):
+        seen = []
+        for s in self.segments:
+            if s.key is not None and s.key not in seen:
+                seen.append(s.key)
+        return seen
+
+
+def parse_playlist(text, base_url=None):
+    """Parse an HLS media playlist into a Playlist of Segments.
+
+    Relative segment and key URIs are resolved against base_url.
+    """
+    segments = []
+    media_sequence = 0
+    key = None
+    duration = 0.0
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+            media_sequence = int(line.split(":", 1)[1])
+        elif line.startswith("#EXT-X-KEY:"):
+            attrs = parse_attributes(line.split(":", 1)[1])
+            method = attrs.get("METHOD", "NONE")
+            if method == "NONE":
+                key = None
+            else:
+                iv = attrs.get("IV")
+                if iv:
+                    iv = bytes.fromhex(iv[2:] if iv.lower().startswith("0x") else iv).rjust(16, b"\0")
+                uri = attrs.get("URI")
+                if uri and base_url:
+                    uri = urljoin(base_url, uri)
+                key = Key(method, uri, iv or None)
+        elif line.startswith("#EXTINF:"):
+            duration = float(line.split(":", 1)[1].split(",", 1)[0] or 0)
+        elif not line.startswith("#"):
+            uri = urljoin(base_url, line) if base_url else line
+            index = len(segments)
+            segments.append(Segment(index, uri, duration, media_sequence + index, key))
+            duration = 0.0
+    return Playlist(segments, media_sequence)
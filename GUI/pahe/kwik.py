@@ -0,0 +1,168 @@
+"""Kwik playlist resolution without node.
+
+Kwik pages hide the m3u8 link in a Dean Edwards style packed script,
+`eval(function(p,a,c,k,e,d){...}('payload',62,123,'w|o|r|d|s'.split('|'),0,{}))`.
+unpack() decodes it in-process; get_playlist_link in animepahe-dl.sh only
+falls back to node when this fails.
+
+PlaylistCache remembers resolved links per (episode session, resolution,
+audio) for a configurable TTL, so re-listing or retrying a batch skips the
+play page and kwik entirely.
+
+    python -m pahe.kwik unpack < kwik.html
+    python -m pahe.kwik cache-get <key>
+    python -m pahe.kwik cache-put <key> <link>
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: no lock between processes
+    fcntl = None
+
+_PACKED_RE = re.compile(
+    r"}\s*\(\s*'((?:[^'\\]|\\.)*)'\s*,\s*(\d+)\s*,\s*(\d+)\s*,\s*'((?:[^'\\]|\\.)*)'\.split\('\|'\)", re.S)
+_SOURCE_RE = re.compile(r"source\s*=\s*['\"]([^'\"]+?\.m3u8)")
+_ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+CACHE_FILE = ".playlist.cache"
+DEFAULT_TTL = 3600
+
+
+class UnpackError(Exception):
+    pass
+
+
+def _unbase(word, radix):
+    if radix <= 36:
+        return int(word, radix)
+    n = 0
+    for ch in word:
+        n = n * radix + _ALPHABET.index(ch)
+    return n
+
+
+def _unescape(s):
+    return s.replace("\\'", "'").replace("\\\\", "\\")
+
+
+def unpack(html):
+    """Return the source of the packed script in html"""
+    m = _PACKED_RE.search(html)
+    if not m:
+        raise UnpackError("no packed script found")
+    payload, radix, count, symtab = _unescape(m.group(1)), int(m.group(2)), int(m.group(3)), m.group(4).split("|")
+    if radix > len(_ALPHABET):
+        raise UnpackError(f"unsupported radix {radix}")
+    if len(symtab) != count:
+        raise UnpackError("symbol table does not match its count")
+
+    def lookup(w):
+        word = w.group(0)
+        try:
+            i = _unbase(word, radix)
+        except ValueError:
+            return word
+        return symtab[i] if i < len(symtab) and symtab[i] else word
+
+    return re.sub(r"\b\w+\b", lookup, payload)
+
+
+def playlist_link(html):
+    """The m3u8 link of a kwik page"""
+    m = _SOURCE_RE.search(unpack(html))
+    if not m:
+        raise UnpackError("no source in unpacked script")
+    return m.group(1)
+
+
+# Threads of one process (pahe.client) share a cache file too
+_put_lock = threading.Lock()
+
+
+@contextmanager
+def _file_lock(path):
+    if fcntl is None:
+        yield
+        return
+    with open(path, "a") as f:
+        # lockf: POSIX locks are the kind NFS passes on to the server
+        fcntl.lockf(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(f, fcntl.LOCK_UN)
+
+
+class PlaylistCache:
+    def __init__(self, path, ttl=DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, key):
+        entry = self._load().get(key)
+        if entry and entry[1] > time.time():
+            return entry[0]
+        return None
+
+    def put(self, key, link):
+        # Read, add and write back under a lock: prefetch jobs put at the same time
+        with _put_lock, _file_lock(self.path + ".lock"):
+            now = time.time()
+            data = {k: v for k, v in self._load().items() if v[1] > now}
+            data[key] = [link, now + self.ttl]
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="pahe.kwik", description="Resolve kwik playlist links")
+    parser.add_argument("--cache", default=CACHE_FILE, help=f"cache file (default: ./{CACHE_FILE})")
+    parser.add_argument("--ttl", type=int, default=int(os.environ.get("ANIMEPAHE_DL_CACHE_TTL", DEFAULT_TTL)),
+                        help="seconds a cached link stays valid, ANIMEPAHE_DL_CACHE_TTL (default: 3600)")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("unpack", help="print the m3u8 link of the kwik page read from stdin")
+    p = sub.add_parser("cache-get")
+    p.add_argument("key")
+    p = sub.add_parser("cache-put")
+    p.add_argument("key")
+    p.add_argument("link")
+    args = parser.parse_args(argv)
+
+    if args.cmd == "unpack":
+        try:
+            print(playlist_link(sys.stdin.read()))
+        except UnpackError as e:
+            print(f"kwik: {e}", file=sys.stderr)
+            return 1
+        return 0
+    cache = PlaylistCache(args.cache, args.ttl)
+    if args.cmd == "cache-put":
+        if args.ttl > 0:
+            cache.put(args.key, args.link)
+        return 0
+    link = cache.get(args.key) if args.ttl > 0 else None
+    if link is None:
+        return 1
+    print(link)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
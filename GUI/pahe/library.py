@@ -0,0 +1,268 @@
+"""Library inventory: which episodes are on disk, and whether they are whole.
+
+Every finished episode is recorded in its anime folder's .inventory.json
+with its size, mtime, the duration ffprobe reads, the playlist's total
+#EXTINF duration and a fast checksum (BLAKE2b over the size and three
+1 MiB samples). A video is complete when ffprobe reads a duration within
+max(2s, 1%) of the playlist's.
+
+Before an episode is downloaded, is_complete() decides whether the
+existing video can be kept. A recorded video whose size and mtime did not
+change passes without running ffprobe, so re-running a whole season only
+fetches the missing or truncated episodes. `verify` re-checks every video
+of the library, one ffprobe per core, for scheduled integrity checks.
+Updates hold a lock on .inventory.json.lock, so processes on several
+hosts sharing the library (pahe.workqueue) do not lose each other's.
+
+    python -m pahe.library check --playlist <m3u8 url or file> <anime>/<n>.mp4
+    python -m pahe.library record --playlist <m3u8 url or file> <anime>/<n>.mp4
+    python -m pahe.library verify [--root .] [-j N] [--json]
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .console import print_info, print_warn
+from .hls import parse_playlist
+from .kwik import _file_lock
+from .session import Session
+
+INVENTORY_FILE = ".inventory.json"
+SAMPLE_BYTES = 1024 * 1024
+TOLERANCE = 2.0
+BAD_STATUS = ("truncated", "unreadable", "changed", "missing")
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+def find_ffprobe(ffmpeg=None):
+    """ffprobe next to ffmpeg, else from PATH; None if there is none"""
+    if ffmpeg and os.path.dirname(ffmpeg):
+        for name in ("ffprobe", "ffprobe.exe"):
+            candidate = os.path.join(os.path.dirname(ffmpeg), name)
+            if os.path.isfile(candidate):
+                return candidate
+    return shutil.which("ffprobe")
+
+
+def probe_duration(path, ffprobe):
+    """Container duration in seconds, None if ffprobe cannot read the file"""
+    cmd = [ffprobe, "-v", "error", "-show_entries", "format=duration",
+           "-of", "default=noprint_wrappers=1:nokey=1", path]
+    try:
+        proc = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              universal_newlines=True, timeout=300)
+        return float(proc.stdout.strip()) if proc.returncode == 0 else None
+    except (OSError, ValueError, subprocess.TimeoutExpired):
+        return None
+
+
+def quick_checksum(path, size=None):
+    """BLAKE2b of the size and the first, middle and last MiB"""
+    size = os.path.getsize(path) if size is None else size
+    h = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(path, "rb") as f:
+        for offset in sorted({0, max(0, size // 2 - SAMPLE_BYTES // 2), max(0, size - SAMPLE_BYTES)}):
+            f.seek(offset)
+            h.update(f.read(SAMPLE_BYTES))
+    return h.hexdigest()
+
+
+def duration_status(duration, expected):
+    if duration is None:
+        return "unreadable"
+    if not expected:
+        return "unverified"
+    return "ok" if duration >= expected - max(TOLERANCE, expected * 0.01) else "truncated"
+
+
+def playlist_duration(source, referer=None, cookie=None):
+    """Total #EXTINF of a playlist file or URL"""
+    if os.path.isfile(source):
+        with open(source, encoding="utf-8") as f:
+            text = f.read()
+    else:
+        text = Session(cookie=cookie, referer=referer, verify=False).fetch(source).text()
+    return parse_playlist(text).duration
+
+
+class Inventory:
+    """The .inventory.json of one anime folder, keyed by video file name.
+
+    ffprobe None looks it up, False does without.
+    """
+
+    def __init__(self, folder, ffprobe=None):
+        self.folder = folder
+        self.path = os.path.join(folder, INVENTORY_FILE)
+        self.ffprobe = find_ffprobe() if ffprobe is None else ffprobe
+        with _locks_guard:
+            self._lock = _locks.setdefault(os.path.abspath(self.path), threading.Lock())
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def entry(self, name):
+        return self.load().get(name)
+
+    def _save(self, name, entry):
+        with self._lock, _file_lock(self.path + ".lock"):
+            # Re-read: another process may have recorded other episodes
+            data = self.load()
+            data[name] = entry
+            tmp = f"{self.path}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+
+    def inspect(self, video, expected=None):
+        """Entry for video as it is on disk now: stat, ffprobe and checksum"""
+        st = os.stat(video)
+        duration = probe_duration(video, self.ffprobe) if self.ffprobe else None
+        status = duration_status(duration, expected) if self.ffprobe else "unverified"
+        return {"size": st.st_size, "mtime": st.st_mtime, "duration": duration, "expected": expected,
+                "checksum": quick_checksum(video, st.st_size), "status": status, "verified": time.time()}
+
+    def record(self, video, expected=None, name=None):
+        """Inspect video and store the result under name (default: its own); returns the entry"""
+        name = name or os.path.basename(video)
+        if expected is None:
+            expected = (self.entry(name) or {}).get("expected")
+        entry = self.inspect(video, expected)
+        self._save(name, entry)
+        return entry
+
+    def is_complete(self, video, expected=None):
+        """True if video exists and is whole, against the playlist duration `expected`.
+
+        An unchanged video recorded as ok is trusted as is; anything else
+        is probed again and recorded. A video recorded as unverified, i.e.
+        never probed, passes only while ffprobe is still unavailable and
+        the file has the size and checksum it was recorded with; once
+        ffprobe is there it is probed like any other.
+        """
+        try:
+            st = os.stat(video)
+        except OSError:
+            return False
+        known = self.entry(os.path.basename(video))
+        unchanged = known and known["size"] == st.st_size and known["mtime"] == st.st_mtime
+        if unchanged and known["status"] == "ok" and (
+                not expected or not known.get("expected") or abs(known["expected"] - expected) <= TOLERANCE):
+            return True
+        if not self.ffprobe:
+            if unchanged and known["status"] in ("ok", "unverified") and (
+                    not known.get("checksum") or known["checksum"] == quick_checksum(video, st.st_size)):
+                return True
+            print_warn(f"Cannot verify {video} without ffprobe, downloading it again")
+            return False
+        expected = expected or (known or {}).get("expected")
+        if not expected:
+            print_warn(f"Cannot verify {video} without the playlist duration, downloading it again")
+            return False
+        return self.record(video, expected)["status"] == "ok"
+
+
+def library_videos(root):
+    """(folder, video name) of every episode video and inventory entry under root"""
+    for d in sorted(os.listdir(root)):
+        folder = os.path.join(root, d)
+        if not os.path.isdir(folder):
+            continue
+        # Hidden ones are videos still being muxed, see pahe.mux.partial_path
+        names = {n for n in os.listdir(folder) if n.endswith(".mp4") and not n.startswith(".")}
+        names.update(Inventory(folder, ffprobe=False).load())
+        for name in sorted(names):
+            yield folder, name
+
+
+def verify_video(folder, name, ffprobe):
+    """Re-check one video against its record; returns (path, entry)"""
+    inventory = Inventory(folder, ffprobe)
+    video = os.path.join(folder, name)
+    known = inventory.entry(name) or {}
+    if not os.path.exists(video):
+        return video, dict(known, status="missing")
+    entry = inventory.inspect(video, known.get("expected"))
+    if (entry["status"] in ("ok", "unverified") and known.get("checksum") and known["size"] == entry["size"]
+            and known["mtime"] == entry["mtime"] and known["checksum"] != entry["checksum"]):
+        # Same size and mtime but other bytes: the file rotted or was tampered with
+        entry["status"] = "changed"
+    inventory._save(name, entry)
+    return video, entry
+
+
+def verify(root=".", jobs=None, ffprobe=None):
+    """Verify every video of the library in parallel; returns [(path, entry), ...]"""
+    ffprobe = ffprobe or find_ffprobe() or False
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as pool:
+        futures = [pool.submit(verify_video, folder, name, ffprobe) for folder, name in library_videos(root)]
+        return [f.result() for f in futures]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="pahe.library", description="Record and verify downloaded episodes")
+    parser.add_argument("--ffprobe", help="ffprobe binary (default: next to --ffmpeg or from PATH)")
+    parser.add_argument("--ffmpeg")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    for name, text in (("check", "exit 0 if the video is complete, 1 otherwise"),
+                       ("record", "record a finished video, exit 1 if it is truncated")):
+        p = sub.add_parser(name, help=text)
+        p.add_argument("--playlist", help="m3u8 URL or file the video was downloaded from")
+        p.add_argument("--referer")
+        p.add_argument("--cookie")
+        p.add_argument("video")
+    p = sub.add_parser("verify", help="re-check every video of the library")
+    p.add_argument("--root", default=".", help="library directory (default: .)")
+    p.add_argument("-j", "--jobs", type=int, help="parallel checks (default: CPU count)")
+    p.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args(argv)
+    ffprobe = args.ffprobe or find_ffprobe(args.ffmpeg) or False
+
+    if args.cmd == "verify":
+        if not ffprobe:
+            print_warn("ffprobe not found, only checksums are compared")
+        results = verify(args.root, args.jobs, ffprobe)
+        bad = [(path, e) for path, e in results if e["status"] in BAD_STATUS]
+        if args.json:
+            print(json.dumps({"checked": len(results), "bad": len(bad),
+                              "videos": [dict(e, path=path) for path, e in results]}, indent=1))
+        else:
+            for path, e in results:
+                duration = "" if e.get("duration") is None else f" {e['duration']:.1f}s"
+                expected = f" of {e['expected']:.1f}s" if e.get("expected") else ""
+                print(f"{e['status']:<10} {path}{duration}{expected}")
+            print_info(f"{len(results)} videos checked, {len(bad)} bad")
+        return 1 if bad else 0
+
+    expected = None
+    if args.playlist:
+        try:
+            expected = playlist_duration(args.playlist, args.referer, args.cookie)
+        except Exception as e:
+            print_warn(f"Cannot read playlist: {e}")
+    inventory = Inventory(os.path.dirname(os.path.abspath(args.video)), ffprobe)
+    if args.cmd == "check":
+        return 0 if inventory.is_complete(args.video, expected) else 1
+    entry = inventory.record(args.video, expected)
+    if entry["status"] in BAD_STATUS:
+        print_warn(f"{args.video} is {entry['status']}: {entry['duration'] or 0:.1f}s of {expected or 0:.1f}s")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
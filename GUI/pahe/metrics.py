@@ -0,0 +1,263 @@
+"""Per-phase timing figures and their export.
+
+The script, the engine, the scheduler and the client report every stage
+of the work as a "phase" event (pahe.events): wall time, bytes and item
+count per episode, plus the segment latency histogram and retry count of
+the "segments" phase. MetricsCollector folds them, with episode outcomes,
+into per-episode, per-job and overall figures, which are exported as
+
+- a JSON summary of the run, `summary()`;
+- Prometheus text, `prometheus()`, served by pahe.daemon on GET /metrics
+  and written to <dir>/animepahe_dl.prom for node_exporter's textfile
+  collector when ANIMEPAHE_DL_METRICS names a directory; the JSON summary
+  goes next to it as run-<time>-<pid>.json.
+
+    python -m pahe.metrics summary <events file> [--json]
+    python -m pahe.metrics prom <events file>
+    python -m pahe.metrics write <events file> <dir> [--offset N]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from .events import LATENCY_BUCKETS, PHASES, EventReader, LatencyHistogram, human_duration, human_size
+
+METRICS_ENV = "ANIMEPAHE_DL_METRICS"
+PROM_FILE = "animepahe_dl.prom"
+RESULTS = ("ok", "skipped", "failed", "cancelled")
+# The only events a collector needs, for consumers that forward a subset
+METRIC_EVENTS = ("phase", "retry", "episode_start", "episode_end")
+
+
+def _result(event):
+    if event.get("cancelled"):
+        return "cancelled"
+    if event.get("skipped"):
+        return "skipped"
+    return "ok" if event.get("ok") else "failed"
+
+
+class _Figures:
+    """Phase totals, latency and retries of an episode, a job or the whole run"""
+
+    def __init__(self):
+        self.phases = {}
+        self.latency = LatencyHistogram()
+        self.retries = 0
+
+    def add_phase(self, event):
+        p = self.phases.setdefault(event.get("phase"), {"seconds": 0.0, "bytes": 0, "count": 0, "runs": 0})
+        p["seconds"] += event.get("seconds") or 0.0
+        p["bytes"] += event.get("bytes") or 0
+        p["count"] += event.get("count") or 0
+        p["runs"] += 1
+        if event.get("latency"):
+            self.latency.merge(event["latency"])
+
+    def to_dict(self):
+        order = {name: i for i, name in enumerate(PHASES)}
+        phases = {name: dict(p, seconds=round(p["seconds"], 3))
+                  for name, p in sorted(self.phases.items(), key=lambda kv: order.get(kv[0], len(order)))}
+        latency = self.latency.to_dict()
+        latency.update(count=self.latency.count, p50=self.latency.quantile(0.5),
+                       p90=self.latency.quantile(0.9), p99=self.latency.quantile(0.99))
+        return {"phases": phases, "latency": latency, "retries": self.retries}
+
+
+class MetricsCollector:
+    """Folds events into figures; jobs are told apart by the events' "job" field"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.updated = None
+        self.total = _Figures()
+        self.results = dict.fromkeys(RESULTS, 0)
+        self.jobs = {}
+        self._lock = threading.Lock()
+
+    def _job(self, name):
+        job = self.jobs.get(name)
+        if job is None:
+            job = self.jobs[name] = {"figures": _Figures(), "episodes": {}}
+        return job
+
+    def _episode(self, job, ep):
+        state = job["episodes"].get(ep)
+        if state is None:
+            state = job["episodes"][ep] = {"figures": _Figures(), "result": None, "started": None, "ended": None}
+        return state
+
+    def update(self, event):
+        kind = event.get("type")
+        if kind not in METRIC_EVENTS:
+            return
+        name = str(event.get("job") or "")
+        ep = event.get("episode")
+        with self._lock:
+            self.updated = event.get("t") or time.time()
+            # Folded from a file, the run started with its first event
+            self.started = min(self.started, self.updated)
+            job = self._job(name)
+            state = self._episode(job, str(ep)) if ep is not None else None
+            if kind == "phase":
+                for figures in (self.total, job["figures"]) + ((state["figures"],) if state else ()):
+                    figures.add_phase(event)
+            elif kind == "retry":
+                for figures in (self.total, job["figures"]) + ((state["figures"],) if state else ()):
+                    figures.retries += 1
+            elif kind == "episode_start" and state:
+                state["started"] = event.get("t")
+                state["result"] = None
+            elif kind == "episode_end" and state:
+                state["ended"] = event.get("t")
+                state["result"] = _result(event)
+                self.results[state["result"]] += 1
+
+    def summary(self, job=None):
+        """JSON-ready figures of the run, or of one job"""
+        with self._lock:
+            jobs = {}
+            for name, j in self.jobs.items():
+                if job is not None and name != str(job):
+                    continue
+                episodes = {}
+                for ep, state in j["episodes"].items():
+                    wall = state["ended"] - state["started"] if state["started"] and state["ended"] else None
+                    episodes[ep] = dict(state["figures"].to_dict(), result=state["result"],
+                                        seconds=round(wall, 3) if wall is not None else None)
+                jobs[name] = dict(j["figures"].to_dict(), episodes=episodes)
+            if job is not None:
+                return jobs.get(str(job))
+            return dict(self.total.to_dict(), started=self.started, updated=self.updated,
+                        episodes=dict(self.results), jobs=jobs)
+
+    def prometheus(self, prefix="animepahe_dl"):
+        """Prometheus text exposition of the overall figures"""
+        with self._lock:
+            total = self.total.to_dict()
+            hist = self.total.latency.to_dict()
+            results = dict(self.results)
+            updated = self.updated
+        lines = []
+
+        def family(name, kind, help, samples):
+            lines.append(f"# HELP {prefix}_{name} {help}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for labels, value in samples:
+                label = "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+                lines.append(f"{prefix}_{name}{label} {value}")
+
+        phases = total["phases"]
+        family("phase_seconds_total", "counter", "Wall time spent per phase",
+               [((("phase", p),), v["seconds"]) for p, v in phases.items()])
+        family("phase_bytes_total", "counter", "Bytes received per phase",
+               [((("phase", p),), v["bytes"]) for p, v in phases.items()])
+        family("phase_items_total", "counter", "Items handled per phase (episodes listed, links, playlists, segments)",
+               [((("phase", p),), v["count"]) for p, v in phases.items()])
+        family("phase_runs_total", "counter", "Times each phase ran",
+               [((("phase", p),), v["runs"]) for p, v in phases.items()])
+        family("retries_total", "counter", "Failed segment requests that were retried", [((), total["retries"])])
+        family("episodes_total", "counter", "Episodes by outcome",
+               [((("result", r),), n) for r, n in results.items()])
+        name = f"{prefix}_segment_latency_seconds"
+        lines.append(f"# HELP {name} Time to fetch one segment, retries included")
+        lines.append(f"# TYPE {name} histogram")
+        seen = 0
+        for bound, n in zip(hist["bounds"], hist["counts"]):
+            seen += n
+            lines.append(f'{name}_bucket{{le="{bound}"}} {seen}')
+        count = sum(hist["counts"])
+        lines.append(f'{name}_bucket{{le="+Inf"}} {count}')
+        lines.append(f"{name}_sum {hist['sum']}")
+        lines.append(f"{name}_count {count}")
+        if updated:
+            family("last_event_timestamp_seconds", "gauge", "Time of the last event folded in", [((), updated)])
+        return "\n".join(lines) + "\n"
+
+    def describe(self):
+        """A few lines for people: time, bytes and items per phase, latency and retries"""
+        total = self.summary()
+        lines = []
+        for name, p in total["phases"].items():
+            line = f"{name:<9} {human_duration(p['seconds']):>8}"
+            if p["bytes"]:
+                line += f"  {human_size(p['bytes'])}"
+            if p["count"]:
+                line += f"  {p['count']} items"
+            lines.append(line)
+        lat = total["latency"]
+        if lat["count"]:
+            def bound(v):
+                if v is None:
+                    return f">{LATENCY_BUCKETS[-1]:g}s"
+                return f"<{v * 1000:.0f}ms" if v < 1 else f"<{v:g}s"
+            lines.append(f"segment latency  p50 {bound(lat['p50'])}  p90 {bound(lat['p90'])}  "
+                         f"p99 {bound(lat['p99'])}  mean {lat['sum'] / lat['count'] * 1000:.0f}ms")
+        counts = ", ".join(f"{n} {r}" for r, n in total["episodes"].items() if n)
+        if counts or total["retries"]:
+            lines.append(f"episodes: {counts or 'none'}, {total['retries']} retries")
+        return "\n".join(lines)
+
+
+def _write_atomic(path, text):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".metrics.")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def write_run(collector, directory=None):
+    """Write the run's JSON summary and refresh the .prom file; returns the summary path or None"""
+    directory = directory or os.environ.get(METRICS_ENV)
+    if not directory:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    summary = collector.summary()
+    stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(collector.started))
+    path = os.path.join(directory, f"run-{stamp}-{os.getpid()}.json")
+    _write_atomic(path, json.dumps(summary, indent=1) + "\n")
+    _write_atomic(os.path.join(directory, PROM_FILE), collector.prometheus())
+    return path
+
+
+def collect(path, offset=0):
+    """MetricsCollector over an events file, from byte offset on"""
+    collector = MetricsCollector()
+    reader = EventReader(path, offset)
+    for event in reader.read():
+        collector.update(event)
+    return collector
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="pahe.metrics", description="Per-phase figures from an events file")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    for name, help in (("summary", "print the figures"), ("prom", "print Prometheus text"),
+                       ("write", "write the JSON summary and animepahe_dl.prom to a directory")):
+        p = sub.add_parser(name, help=help)
+        p.add_argument("events", help="file ANIMEPAHE_DL_EVENTS pointed at")
+        if name == "write":
+            p.add_argument("directory")
+        p.add_argument("--offset", type=int, default=0, help="skip this many bytes of older events")
+        if name == "summary":
+            p.add_argument("--json", action="store_true")
+    args = parser.parse_args(argv)
+
+    collector = collect(args.events, args.offset)
+    if args.cmd == "prom":
+        sys.stdout.write(collector.prometheus())
+    elif args.cmd == "write":
+        print(write_run(collector, args.directory))
+    elif args.json:
+        print(json.dumps(collector.summary(), indent=1))
+    else:
+        print(collector.describe())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
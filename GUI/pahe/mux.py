@@ -0,0 +1,118 @@
+"""Muxing segments into the final video.
+
+Streaming mux: decrypted segments go straight into ffmpeg's stdin.
+Segments complete out of order on the download pool; ReorderBuffer holds
+early arrivals, within a memory cap, until the next segment in playlist
+order is available. concat_segments is the file based path, the same as
+generate_filelist plus `ffmpeg -f concat` in animepahe-dl.sh.
+"""
+import os
+import socket
+import subprocess
+import threading
+
+
+class MuxError(Exception):
+    pass
+
+
+def partial_path(output):
+    """Hidden name beside output for ffmpeg to write, renamed over output once whole.
+
+    Host and pid keep processes that share the library apart.
+    """
+    folder, name = os.path.split(output)
+    stem, ext = os.path.splitext(name)
+    return os.path.join(folder, f".{stem}.{socket.gethostname()}-{os.getpid()}.part{ext}")
+
+
+class ReorderBuffer:
+    def __init__(self, sink, max_bytes=64 * 1024 * 1024):
+        self.sink = sink
+        self.max_bytes = max_bytes
+        self.error = None
+        self._pending = {}
+        self._size = 0
+        self._next = 0
+        self._cond = threading.Condition()
+
+    def put(self, index, data):
+        """Queue segment data, blocking while the buffer is over its cap.
+
+        The segment the writer is waiting for is always accepted, so the
+        buffer cannot deadlock however small the cap is.
+        """
+        with self._cond:
+            while (self.error is None and index != self._next and self._pending
+                   and self._size + len(data) > self.max_bytes):
+                self._cond.wait()
+            if self.error is not None:
+                raise self.error
+            self._pending[index] = data
+            self._size += len(data)
+            self._cond.notify_all()
+
+    def fail(self, exc):
+        """Abort both sides of the buffer with exc"""
+        with self._cond:
+            if self.error is None:
+                self.error = exc
+            self._cond.notify_all()
+
+    def drain(self, count):
+        """Hand segments 0..count-1 to the sink in order; run in its own thread"""
+        while self._next < count:
+            with self._cond:
+                while self.error is None and self._next not in self._pending:
+                    self._cond.wait()
+                if self.error is not None:
+                    return
+                data = self._pending.pop(self._next)
+            try:
+                self.sink(data)
+            except Exception as e:
+                self.fail(e)
+                return
+            with self._cond:
+                self._size -= len(data)
+                self._next += 1
+                self._cond.notify_all()
+
+
+class FfmpegPipe:
+    """A single `ffmpeg -f mpegts -i pipe:` process writing output"""
+
+    def __init__(self, output, ffmpeg="ffmpeg", extra_args=()):
+        cmd = [ffmpeg, "-f", "mpegts", "-i", "pipe:", "-c", "copy", *extra_args, "-y", output]
+        # stdout may be a protocol pipe (see pahe.scheduler), keep ffmpeg off it
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+
+    def write(self, data):
+        try:
+            self.proc.stdin.write(data)
+        except BrokenPipeError:
+            raise MuxError(f"ffmpeg exited early with status {self.proc.wait()}")
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        if self.proc.wait() != 0:
+            raise MuxError(f"ffmpeg failed with status {self.proc.returncode}")
+
+    def abort(self):
+        self.proc.kill()
+        self.proc.wait()
+
+
+def concat_segments(workdir, names, output, ffmpeg="ffmpeg", extra_args=(), list_name="file.list"):
+    """Join the decrypted segment files in workdir into output"""
+    with open(os.path.join(workdir, list_name), "w", encoding="utf-8") as f:
+        for name in names:
+            f.write(f"file '{name}'\n")
+    cmd = [ffmpeg, "-f", "concat", "-safe", "0", "-i", list_name, "-c", "copy", *extra_args, "-y", output]
+    # stdin may carry jobs for pahe.scheduler; ffmpeg would read it as key presses
+    rc = subprocess.run(cmd, cwd=workdir, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL).returncode
+    if rc != 0:
+        raise MuxError(f"ffmpeg failed with status {rc}")
@@ -0,0 +1,231 @@
+"""Durable store for the GUI's download queue.
+
+The queue used to live in memory only: closing the window, a crash or
+"Stop" lost every entry and the record of what was finished. Each entry
+and each of its episodes now has a row in <root>/.queue.db, a SQLite file
+written in one transaction per change, with its state (pending, running,
+done, failed; entries also stopped and invalid), attempt count and last
+error.
+
+When the GUI starts, entries and episodes left running are put back to
+pending and the queue is shown as it was. If it was downloading when the
+GUI went away, it starts again. An entry starts again from its first
+episode that is not done, and done episodes are never downloaded again.
+
+    python -m pahe.queuestore show [--json]
+    python -m pahe.queuestore forget-done    drop finished entries
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+STORE_FILE = ".queue.db"
+ITEM_FIELDS = ("slug", "title", "label", "episodes", "audio", "resolution", "folder", "auto",
+               "min_ep", "max_ep", "priority", "state", "attempts", "error")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    position INTEGER NOT NULL,
+    slug TEXT NOT NULL,
+    title TEXT,
+    label TEXT,
+    episodes TEXT NOT NULL,
+    audio TEXT,
+    resolution TEXT,
+    folder TEXT,
+    auto INTEGER NOT NULL DEFAULT 0,
+    min_ep REAL,
+    max_ep REAL,
+    priority TEXT NOT NULL DEFAULT 'Normal',
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS episodes (
+    item INTEGER NOT NULL,
+    episode TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    output TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (item, episode)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class QueueStore:
+    def __init__(self, root=".", path=None):
+        self.root = root
+        self.path = path or os.path.join(root, STORE_FILE)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._lock, self._db:
+            self._db.executescript(_SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    # --- entries ---
+
+    def add(self, **fields):
+        """Append an entry; returns its id"""
+        now = time.time()
+        fields = {k: v for k, v in fields.items() if k in ITEM_FIELDS}
+        with self._lock, self._db:
+            position = self._db.execute("SELECT COALESCE(MAX(position), -1) + 1 FROM items").fetchone()[0]
+            names = ", ".join(fields)
+            marks = ", ".join("?" for _ in fields)
+            return self._db.execute(f"INSERT INTO items (position, created, updated, {names})"
+                                    f" VALUES (?, ?, ?, {marks})", (position, now, now, *fields.values())).lastrowid
+
+    def update(self, id, **fields):
+        fields = {k: v for k, v in fields.items() if k in ITEM_FIELDS}
+        if not fields:
+            return
+        sets = ", ".join(f"{k} = ?" for k in fields)
+        with self._lock, self._db:
+            self._db.execute(f"UPDATE items SET {sets}, updated = ? WHERE id = ?",
+                             (*fields.values(), time.time(), id))
+
+    def remove(self, id):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM episodes WHERE item = ?", (id,))
+            self._db.execute("DELETE FROM items WHERE id = ?", (id,))
+
+    def clear(self):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM episodes")
+            self._db.execute("DELETE FROM items")
+
+    def reorder(self, ids):
+        """Set the queue order to ids"""
+        with self._lock, self._db:
+            self._db.executemany("UPDATE items SET position = ? WHERE id = ?", list(enumerate(ids)))
+
+    def started(self, id):
+        """An entry was launched: count the attempt"""
+        with self._lock, self._db:
+            self._db.execute("UPDATE items SET state = 'running', attempts = attempts + 1, error = NULL,"
+                             " updated = ? WHERE id = ?", (time.time(), id))
+
+    def finished(self, id, state, error=None):
+        """An entry ended as done, failed or stopped; episodes it left running go back to pending"""
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute("UPDATE items SET state = ?, error = ?, updated = ? WHERE id = ?", (state, error, now, id))
+            self._db.execute("UPDATE episodes SET state = 'pending', updated = ? WHERE item = ? AND state = 'running'",
+                             (now, id))
+
+    def items(self):
+        """Every entry in queue order, with its done episodes as "done" """
+        with self._lock:
+            rows = self._db.execute("SELECT * FROM items ORDER BY position, id").fetchall()
+            done = {}
+            for item, episode in self._db.execute("SELECT item, episode FROM episodes WHERE state = 'done'"
+                                                  " ORDER BY CAST(episode AS REAL)"):
+                done.setdefault(item, []).append(episode)
+        return [dict(row, done=done.get(row["id"], [])) for row in rows]
+
+    def recover(self):
+        """After a restart: nothing is running any more, put it back to pending"""
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute("UPDATE items SET state = 'pending', updated = ? WHERE state = 'running'", (now,))
+            self._db.execute("UPDATE episodes SET state = 'pending', updated = ? WHERE state = 'running'", (now,))
+
+    def forget_done(self):
+        """Drop finished entries; returns how many"""
+        with self._lock, self._db:
+            ids = [r[0] for r in self._db.execute("SELECT id FROM items WHERE state = 'done'")]
+            self._db.executemany("DELETE FROM episodes WHERE item = ?", [(i,) for i in ids])
+            self._db.executemany("DELETE FROM items WHERE id = ?", [(i,) for i in ids])
+        return len(ids)
+
+    # --- episodes ---
+
+    def episode_event(self, id, event):
+        """Fold a pahe.events episode_start / episode_end of entry id into its episode's row"""
+        kind = event.get("type")
+        episode = event.get("episode")
+        if kind not in ("episode_start", "episode_end") or episode is None:
+            return
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute("INSERT OR IGNORE INTO episodes (item, episode, updated) VALUES (?, ?, ?)",
+                             (id, str(episode), now))
+            if kind == "episode_start":
+                self._db.execute("UPDATE episodes SET state = 'running', attempts = attempts + 1, error = NULL,"
+                                 " updated = ? WHERE item = ? AND episode = ?", (now, id, str(episode)))
+                return
+            if event.get("cancelled"):
+                state = "pending"
+            elif event.get("ok"):
+                state = "done"
+            else:
+                state = "failed"
+            self._db.execute("UPDATE episodes SET state = ?, error = ?, output = COALESCE(?, output), updated = ?"
+                             " WHERE item = ? AND episode = ?",
+                             (state, event.get("error"), event.get("output"), now, id, str(episode)))
+
+    def episodes(self, id):
+        with self._lock:
+            rows = self._db.execute("SELECT * FROM episodes WHERE item = ? ORDER BY CAST(episode AS REAL)",
+                                    (id,)).fetchall()
+        return [dict(row) for row in rows]
+
+    # --- queue as a whole ---
+
+    def get_flag(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_flag(self, key, value):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="pahe.queuestore", description="The GUI's saved download queue")
+    parser.add_argument("--root", default=".", help="library directory (default: .)")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("show", help="entries and their episodes")
+    p.add_argument("--json", action="store_true")
+    sub.add_parser("forget-done", help="drop finished entries")
+    args = parser.parse_args(argv)
+
+    store = QueueStore(args.root)
+    if args.cmd == "forget-done":
+        print(f"{store.forget_done()} entries dropped")
+        return 0
+    items = store.items()
+    for item in items:
+        item["episode_states"] = store.episodes(item["id"])
+    if args.json:
+        print(json.dumps(items, indent=1))
+        return 0
+    for item in items:
+        counts = {}
+        for ep in item["episode_states"]:
+            counts[ep["state"]] = counts.get(ep["state"], 0) + 1
+        eps = ", ".join(f"{n} {s}" for s, n in counts.items()) or "no episode started"
+        print(f"{item['id']:>4} {item['state']:<8} [{item['priority']}] {item['label'] or item['slug']} "
+              f"Ep {item['episodes']}: {eps}, {item['attempts']} attempt(s)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
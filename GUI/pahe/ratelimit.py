@@ -0,0 +1,410 @@
+"""Bandwidth shaping shared by every segment worker.
+
+Every segment body is read in CHUNK-sized pieces through one TokenBucket
+per process, so the workers together never go faster than the bucket's
+rate. The cap is a rate such as 500K or 4M (bytes per second, K/M/G are
+powers of 1024, 0 or off for no limit) or a time-of-day schedule, where a
+bare rate covers the rest of the day:
+
+    08:00-23:00=1M,01:00-07:00=0,4M
+
+Downloads running on the same machine share the cap through a registry
+directory (ANIMEPAHE_DL_RATE_DIR, default animepahe-dl-rate in the temp
+dir). Each one writes a heartbeat with its weight and usage every second
+and takes a weighted max-min share of the cap: a job that does not use its
+share leaves it to the others, the rest is split by weight. The cap is
+--rate / ANIMEPAHE_DL_RATE if given, else the registry's limit file, which
+the GUI and `set` write and running downloads pick up within a second.
+Share changes are emitted as "bandwidth" events (see pahe.events).
+
+    python -m pahe.ratelimit set "08:00-23:00=1M,4M"
+    python -m pahe.ratelimit clear
+    python -m pahe.ratelimit status [--json]
+"""
+import argparse
+import json
+import os
+import re
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from .console import print_info, print_warn
+from .events import EventWriter, human_size
+from .retry import Cancelled
+
+RATE_ENV = "ANIMEPAHE_DL_RATE"
+WEIGHT_ENV = "ANIMEPAHE_DL_WEIGHT"
+RATE_DIR_ENV = "ANIMEPAHE_DL_RATE_DIR"
+LIMIT_FILE = "limit"
+CHUNK = 64 * 1024
+INTERVAL = 1.0
+STALE = 5.0
+# A job that left its share unused may grow by this much before the next tick
+HEADROOM = 1.5
+MIN_SHARE = CHUNK
+
+_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+_RATE_RE = re.compile(r"^(\d+(?:\.\d+)?)\s*([kmg]?)(?:i?b)?(?:/s)?$")
+_WINDOW_RE = re.compile(r"^(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*=\s*(.+)$")
+
+
+def parse_rate(text):
+    """Bytes per second of "500K", "4M" or "1048576"; None for 0 or off"""
+    text = str(text).strip().lower()
+    if text in ("", "off", "none"):
+        return None
+    m = _RATE_RE.match(text)
+    if m is None:
+        raise ValueError(f"invalid rate {text!r}, expected e.g. 500K, 4M or 0")
+    return float(m.group(1)) * _UNITS[m.group(2)] or None
+
+
+class RateSchedule:
+    """A cap that may change with the time of day"""
+
+    def __init__(self, spec):
+        self.spec = str(spec).strip()
+        self.default = None
+        self.windows = []  # (first minute, end minute, rate)
+        defaults = 0
+        for part in filter(None, (p.strip() for p in self.spec.split(","))):
+            m = _WINDOW_RE.match(part)
+            if m is None:
+                self.default = parse_rate(part)
+                defaults += 1
+                continue
+            h1, m1, h2, m2 = map(int, m.groups()[:4])
+            if h1 > 23 or h2 > 24 or m1 > 59 or m2 > 59 or (h2 == 24 and m2):
+                raise ValueError(f"invalid time window {part!r}")
+            self.windows.append((h1 * 60 + m1, h2 * 60 + m2, parse_rate(m.group(5))))
+        if defaults > 1:
+            raise ValueError(f"more than one rate outside time windows in {self.spec!r}")
+
+    def rate(self, now=None):
+        """Cap in bytes per second at local time now, None for no limit"""
+        t = time.localtime(now)
+        minute = t.tm_hour * 60 + t.tm_min
+        for start, end, rate in self.windows:
+            # A window such as 23:00-07:00 wraps around midnight
+            if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                return rate
+        return self.default
+
+    def __str__(self):
+        return self.spec
+
+
+class TokenBucket:
+    """consume(n) blocks until n bytes may pass at `rate` bytes per second.
+
+    rate None lets everything through. At most a quarter second of tokens
+    (one CHUNK at least) is saved up, so idle moments are not followed by
+    bursts above the rate.
+    """
+
+    def __init__(self, rate=None):
+        self._lock = threading.Lock()
+        self.rate = None
+        self._tokens = 0.0
+        self._stamp = time.monotonic()
+        self._consumed = 0
+        self._waited = 0.0
+        self.set_rate(rate)
+
+    def _capacity(self):
+        return max(CHUNK, self.rate / 4)
+
+    def _refill(self, now):
+        if self.rate:
+            self._tokens = min(self._capacity(), self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = max(1.0, rate) if rate else None
+            if self.rate:
+                self._tokens = min(self._tokens, self._capacity())
+
+    def consume(self, n, stop_event=None):
+        """Take n tokens, waiting for them; raises Cancelled once stop_event is set"""
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if not self.rate:
+                    self._consumed += n
+                    return
+                need = min(n, self._capacity())
+                if self._tokens >= need:
+                    self._tokens -= n
+                    self._consumed += n
+                    return
+                # Short naps, so a new rate applies to waiting workers too
+                delay = min(0.25, (need - self._tokens) / self.rate)
+                self._waited += delay
+            if stop_event is None:
+                time.sleep(delay)
+            elif stop_event.wait(delay):
+                raise Cancelled()
+
+    def take_stats(self):
+        """(bytes consumed, seconds workers waited) since the last call"""
+        with self._lock:
+            stats = self._consumed, self._waited
+            self._consumed, self._waited = 0, 0.0
+            return stats
+
+
+def allocate(cap, demands):
+    """Weighted max-min split of cap.
+
+    demands maps a key to (weight, demand), demand None for as much as it
+    can get. Jobs asking for less than their weighted share get what they
+    ask for, the others split the rest by weight.
+    """
+    shares = {}
+    left = dict(demands)
+    remaining = cap
+    while left:
+        total = sum(w for w, _ in left.values())
+        modest = {k: d for k, (w, d) in left.items() if d is not None and d <= remaining * w / total}
+        if not modest:
+            for k, (w, _) in left.items():
+                shares[k] = remaining * w / total
+            break
+        for k, d in modest.items():
+            shares[k] = d
+            remaining -= d
+            del left[k]
+    return shares
+
+
+def rate_dir():
+    return os.environ.get(RATE_DIR_ENV) or os.path.join(tempfile.gettempdir(), "animepahe-dl-rate")
+
+
+def read_limit(directory=None):
+    """The cap the GUI or `set` wrote, None if there is none"""
+    try:
+        with open(os.path.join(directory or rate_dir(), LIMIT_FILE), encoding="utf-8") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def write_limit(spec, directory=None):
+    """Set the shared cap; an empty spec removes it"""
+    directory = directory or rate_dir()
+    path = os.path.join(directory, LIMIT_FILE)
+    if not spec or not str(spec).strip():
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return
+    RateSchedule(spec)
+    os.makedirs(directory, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(str(spec).strip() + "\n")
+    os.replace(tmp, path)
+
+
+def members(directory=None, now=None):
+    """Heartbeats of the downloads sharing the cap, {path: entry}; stale ones are dropped"""
+    directory = directory or rate_dir()
+    now = time.time() if now is None else now
+    found = {}
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return found
+    for name in names:
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            continue
+        age = now - entry.get("updated", 0)
+        if age <= STALE:
+            found[path] = entry
+        elif age > 60 * STALE:
+            # Left behind by a killed process
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    return found
+
+
+class Bandwidth:
+    """A TokenBucket whose rate is this process's weighted share of the cap.
+
+    spec is the cap, a rate or schedule; None follows the registry's limit
+    file. start() registers the heartbeat and re-balances every INTERVAL.
+    """
+
+    def __init__(self, spec=None, weight=1.0, name=None, directory=None, events=None, log=print_info):
+        self.schedule = RateSchedule(spec) if spec else None
+        self.weight = weight
+        self.name = name or f"pid {os.getpid()}"
+        self.directory = directory or rate_dir()
+        self.path = os.path.join(self.directory, f"{socket.gethostname()}-{os.getpid()}.json")
+        self.events = events or EventWriter()
+        self.log = log
+        self.bucket = TokenBucket()
+        self.cap = None
+        self.share = None
+        self.used = None
+        self._limit = (None, None)  # (spec, RateSchedule) of the limit file
+        self._stamp = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.tick()
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._stop.set()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def _run(self):
+        while not self._stop.wait(INTERVAL):
+            try:
+                self.tick()
+            except OSError as e:
+                print_warn(f"Cannot update bandwidth share: {e}")
+
+    def current_cap(self, now=None):
+        if self.schedule is not None:
+            return self.schedule.rate(now)
+        spec = read_limit(self.directory)
+        if spec != self._limit[0]:
+            try:
+                self._limit = (spec, RateSchedule(spec) if spec else None)
+            except ValueError as e:
+                print_warn(f"Ignore bandwidth limit: {e}")
+                self._limit = (spec, None)
+        return self._limit[1].rate(now) if self._limit[1] else None
+
+    def tick(self):
+        """Measure this process's usage, publish it and take a new share"""
+        now = time.monotonic()
+        elapsed = max(now - self._stamp, 1e-3)
+        self._stamp = now
+        consumed, waited = self.bucket.take_stats()
+        # Nothing measured yet, or workers had to wait: as much as it can get
+        wanting = self.used is None or waited > elapsed * 0.1
+        self.used = consumed / elapsed
+        demand = None if wanting else max(self.used * HEADROOM, MIN_SHARE)
+        cap = self.current_cap()
+        share = None
+        if cap:
+            demands = {path: (e.get("weight", 1.0), e.get("demand"))
+                       for path, e in members(self.directory).items() if path != self.path}
+            demands[self.path] = (self.weight, demand)
+            share = allocate(cap, demands)[self.path]
+        self.bucket.set_rate(share)
+        self._write({"name": self.name, "pid": os.getpid(), "weight": self.weight, "demand": demand,
+                     "used": round(self.used, 1), "share": share and round(share, 1), "cap": cap,
+                     "updated": time.time()})
+        if cap != self.cap:
+            self.log(f"Bandwidth limit {human_size(cap) + '/s' if cap else 'off'}")
+        if cap != self.cap or (share is None) != (self.share is None) or (
+                share and abs(share - self.share) > 0.05 * self.share):
+            self.share = share
+            self.events.emit("bandwidth", cap=cap, share=share and round(share, 1), weight=self.weight)
+        self.cap = cap
+
+    def _write(self, entry):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(tmp, self.path)
+
+
+def weight_arg(value):
+    """argparse type for --weight: a positive number"""
+    try:
+        weight = float(value)
+    except ValueError:
+        weight = 0
+    if weight <= 0:
+        raise argparse.ArgumentTypeError(f"invalid weight {value!r}, expected a positive number")
+    return weight
+
+
+def schedule_arg(value):
+    """argparse type for --rate: a rate or schedule, validated"""
+    try:
+        RateSchedule(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return value
+
+
+def add_arguments(parser):
+    """--rate, --weight and --name, for the download modules"""
+    parser.add_argument("--rate", type=schedule_arg, default=os.environ.get(RATE_ENV) or None,
+                        help=f"bandwidth cap, e.g. 4M or 08:00-23:00=1M,4M (default: ${RATE_ENV}, "
+                             "else the shared limit)")
+    parser.add_argument("--weight", type=weight_arg, default=os.environ.get(WEIGHT_ENV) or None,
+                        help=f"share of the cap against other downloads (default: ${WEIGHT_ENV} or 1)")
+    parser.add_argument("--name", help="label of this download in `pahe.ratelimit status`")
+
+
+def bandwidth_for(args):
+    """Started Bandwidth for parsed add_arguments() options.
+
+    Also without any cap yet: it watches the limit file, so a cap set
+    later applies to this download too.
+    """
+    return Bandwidth(args.rate, args.weight or 1.0, args.name).start()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="pahe.ratelimit", description="Shared bandwidth cap of all downloads")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("set", help="set the cap of every download on this machine")
+    p.add_argument("spec", type=schedule_arg, help="rate or schedule, e.g. 4M or 08:00-23:00=1M,4M")
+    sub.add_parser("clear", help="remove the cap")
+    p = sub.add_parser("status", help="show the cap and every download's share")
+    p.add_argument("--json", action="store_true")
+    args = parser.parse_args(argv)
+
+    if args.cmd == "set":
+        write_limit(args.spec)
+        cap = RateSchedule(args.spec).rate()
+        print_info(f"Bandwidth limit set, now {human_size(cap) + '/s' if cap else 'off'}")
+        return 0
+    if args.cmd == "clear":
+        write_limit(None)
+        print_info("Bandwidth limit removed")
+        return 0
+    spec = read_limit()
+    found = sorted(members().values(), key=lambda e: e.get("name", ""))
+    if args.json:
+        print(json.dumps({"limit": spec, "downloads": found}, indent=1))
+        return 0
+    print(f"limit: {spec or 'off'}")
+    for e in found:
+        share = f"{human_size(e['share'])}/s" if e.get("share") else "unlimited"
+        print(f"{e.get('name', '?')}: weight {e.get('weight', 1):g}, using {human_size(e.get('used', 0))}/s "
+              f"of {share}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
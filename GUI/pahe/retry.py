@@ -0,0 +1,152 @@
+"""Bounded retries with backoff, and per-host circuit breakers.
+
+A failed request is retried at most `attempts` times, sleeping a random
+time up to base * 2^attempt (capped, "full jitter") in between. Only
+errors that can heal are retried: connection problems, timeouts, short
+reads and HTTP 408/425/429/5xx. Other 4xx answers, such as 403 for an
+expired cookie or 404 for a dead link, fail at once.
+
+Consecutive retryable failures are also counted per host. After
+`threshold` of them in a row the host's breaker opens and every worker
+waits out a cooldown instead of hammering it; the cooldown doubles each
+time the first request after it fails again, and any success resets it.
+
+ANIMEPAHE_DL_RETRIES sets the number of attempts (default 8), for the
+bash fallback's download_file as well.
+"""
+import http.client
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+from .session import HttpError
+
+DEFAULT_ATTEMPTS = 8
+RETRYABLE_STATUS = (408, 425, 429)
+
+
+class Cancelled(Exception):
+    pass
+
+
+class DownloadFailed(Exception):
+    """A request failed for good: a fatal error, or out of attempts"""
+
+    def __init__(self, url, cause, attempts):
+        reason = f"after {attempts} attempts" if retryable(cause) else "not retryable"
+        super().__init__(f"{url}: {cause} ({reason})")
+        self.url = url
+        self.cause = cause
+        self.attempts = attempts
+
+
+def retryable(exc):
+    if isinstance(exc, HttpError):
+        return exc.status in RETRYABLE_STATUS or exc.status >= 500
+    return isinstance(exc, (OSError, http.client.HTTPException))
+
+
+def env_attempts():
+    value = os.environ.get("ANIMEPAHE_DL_RETRIES", "")
+    return int(value) if value.isdigit() and int(value) > 0 else DEFAULT_ATTEMPTS
+
+
+class RetryPolicy:
+    def __init__(self, attempts=None, base=0.5, cap=30.0):
+        self.attempts = attempts or env_attempts()
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt):
+        """Sleep before retry number `attempt` (1 for the first retry)"""
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """Pauses requests to hosts that keep failing"""
+
+    def __init__(self, threshold=10, cooldown=5.0, max_cooldown=120.0, log=None):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.log = log
+        self._lock = threading.Lock()
+        self._failures = {}   # host -> consecutive failures
+        self._open_until = {}  # host -> monotonic time
+        self._cooldowns = {}  # host -> current cooldown
+
+    def wait(self, host, stop_event=None):
+        """Block while host's breaker is open; raise Cancelled if stop_event is set"""
+        while True:
+            with self._lock:
+                left = self._open_until.get(host, 0) - time.monotonic()
+            if left <= 0:
+                return
+            if stop_event is not None:
+                if stop_event.wait(left):
+                    raise Cancelled()
+            else:
+                time.sleep(left)
+
+    def success(self, host):
+        with self._lock:
+            self._failures.pop(host, None)
+            self._cooldowns.pop(host, None)
+
+    def failure(self, host):
+        with self._lock:
+            n = self._failures.get(host, 0) + 1
+            self._failures[host] = n
+            if n < self.threshold or self._open_until.get(host, 0) > time.monotonic():
+                return
+            cooldown = self._cooldowns.get(host)
+            cooldown = self.cooldown if cooldown is None else min(self.max_cooldown, cooldown * 2)
+            self._cooldowns[host] = cooldown
+            self._open_until[host] = time.monotonic() + cooldown
+            # The next failure after the pause reopens it straight away
+            self._failures[host] = self.threshold - 1
+        if self.log:
+            self.log(f"{host} failed {n} times in a row, pausing requests to it for {cooldown:.0f}s")
+
+
+class Retrier:
+    def __init__(self, policy=None, breaker=None):
+        self.policy = policy or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+
+    def call(self, fn, url, on_retry=None, stop_event=None):
+        """Return fn(), retrying it per the policy.
+
+        on_retry(exc, attempt, delay) is called before each retry. Raises
+        DownloadFailed when giving up, Cancelled once stop_event is set.
+        """
+        host = urlsplit(url).netloc
+        attempts = self.policy.attempts
+        for attempt in range(1, attempts + 1):
+            self.breaker.wait(host, stop_event)
+            try:
+                result = fn()
+            except Cancelled:
+                raise
+            except Exception as e:
+                if not retryable(e):
+                    if isinstance(e, HttpError):
+                        # The host answered, it is just this request that is wrong
+                        self.breaker.success(host)
+                    raise DownloadFailed(url, e, attempt) from e
+                self.breaker.failure(host)
+                if attempt == attempts:
+                    raise DownloadFailed(url, e, attempt) from e
+                delay = self.policy.delay(attempt)
+                if on_retry:
+                    on_retry(e, attempt, delay)
+                if stop_event is not None:
+                    if stop_event.wait(delay):
+                        raise Cancelled()
+                else:
+                    time.sleep(delay)
+                continue
+            self.breaker.success(host)
+            return result
@@ -0,0 +1,350 @@
+"""Cross-episode scheduler for multi-episode ranges.
+
+animepahe-dl.sh runs it as a coprocess and hands it one resolved episode
+per line on stdin:
+
+    <episode>\\t<playlist url>\\t<output file>\\t<scratch dir>
+
+Whenever the scheduler has room for another episode it prints "next" on
+stdout, so the script resolves episodes N+1 and N+2 while N is still
+downloading. Every in-flight episode shares one pool of -t segment
+workers, earlier episodes first, and muxing runs beside the pool so
+episode N is joined while N+1's segments stream in. Episode and segment
+progress is reported through pahe.events when ANIMEPAHE_DL_EVENTS is set,
+and all workers draw from one bandwidth share (pahe.ratelimit).
+Episodes whose video is already complete (pahe.library) are skipped, and
+every finished video is recorded in the library inventory. ffmpeg writes
+a hidden partial file that replaces the video only once it is whole. pahe.daemon
+feeds one long-lived Scheduler from many jobs, each episode reporting to
+its job's events.
+"""
+import argparse
+import itertools
+import os
+import queue
+import shlex
+import shutil
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .checkpoint import Checkpoint
+from .console import print_info, print_warn
+from .crypto import Decryptor
+from .engine import Cancelled, SegmentDownloader, limiter_for, thread_arg
+from .events import EpisodeProgress, EventWriter, timed
+from .hls import parse_playlist
+from .library import BAD_STATUS, Inventory, find_ffprobe
+from .mux import FfmpegPipe, MuxError, ReorderBuffer, concat_segments, partial_path
+from .ratelimit import add_arguments as add_rate_arguments, bandwidth_for
+from .session import Session
+
+
+class Episode:
+    def __init__(self, order, number, playlist_url, output, workdir, events):
+        self.order = order
+        self.number = number
+        self.playlist_url = playlist_url
+        self.output = output
+        self.partial = partial_path(output)
+        self.workdir = workdir
+        self.events = events
+        self.playlist = None
+        self.checkpoint = None
+        self.buffer = None
+        self.pipe = None
+        self.writer = None
+        self.progress = None
+        self.remaining = 0
+        self.released = False
+        self.error = None
+        self.lock = threading.Lock()
+
+
+class Scheduler:
+    def __init__(self, session, threads, lookahead=2, stream=False, ffmpeg="ffmpeg", ffmpeg_args=(),
+                 buffer_bytes=64 * 1024 * 1024, keep_workdir=False, on_ready=None, events=None, limiter=None, bucket=None):
+        self.session = session
+        self.threads = max(1, threads)
+        self.lookahead = max(0, lookahead)
+        self.stream = stream
+        self.ffmpeg = ffmpeg
+        self.ffmpeg_args = list(ffmpeg_args)
+        # Every in-flight episode gets an equal slice of the reorder memory
+        self.buffer_bytes = buffer_bytes // (self.lookahead + 1)
+        self.keep_workdir = keep_workdir
+        self.on_ready = on_ready
+        self.events = events or EventWriter()
+        self.ffprobe = find_ffprobe(ffmpeg) or False
+        self.downloader = SegmentDownloader(session, self.threads, limiter=limiter, bucket=bucket)
+        self.decryptor = Decryptor(session)
+        self.failed = []
+        self._queue = queue.PriorityQueue()
+        self._ticket = itertools.count()
+        self._order = itertools.count()
+        self._prepare = ThreadPoolExecutor(max_workers=self.lookahead + 1)
+        self._mux = ThreadPoolExecutor(max_workers=2)
+        self._active = []
+        self._cond = threading.Condition()
+        self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(self.threads)]
+
+    def start(self):
+        for w in self._workers:
+            w.start()
+        for _ in range(self.lookahead + 1):
+            self._ready()
+
+    def _ready(self):
+        if self.on_ready:
+            self.on_ready()
+
+    def submit(self, number, playlist_url, output, workdir, events=None):
+        """Queue one episode; its events go to `events` if given, else to the scheduler's"""
+        ep = Episode(next(self._order), number, playlist_url, output, workdir, events or self.events)
+        with self._cond:
+            self._active.append(ep)
+        self._prepare.submit(self._run_guarded, ep, self._start_episode, ep)
+        return ep
+
+    def _run_guarded(self, ep, fn, *args):
+        try:
+            fn(*args)
+        except Cancelled:
+            pass
+        except Exception as e:
+            self._fail(ep, e)
+
+    def _start_episode(self, ep):
+        """Fetch the playlist and queue the episode's segments on the shared pool"""
+        with timed(ep.events, "playlist", ep.number, count=1) as m:
+            resp = self.session.fetch(ep.playlist_url)
+            m["bytes"] = len(resp.data)
+        text = resp.text()
+        ep.playlist = parse_playlist(text, ep.playlist_url)
+        if not ep.playlist.segments:
+            raise ValueError("no segment found in playlist")
+        with timed(ep.events, "verify", ep.number):
+            complete = Inventory(os.path.dirname(ep.output), self.ffprobe).is_complete(ep.output, ep.playlist.duration)
+        if complete:
+            print_info(f"Episode {ep.number} is already downloaded, skip")
+            ep.events.emit("episode_end", episode=ep.number, ok=True, output=ep.output, skipped=True)
+            self._release(ep)
+            self._retire(ep)
+            return
+        print_info(f"Downloading Episode {ep.number}...")
+        ep.events.emit("episode_start", episode=ep.number)
+        ep.remaining = len(ep.playlist.segments)
+        ep.progress = EpisodeProgress(ep.events, ep.number, ep.remaining)
+        if self.stream:
+            ep.pipe = FfmpegPipe(ep.partial, self.ffmpeg, self.ffmpeg_args)
+            ep.buffer = ReorderBuffer(ep.pipe.write, self.buffer_bytes)
+            ep.writer = threading.Thread(target=ep.buffer.drain, args=(ep.remaining,), daemon=True)
+            ep.writer.start()
+        else:
+            os.makedirs(ep.workdir, exist_ok=True)
+            with open(os.path.join(ep.workdir, "playlist.m3u8"), "w", encoding="utf-8") as f:
+                f.write(text)
+            ep.checkpoint = Checkpoint(ep.workdir, ep.playlist)
+        if ep.error is not None:
+            # Cancelled while it was being prepared
+            self._abandon(ep, ep.error)
+            return
+        for segment in ep.playlist.segments:
+            self._queue.put((ep.order, segment.index, next(self._ticket), ep, segment))
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item[-1] is None:
+                return
+            _, _, _, ep, segment = item
+            if ep.error is None:
+                self._run_guarded(ep, self._segment, ep, segment)
+
+    def _segment(self, ep, segment):
+        started = time.monotonic()
+        if self.stream:
+            data = self.downloader.fetch_segment(segment, ep.progress.retry)
+            ep.progress.segment_done(len(data), time.monotonic() - started)
+            started = time.monotonic()
+            data = self.decryptor.decrypt_segment(segment, data)
+            ep.progress.decrypted(time.monotonic() - started)
+            ep.buffer.put(segment.index, data)
+            self._segment_done(ep)
+            return
+        cp = ep.checkpoint
+        if cp.is_decrypted(segment.name):
+            ep.progress.segment_done(0)
+            self._segment_done(ep)
+            return
+        src = os.path.join(ep.workdir, segment.name + ".encrypted")
+        dst = os.path.join(ep.workdir, segment.name)
+        received, seconds = 0, None
+        if not cp.is_downloaded(segment.name):
+            received = self.downloader.download_segment(segment, src, ep.progress.retry)
+            seconds = time.monotonic() - started
+            cp.mark_downloaded(segment.name, received)
+        ep.progress.segment_done(received, seconds)
+        future = self.decryptor.submit(segment, src, dst, ep.progress.decrypted)
+
+        def decrypted(f):
+            if f.exception() is not None:
+                self._fail(ep, f.exception())
+                return
+            cp.mark_decrypted(segment.name, os.path.getsize(dst))
+            self._segment_done(ep)
+
+        future.add_done_callback(decrypted)
+
+    def _segment_done(self, ep):
+        with ep.lock:
+            ep.remaining -= 1
+            last = ep.remaining == 0
+        if last and ep.error is None:
+            self._release(ep)
+            self._mux.submit(self._run_guarded, ep, self._finish, ep)
+
+    def _release(self, ep):
+        """Downloading is over for ep, one way or another: let the next episode in"""
+        with ep.lock:
+            if ep.released:
+                return
+            ep.released = True
+        self._ready()
+
+    def _finish(self, ep):
+        ep.progress.decrypt_finished()
+        with timed(ep.events, "mux", ep.number):
+            if self.stream:
+                ep.writer.join()
+                if ep.buffer.error is not None:
+                    raise ep.buffer.error
+                ep.pipe.close()
+            else:
+                ep.checkpoint.flush()
+                concat_segments(ep.workdir, [s.name for s in ep.playlist.segments], ep.partial,
+                                self.ffmpeg, self.ffmpeg_args)
+        with timed(ep.events, "verify", ep.number):
+            entry = Inventory(os.path.dirname(ep.output), self.ffprobe).record(
+                ep.partial, ep.playlist.duration, os.path.basename(ep.output))
+        if entry["status"] in BAD_STATUS:
+            # The segments stay, so a rerun muxes them again
+            raise MuxError(f"video is {entry['status']}: {entry['duration'] or 0:.1f}s of {ep.playlist.duration:.1f}s")
+        os.replace(ep.partial, ep.output)
+        if not self.stream and not self.keep_workdir:
+            shutil.rmtree(ep.workdir, ignore_errors=True)
+        print_info(f"Episode {ep.number} finished: {ep.output}")
+        ep.events.emit("episode_end", episode=ep.number, ok=True, output=ep.output)
+        self._retire(ep)
+
+    def _fail(self, ep, exc):
+        with ep.lock:
+            if ep.error is not None:
+                return
+            ep.error = exc
+        print_warn(f"Episode {ep.number} failed: {exc}")
+        ep.events.emit("episode_end", episode=ep.number, ok=False, error=str(exc))
+        self._abandon(ep, exc)
+        self.failed.append(ep.number)
+
+    def cancel(self, ep):
+        """Drop ep without counting it as failed; its checkpoint is kept, so it resumes if submitted again"""
+        with ep.lock:
+            if ep.error is not None:
+                return
+            ep.error = Cancelled()
+        print_info(f"Episode {ep.number} cancelled")
+        ep.events.emit("episode_end", episode=ep.number, ok=False, cancelled=True)
+        self._abandon(ep, ep.error)
+
+    def _abandon(self, ep, exc):
+        if ep.buffer is not None:
+            ep.buffer.fail(exc)
+        if ep.pipe is not None:
+            ep.pipe.abort()
+        try:
+            os.remove(ep.partial)
+        except OSError:
+            pass
+        if ep.checkpoint is not None:
+            ep.checkpoint.flush()
+        self._release(ep)
+        self._retire(ep)
+
+    def _retire(self, ep):
+        with self._cond:
+            if ep in self._active:
+                self._active.remove(ep)
+            self._cond.notify_all()
+
+    def wait(self):
+        """Block until every submitted episode is finished or failed"""
+        with self._cond:
+            while self._active:
+                self._cond.wait()
+
+    def close(self, abort=False):
+        if abort:
+            self.downloader.cancel()
+            with self._cond:
+                active = list(self._active)
+            for ep in active:
+                if ep.pipe is not None:
+                    ep.pipe.abort()
+                if ep.checkpoint is not None:
+                    ep.checkpoint.flush()
+        for _ in self._workers:
+            self._queue.put((float("inf"), 0, next(self._ticket), None, None))
+        self._prepare.shutdown(wait=not abort)
+        self._mux.shutdown(wait=not abort)
+        self.decryptor.shutdown()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="pahe.scheduler", description="Download a range of episodes as one job")
+    parser.add_argument("-t", "--threads", type=thread_arg, default=(1, 1, False),
+                        help="segment connections shared by all episodes: a number, auto or auto:MIN-MAX")
+    parser.add_argument("--lookahead", type=int, default=2, help="episodes resolved ahead of the current one")
+    parser.add_argument("--referer")
+    parser.add_argument("--cookie")
+    parser.add_argument("--stream", action="store_true", help="pipe segments into ffmpeg, no segment files")
+    parser.add_argument("--ffmpeg", default="ffmpeg")
+    parser.add_argument("--ffmpeg-args", default="", help="extra ffmpeg output options")
+    parser.add_argument("--buffer-mb", type=int, default=64, help="reorder memory shared by in-flight episodes")
+    parser.add_argument("--keep", action="store_true", help="keep scratch directories (debug)")
+    add_rate_arguments(parser)
+    args = parser.parse_args(argv)
+
+    def ready():
+        try:
+            print("next", flush=True)
+        except BrokenPipeError:
+            pass
+
+    session = Session(cookie=args.cookie, referer=args.referer, verify=False)
+    bandwidth = bandwidth_for(args)
+    sched = Scheduler(session, args.threads[1], args.lookahead, args.stream, args.ffmpeg,
+                      shlex.split(args.ffmpeg_args), args.buffer_mb * 1024 * 1024, args.keep, on_ready=ready,
+                      limiter=limiter_for(args.threads), bucket=bandwidth.bucket)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(143))
+    sched.start()
+    aborted = True
+    try:
+        for line in sys.stdin:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) != 4:
+                print_warn(f"Ignore malformed job: {line.strip()}")
+                continue
+            sched.submit(*fields)
+        sched.wait()
+        aborted = False
+    finally:
+        sched.close(abort=aborted)
+        bandwidth.close()
+    return 1 if sched.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
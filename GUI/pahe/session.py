@@ -0,0 +1,143 @@
+import gzip
+import http.client
+import ssl
+import threading
+import zlib
+from urllib.parse import urljoin, urlsplit
+
+
+class HttpError(Exception):
+    def __init__(self, status, url):
+        super().__init__(f"HTTP {status} for {url}")
+        self.status = status
+        self.url = url
+
+
+def _read_throttled(resp, throttle, size=64 * 1024):
+    chunks = []
+    while True:
+        chunk = resp.read(size)
+        if not chunk:
+            return b"".join(chunks)
+        throttle(len(chunk))
+        chunks.append(chunk)
+
+
+class Response:
+    def __init__(self, status, headers, data, url):
+        self.status = status
+        self.headers = headers
+        self.data = data
+        self.url = url
+
+    def text(self):
+        return self.data.decode("utf-8", errors="replace")
+
+
+class Session:
+    """Keep-alive HTTP client, the in-process replacement for get()/download_file.
+
+    Connections are kept per thread and per origin, so a pool of N workers
+    holds at most N sockets to the CDN and pays the TLS handshake once per
+    socket instead of once per segment. Every request carries the same
+    Referer and __ddg2_ cookie the bash script sends.
+    """
+
+    def __init__(self, cookie=None, referer=None, timeout=30, verify=True):
+        self.cookie = cookie
+        self.referer = referer
+        self.timeout = timeout
+        self.verify = verify
+        self._local = threading.local()
+        self._ssl_context = ssl.create_default_context()
+        if not verify:
+            # Same as curl -k in download_file
+            self._ssl_context.check_hostname = False
+            self._ssl_context.verify_mode = ssl.CERT_NONE
+
+    def _connection(self, scheme, netloc):
+        conns = getattr(self._local, "conns", None)
+        if conns is None:
+            conns = self._local.conns = {}
+        conn = conns.get((scheme, netloc))
+        if conn is None:
+            if scheme == "https":
+                conn = http.client.HTTPSConnection(netloc, timeout=self.timeout, context=self._ssl_context)
+            else:
+                conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+            conns[(scheme, netloc)] = conn
+        return conn
+
+    def _drop_connection(self, scheme, netloc):
+        conn = getattr(self._local, "conns", {}).pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def close(self):
+        """Close the connections opened by the calling thread"""
+        for conn in getattr(self._local, "conns", {}).values():
+            conn.close()
+        self._local.conns = {}
+
+    def _headers(self, extra):
+        headers = {"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"}
+        if self.referer:
+            headers["Referer"] = self.referer
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        if extra:
+            headers.update(extra)
+        return headers
+
+    def _send(self, url, headers, throttle=None):
+        parts = urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        # A kept-alive socket may have been closed by the server since the
+        # last request; retry once on a fresh connection before giving up.
+        for attempt in range(2):
+            conn = self._connection(parts.scheme, parts.netloc)
+            try:
+                conn.request("GET", path, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read() if throttle is None else _read_throttled(resp, throttle)
+            except (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                    BrokenPipeError, ConnectionResetError):
+                self._drop_connection(parts.scheme, parts.netloc)
+                if attempt:
+                    raise
+                continue
+            except Exception:
+                self._drop_connection(parts.scheme, parts.netloc)
+                raise
+            if resp.will_close:
+                self._drop_connection(parts.scheme, parts.netloc)
+            return resp, data
+
+    def get(self, url, headers=None, max_redirects=5, throttle=None):
+        """GET url following redirects (curl -L), returns a Response
+
+        throttle(n), if given, is called for every chunk of the body as it
+        is read, and may block to pace the download (pahe.ratelimit).
+        """
+        headers = self._headers(headers)
+        for _ in range(max_redirects + 1):
+            resp, data = self._send(url, headers, throttle)
+            if resp.status in (301, 302, 303, 307, 308) and resp.getheader("Location"):
+                url = urljoin(url, resp.getheader("Location"))
+                continue
+            encoding = (resp.getheader("Content-Encoding") or "").lower()
+            if encoding == "gzip":
+                data = gzip.decompress(data)
+            elif encoding == "deflate":
+                data = zlib.decompress(data)
+            return Response(resp.status, resp.headers, data, url)
+        raise HttpError(resp.status, url)
+
+    def fetch(self, url, headers=None):
+        """GET url and raise HttpError unless the server answered 2xx"""
+        resp = self.get(url, headers=headers)
+        if not 200 <= resp.status < 300:
+            raise HttpError(resp.status, url)
+        return resp
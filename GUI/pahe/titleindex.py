@@ -0,0 +1,163 @@
+"""Persistent search index over anime.list.
+
+anime.list holds one "[slug] Title" line per anime; download_anime_list
+and search_anime_by_name merge into it by slug (pahe.animelist), but
+lists written before that can hold the same slug many times. The index
+keeps one title per slug (the last one, as get_slug_from_name's `tail -1`
+does) plus a trigram table for ranked fuzzy matching, stored next to the
+list as anime.list.idx. pahe.animelist rewrites the list in place, so
+any change of its size or mtime triggers a rebuild.
+
+    python -m pahe.titleindex search "one punch"
+"""
+import argparse
+import json
+import os
+import re
+import sys
+
+from .animelist import parse_line
+
+INDEX_VERSION = 1
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+
+def normalize(text):
+    return " ".join(_WORD_RE.findall(text.lower()))
+
+
+def trigrams(text):
+    text = f"  {normalize(text)} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class TitleIndex:
+    def __init__(self, list_file="anime.list", index_file=None):
+        self.list_file = list_file
+        self.index_file = index_file or list_file + ".idx"
+        self.titles = {}   # slug -> title
+        self.grams = {}    # trigram -> set of slugs
+        self._source = None
+        self._loaded = False
+
+    def _stat(self):
+        try:
+            st = os.stat(self.list_file)
+        except OSError:
+            return None
+        return {"size": st.st_size, "mtime": st.st_mtime}
+
+    def _load(self):
+        self._loaded = True
+        try:
+            with open(self.index_file, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("version") != INDEX_VERSION:
+            return
+        self.titles = data["titles"]
+        self.grams = {g: set(slugs) for g, slugs in data["grams"].items()}
+        self._source = data["source"]
+
+    def _save(self):
+        tmp = self.index_file + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"version": INDEX_VERSION, "source": self._source, "titles": self.titles,
+                       "grams": {g: sorted(slugs) for g, slugs in self.grams.items() if slugs}}, f)
+        os.replace(tmp, self.index_file)
+
+    def _add_grams(self, slug, title):
+        for g in trigrams(title):
+            self.grams.setdefault(g, set()).add(slug)
+
+    def _add(self, slug, title):
+        old = self.titles.get(slug)
+        if old == title:
+            return
+        if old is not None:
+            for g in trigrams(old):
+                self.grams.get(g, set()).discard(slug)
+        self.titles[slug] = title
+        self._add_grams(slug, title)
+
+    def refresh(self):
+        """Bring the index up to date with anime.list; cheap when nothing changed"""
+        if not self._loaded:
+            self._load()
+        cur = self._stat()
+        if cur is None:
+            return False
+        old = self._source
+        if old and old["size"] == cur["size"] and old["mtime"] == cur["mtime"]:
+            return False
+        # Merged lines can land anywhere in the file, not just at its end
+        self.titles = {}
+        self.grams = {}
+        with open(self.list_file, "rb") as f:
+            for raw in f:
+                entry = parse_line(raw.decode("utf-8", errors="replace"))
+                if entry:
+                    self._add(*entry)
+        self._source = cur
+        self._save()
+        return True
+
+    def search(self, query, limit=50):
+        """Ranked (slug, title) matches for query, best first"""
+        self.refresh()
+        q = normalize(query)
+        if not q:
+            return []
+        qgrams = trigrams(q)
+        words = q.split()
+        hits = {}
+        for g in qgrams:
+            for slug in self.grams.get(g, ()):
+                hits[slug] = hits.get(slug, 0) + 1
+        scored = []
+        for slug, shared in hits.items():
+            title = normalize(self.titles[slug])
+            score = shared / len(qgrams)
+            if q in title:
+                score += 2 + (1 if title.startswith(q) else 0)
+            elif all(w in title for w in words):
+                score += 1
+            # Shorter titles win ties: "Naruto" before "Naruto Shippuden"
+            scored.append((-score, len(title), slug))
+        # Fuzzy tail: drop candidates sharing under a third of the trigrams
+        scored = sorted(s for s in scored if -s[0] >= 1 / 3)
+        return [(slug, self.titles[slug]) for _, _, slug in scored[:limit]]
+
+    def lines(self):
+        """The deduplicated list, in anime.list format"""
+        self.refresh()
+        return [f"[{slug}] {title}" for slug, title in self.titles.items()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="pahe.titleindex", description="Search anime.list through its index")
+    parser.add_argument("--list", default="anime.list", help="anime list file (default: ./anime.list)")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("search", help="print ranked matches as [slug] Title lines")
+    p.add_argument("query")
+    p.add_argument("-n", "--limit", type=int, default=50)
+    sub.add_parser("build", help="build or update the index")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.list):
+        print(f"{args.list} not found", file=sys.stderr)
+        return 1
+    index = TitleIndex(args.list)
+    if args.cmd == "build":
+        index.refresh()
+        print(f"{len(index.titles)} titles indexed", file=sys.stderr)
+        return 0
+    matches = index.search(args.query, args.limit)
+    for slug, title in matches:
+        print(f"[{slug}] {title}")
+    return 0 if matches else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
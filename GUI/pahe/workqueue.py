@@ -0,0 +1,532 @@
+"""Per-episode work queue shared by the hosts downloading into one library.
+
+Several machines writing into one library (an NFS export, say) each had
+to be handed disjoint episode ranges, or they clobbered each other's
+scratch directories and videos. `submit` breaks a job into one task per
+episode in <root>/.workqueue.db, a SQLite file every host opens through
+the shared directory, and `work` runs a pahe.scheduler that claims tasks
+whenever it has room for another episode.
+
+A claim is a lease that the worker renews every LEASE/3 seconds while the
+episode downloads. A lease that ran out, because its host died or lost
+the share, is taken over by the next worker that asks: it moves the old
+scratch directory (<anime>/<episode>.<worker>) to its own and resumes from
+the checkpoint in it, and the old worker drops the episode as soon as it
+finds its lease gone. Videos are muxed under a hidden name and renamed
+into place once whole (pahe.scheduler), so two workers finishing the same
+episode still leave one whole video. A task is tried MAX_ATTEMPTS times
+before it is marked failed; `retry` queues failed tasks again.
+
+Every change is one SQLite write transaction, which over NFS needs working
+POSIX locks (NFSv4, or v3 with lockd). Leases are compared with each
+host's clock, keep them in sync.
+
+    python -m pahe.workqueue submit <slug> -e 1-12 [-r 1080] [-o jpn]
+    python -m pahe.workqueue work [-t auto] [--lookahead 2] [--lease 60] [--drain]
+    python -m pahe.workqueue status [--json]
+    python -m pahe.workqueue retry
+"""
+import argparse
+import json
+import os
+import re
+import secrets
+import shlex
+import signal
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from .client import Client, ClientError, episode_sessions, folder_name, parse_episodes
+from .console import print_info, print_warn
+from .engine import limiter_for, thread_arg
+from .events import EventWriter
+from .ratelimit import Bandwidth, add_arguments as add_rate_arguments
+from .scheduler import Scheduler
+from .session import Session
+
+QUEUE_FILE = ".workqueue.db"
+LEASE = 60.0
+MAX_ATTEMPTS = 3
+# Seconds between claims while the queue has nothing for this worker
+POLL = 5.0
+STATES = ("pending", "leased", "done", "failed")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    slug TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    episodes TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    job INTEGER NOT NULL,
+    slug TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    episode TEXT NOT NULL,
+    session TEXT NOT NULL,
+    resolution TEXT,
+    audio TEXT,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    token TEXT,
+    expires REAL,
+    workdir TEXT,
+    error TEXT,
+    updated REAL,
+    UNIQUE (folder, episode)
+);
+CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, expires);
+"""
+
+
+def worker_name():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class Task:
+    """One claimed episode. token tells this lease from later ones on the same task;
+    previous and previous_workdir name the worker it was taken over from, if any."""
+
+    def __init__(self, row, previous=None, previous_workdir=None):
+        self.id = row["id"]
+        self.job = row["job"]
+        self.slug = row["slug"]
+        self.folder = row["folder"]
+        self.episode = row["episode"]
+        self.session = row["session"]
+        self.resolution = row["resolution"]
+        self.audio = row["audio"]
+        self.attempts = row["attempts"]
+        self.worker = row["worker"]
+        self.token = row["token"]
+        self.workdir = row["workdir"]
+        self.previous = previous
+        self.previous_workdir = previous_workdir
+
+
+class WorkQueue:
+    def __init__(self, root=".", path=None):
+        self.root = os.path.abspath(root)
+        self.path = path or os.path.join(self.root, QUEUE_FILE)
+        self._lock = threading.Lock()
+        # Autocommit mode: every change is an explicit BEGIN IMMEDIATE transaction
+        self._db = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._lock:
+            self._db.executescript(_SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            # Take the write lock up front, so two claims never pick the same task
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def submit(self, slug, folder, sessions, resolution=None, audio=None, spec="*"):
+        """Queue one task per {episode: session}; returns (job id, tasks added).
+
+        An episode already pending or leased stays as it is; a done or
+        failed one is queued again, the scheduler skips a video that is
+        still whole.
+        """
+        now = time.time()
+        added = 0
+        with self._transaction() as db:
+            job = db.execute("INSERT INTO jobs (slug, folder, episodes, created) VALUES (?, ?, ?, ?)",
+                             (slug, folder, spec, now)).lastrowid
+            for n, session in sessions.items():
+                added += db.execute(
+                    "INSERT INTO tasks (job, slug, folder, episode, session, resolution, audio, updated)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+                    " ON CONFLICT (folder, episode) DO UPDATE SET job = excluded.job, slug = excluded.slug,"
+                    " session = excluded.session, resolution = excluded.resolution, audio = excluded.audio,"
+                    " state = 'pending', attempts = 0, error = NULL, updated = excluded.updated"
+                    " WHERE tasks.state IN ('done', 'failed')",
+                    (job, slug, folder, str(n), session, resolution, audio, now)).rowcount
+        return job, added
+
+    def claim(self, worker, lease=LEASE):
+        """Lease the first pending task, or one whose lease ran out; None if there is none"""
+        while True:
+            now = time.time()
+            with self._transaction() as db:
+                row = db.execute("SELECT * FROM tasks WHERE state = 'pending' OR (state = 'leased' AND expires < ?)"
+                                 " ORDER BY job, CAST(episode AS REAL) LIMIT 1", (now,)).fetchone()
+                if row is None:
+                    return None
+                stolen = row["state"] == "leased"
+                if row["attempts"] >= MAX_ATTEMPTS:
+                    db.execute("UPDATE tasks SET state = 'failed', token = NULL, expires = NULL, error = ?,"
+                               " updated = ? WHERE id = ?",
+                               (f"gave up after {row['attempts']} attempts, the last lease of {row['worker']}"
+                                " ran out", now, row["id"]))
+                    continue
+                token = secrets.token_hex(8)
+                workdir = f"{row['episode']}.{worker}"
+                db.execute("UPDATE tasks SET state = 'leased', worker = ?, token = ?, expires = ?, workdir = ?,"
+                           " attempts = attempts + 1, updated = ? WHERE id = ?",
+                           (worker, token, now + lease, workdir, now, row["id"]))
+            task = dict(row, worker=worker, token=token, workdir=workdir, attempts=row["attempts"] + 1)
+            return Task(task, row["worker"] if stolen else None, row["workdir"])
+
+    def renew(self, tasks, lease=LEASE):
+        """Extend the leases of tasks; returns the ones that were taken over meanwhile"""
+        now = time.time()
+        lost = []
+        with self._transaction() as db:
+            for task in tasks:
+                cur = db.execute("UPDATE tasks SET expires = ?, updated = ? WHERE id = ? AND token = ?"
+                                 " AND state = 'leased'", (now + lease, now, task.id, task.token))
+                if cur.rowcount == 0:
+                    lost.append(task)
+        return lost
+
+    def complete(self, task):
+        """Mark task done; False if its lease was lost before"""
+        with self._transaction() as db:
+            return db.execute("UPDATE tasks SET state = 'done', token = NULL, expires = NULL, error = NULL,"
+                              " updated = ? WHERE id = ? AND token = ?",
+                              (time.time(), task.id, task.token)).rowcount == 1
+
+    def fail(self, task, error):
+        """Put task back for another attempt, or mark it failed after MAX_ATTEMPTS; returns its state"""
+        with self._transaction() as db:
+            db.execute("UPDATE tasks SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,"
+                       " token = NULL, expires = NULL, error = ?, updated = ? WHERE id = ? AND token = ?",
+                       (MAX_ATTEMPTS, error, time.time(), task.id, task.token))
+            row = db.execute("SELECT state FROM tasks WHERE id = ?", (task.id,)).fetchone()
+        return row["state"] if row else None
+
+    def release(self, task):
+        """Give task back untried, e.g. when the worker stops; its scratch directory is kept for the next one"""
+        with self._transaction() as db:
+            db.execute("UPDATE tasks SET state = 'pending', attempts = MAX(attempts - 1, 0), token = NULL,"
+                       " expires = NULL, updated = ? WHERE id = ? AND token = ?",
+                       (time.time(), task.id, task.token))
+
+    def retry(self):
+        """Queue every failed task again; returns how many"""
+        with self._transaction() as db:
+            return db.execute("UPDATE tasks SET state = 'pending', attempts = 0, updated = ?"
+                              " WHERE state = 'failed'", (time.time(),)).rowcount
+
+    def unfinished(self):
+        """Tasks pending or leased"""
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM tasks WHERE state IN ('pending', 'leased')").fetchone()[0]
+
+    def status(self):
+        """Per job task counts, and the leased tasks"""
+        with self._lock:
+            counts = self._db.execute("SELECT job, folder, state, COUNT(*) AS n FROM tasks"
+                                      " GROUP BY job, folder, state ORDER BY job").fetchall()
+            leased = self._db.execute("SELECT folder, episode, worker, expires, attempts FROM tasks"
+                                      " WHERE state = 'leased' ORDER BY job, CAST(episode AS REAL)").fetchall()
+            failed = self._db.execute("SELECT folder, episode, error FROM tasks WHERE state = 'failed'"
+                                      " ORDER BY job, CAST(episode AS REAL)").fetchall()
+        jobs = {}
+        for row in counts:
+            job = jobs.setdefault(row["job"], {"job": row["job"], "folder": row["folder"],
+                                               **dict.fromkeys(STATES, 0)})
+            job[row["state"]] = row["n"]
+        return {"jobs": list(jobs.values()), "leased": [dict(r) for r in leased],
+                "failed": [dict(r) for r in failed]}
+
+
+def _remove_partials(folder, episode):
+    """Drop the half-muxed videos of episode that a dead worker left, see pahe.mux.partial_path"""
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        return
+    # .<episode>.<host>-<pid>.part<ext>: exact, so taking over 1 spares .1.5.*
+    partial = re.compile(rf"^\.{re.escape(str(episode))}\.[^.]+-\d+\.part\.")
+    for name in names:
+        if partial.match(name):
+            try:
+                os.remove(os.path.join(folder, name))
+            except OSError:
+                pass
+
+
+class _TaskEvents:
+    """Event sink of one task's episode: passes events on, settles the task when it ends"""
+
+    def __init__(self, worker, task):
+        self.worker = worker
+        self.task = task
+
+    def emit(self, type, **fields):
+        # Episode numbers repeat across anime, the folder tells them apart
+        self.worker.events.emit(type, job=self.task.folder, **fields)
+        if type == "episode_end":
+            self.worker._settle(self.task, fields)
+
+
+class Worker:
+    """Downloads claimed tasks on one Scheduler, the way pahe.daemon runs its jobs.
+
+    The scheduler asks for an episode whenever it has room (on_ready); the
+    main loop answers with the next task claimed from the queue. A
+    heartbeat thread renews the leases of the tasks in hand.
+    """
+
+    def __init__(self, root=".", threads=(2, 32, True), lookahead=2, stream=False, ffmpeg="ffmpeg",
+                 ffmpeg_args=(), rate=None, weight=1.0, lease=LEASE, name=None, drain=False):
+        self.root = os.path.abspath(root)
+        self.name = name or worker_name()
+        self.lease = lease
+        self.drain = drain
+        self.queue = WorkQueue(self.root)
+        self.client = Client(self.root, log=print_warn)
+        self.session = Session(cookie=self.client.cookie, referer=self.client.host, verify=False)
+        self.events = EventWriter()
+        limiter = limiter_for(threads)
+        if limiter is not None:
+            limiter.events = self.events
+        self.bandwidth = Bandwidth(rate, weight, f"worker {self.name}", events=self.events).start()
+        self.scheduler = Scheduler(self.session, threads[1], lookahead, stream, ffmpeg, ffmpeg_args,
+                                   on_ready=self._slot_free, events=self.events, limiter=limiter,
+                                   bucket=self.bandwidth.bucket)
+        self.held = {}  # task id -> [Task, scheduler Episode or None while its link is resolved]
+        self.done = 0
+        self.failed = 0
+        self._cond = threading.Condition()
+        self._slots = threading.Semaphore(0)
+        self._stop = threading.Event()
+
+    def _slot_free(self):
+        self._slots.release()
+
+    def run(self):
+        """Work until stopped, or with drain until the queue is finished; returns the exit status"""
+        print_info(f"Worker {self.name} on {self.root}")
+        self.scheduler.start()
+        heartbeat = threading.Thread(target=self._heartbeat, daemon=True)
+        heartbeat.start()
+        clean = False
+        try:
+            while self._slots.acquire() and not self._stop.is_set():
+                if not self._dispatch():
+                    break
+            with self._cond:
+                while self.held:
+                    self._cond.wait()
+            clean = True
+        finally:
+            self.close(abort=not clean)
+        print_info(f"Worker {self.name}: {self.done} episode(s) done, {self.failed} failed")
+        return 1 if self.failed else 0
+
+    def _dispatch(self):
+        """Claim a task and hand it to the scheduler; False once there is nothing left to do"""
+        while not self._stop.is_set():
+            task = self._claim()
+            if task is None:
+                return False
+            folder = os.path.join(self.root, task.folder)
+            workdir = os.path.join(folder, task.workdir)
+            if task.previous_workdir and task.previous_workdir != task.workdir:
+                # Resume from whatever the last holder left; a late write of its own now fails
+                try:
+                    os.rename(os.path.join(folder, task.previous_workdir), workdir)
+                except OSError:
+                    pass
+            if task.previous:
+                print_info(f"Episode {task.episode} of {task.folder}: the lease of {task.previous} ran out, "
+                           f"taking over (attempt {task.attempts})")
+                _remove_partials(folder, task.episode)
+            with self._cond:
+                self.held[task.id] = [task, None]
+            try:
+                link = self.client.resolve_playlist(task.slug, task.session, task.resolution, task.audio)
+            except Exception as e:
+                print_warn(f"Episode {task.episode}: {e}, skip downloading")
+                _TaskEvents(self, task).emit("episode_end", episode=task.episode, ok=False, error=str(e))
+                continue
+            with self._cond:
+                if task.id not in self.held:
+                    # Lease lost while the link was resolved: the slot is still free
+                    continue
+                entry = self.held[task.id]
+            entry[1] = self.scheduler.submit(task.episode, link, os.path.join(folder, f"{task.episode}.mp4"),
+                                             workdir, events=_TaskEvents(self, task))
+            return True
+        return False
+
+    def _claim(self):
+        while not self._stop.is_set():
+            try:
+                task = self.queue.claim(self.name, self.lease)
+                if task is not None:
+                    return task
+                if self.drain and not self.held and not self.queue.unfinished():
+                    return None
+            except sqlite3.Error as e:
+                print_warn(f"Cannot reach the work queue: {e}")
+            with self._cond:
+                self._cond.wait(POLL)
+        return None
+
+    def _settle(self, task, fields):
+        with self._cond:
+            entry = self.held.pop(task.id, None)
+            self._cond.notify_all()
+        if entry is None:
+            # Dropped when its lease was lost
+            return
+        try:
+            if fields.get("cancelled"):
+                self.queue.release(task)
+            elif fields.get("ok"):
+                self.done += 1
+                if not self.queue.complete(task):
+                    print_warn(f"Episode {task.episode} of {task.folder}: finished after its lease was taken over")
+            elif self.queue.fail(task, fields.get("error")) == "failed":
+                self.failed += 1
+                print_warn(f"Episode {task.episode} of {task.folder}: gave up after {task.attempts} attempts")
+        except sqlite3.Error as e:
+            print_warn(f"Cannot record episode {task.episode} of {task.folder}: {e}")
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.lease / 3):
+            with self._cond:
+                tasks = [task for task, _ in self.held.values()]
+            if not tasks:
+                continue
+            try:
+                lost = self.queue.renew(tasks, self.lease)
+            except sqlite3.Error as e:
+                print_warn(f"Cannot renew leases: {e}")
+                continue
+            for task in lost:
+                with self._cond:
+                    entry = self.held.pop(task.id, None)
+                    self._cond.notify_all()
+                if entry is None:
+                    continue
+                print_warn(f"Episode {task.episode} of {task.folder}: lease lost to another worker, dropping it")
+                if entry[1] is not None:
+                    self.scheduler.cancel(entry[1])
+
+    def close(self, abort=False):
+        self._stop.set()
+        self._slots.release()
+        with self._cond:
+            held = [task for task, _ in self.held.values()]
+            self.held.clear()
+            self._cond.notify_all()
+        self.scheduler.close(abort=abort)
+        # Stopped halfway: hand the episodes to the other workers right away
+        for task in held:
+            try:
+                self.queue.release(task)
+            except sqlite3.Error:
+                pass
+        self.bandwidth.close()
+        self.queue.close()
+
+
+def _print_status(status):
+    for job in status["jobs"]:
+        total = sum(job[s] for s in STATES)
+        print(f"{job['job']:>4} {job['folder']}: {job['done']}/{total} done, {job['leased']} running, "
+              f"{job['pending']} pending, {job['failed']} failed")
+    now = time.time()
+    for task in status["leased"]:
+        left = task["expires"] - now
+        lease = f"lease {left:.0f}s left" if left > 0 else "lease ran out"
+        print(f"     {task['folder']} Ep {task['episode']}: {task['worker']}, {lease}, attempt {task['attempts']}")
+    for task in status["failed"]:
+        print(f"     {task['folder']} Ep {task['episode']} failed: {task['error']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="pahe.workqueue", description="Episode queue shared by download hosts")
+    parser.add_argument("--root", default=".", help="library directory (default: .)")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("submit", help="queue the episodes of an anime")
+    p.add_argument("slug")
+    p.add_argument("-e", "--episodes", default="*", help='e.g. "1,3,5-8" (default: all)')
+    p.add_argument("-r", "--resolution")
+    p.add_argument("-o", "--audio")
+    p = sub.add_parser("work", help="download queued episodes")
+    p.add_argument("-t", "--threads", type=thread_arg, default=thread_arg("auto"),
+                   help="segment connections of this worker: a number, auto or auto:MIN-MAX")
+    p.add_argument("--lookahead", type=int, default=2, help="episodes in flight beside the current one")
+    p.add_argument("--stream", action="store_true", help="pipe segments into ffmpeg, no segment files")
+    p.add_argument("--ffmpeg", default="ffmpeg")
+    p.add_argument("--ffmpeg-args", default="-v error", help="extra ffmpeg output options")
+    p.add_argument("--lease", type=float, default=LEASE, help=f"seconds a claim holds without a heartbeat "
+                                                              f"(default: {LEASE:g})")
+    p.add_argument("--drain", action="store_true", help="exit once no episode is pending or running")
+    # --name names the worker too (default: <host>-<pid>)
+    add_rate_arguments(p)
+    p = sub.add_parser("status", help="tasks per job, running and failed tasks")
+    p.add_argument("--json", action="store_true")
+    sub.add_parser("retry", help="queue failed tasks again")
+    args = parser.parse_args(argv)
+
+    if args.cmd == "work":
+        worker = Worker(args.root, args.threads, args.lookahead, args.stream, args.ffmpeg,
+                        shlex.split(args.ffmpeg_args), args.rate, args.weight or 1.0, args.lease, args.name,
+                        args.drain)
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(143))
+        try:
+            return worker.run()
+        except KeyboardInterrupt:
+            return 130
+
+    queue = WorkQueue(args.root)
+    if args.cmd == "status":
+        status = queue.status()
+        if args.json:
+            print(json.dumps(status, indent=1))
+        else:
+            _print_status(status)
+        return 0
+    if args.cmd == "retry":
+        print_info(f"{queue.retry()} task(s) queued again")
+        return 0
+
+    client = Client(args.root, log=print_warn)
+    try:
+        title = client.title(args.slug)
+        if not title:
+            raise ClientError(f"anime {args.slug} not found")
+        folder = folder_name(title)
+        sessions = episode_sessions(client.download_source(args.slug, folder))
+    except (ClientError, OSError) as e:
+        print_warn(str(e))
+        return 1
+    numbers = parse_episodes(args.episodes, list(sessions))
+    missing = [n for n in numbers if n not in sessions]
+    if missing:
+        print_warn(f"Episode(s) {', '.join(map(str, missing))} not found, skip")
+    numbers = [n for n in numbers if n in sessions]
+    if not numbers:
+        print_warn("Wrong episode number!")
+        return 1
+    job, added = queue.submit(args.slug, folder, {n: sessions[n] for n in numbers}, args.resolution, args.audio,
+                              args.episodes)
+    print_info(f"Job {job}: {added} of {len(numbers)} episode(s) of {folder} queued")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,7 +3,7 @@
 # Download anime from animepahe in terminal
 #
 #/ Usage:
-#/   ./animepahe-dl.sh [-a <anime name>] [-s <anime_slug>] [-e <episode_num1,num2,num3-num4...>] [-r <resolution>] [-t <num>] [-l] [-d]
+#/   ./animepahe-dl.sh [-a <anime name>] [-s <anime_slug>] [-e <episode_num1,num2,num3-num4...>] [-r <resolution>] [-t <num>] [-b <rate>] [-S] [-l] [-d]
 #/
 #/ Options:
 #/   -a <name>               anime name
@@ -17,6 +17,13 @@
 #/                           by default, the highest resolution is selected
 #/   -o <language>           optional, specify audio language: "eng", "jpn"...
 #/   -t <num>                optional, specify a positive integer as num of threads
+#/                           or "auto", "auto:<min>-<max>" to tune it while
+#/                           downloading (requires python, default 2-32)
+#/   -b <rate>               optional, with -t, cap the bandwidth shared by all
+#/                           downloads: "500K", "4M" or a schedule such as
+#/                           "08:00-23:00=1M,4M" (requires python)
+#/   -S                      optional, with -t, pipe segments straight into ffmpeg
+#/                           without writing segment files (requires python)
 #/   -l                      optional, show m3u8 playlist link without downloading videos
 #/   -d                      enable debug mode
 #/   -h | --help             display this help message
@@ -33,7 +40,8 @@ set_var() {
     _JQ="$(command -v jq)" || command_not_found "jq"
     _FZF="$(command -v fzf)" || command_not_found "fzf"
     if [[ -z ${ANIMEPAHE_DL_NODE:-} ]]; then
-        _NODE="$(command -v node)" || command_not_found "node"
+        # Only needed when the python kwik unpacker is unavailable, see below
+        _NODE="$(command -v node || true)"
     else
         _NODE="$ANIMEPAHE_DL_NODE"
     fi
@@ -41,8 +49,14 @@ set_var() {
     if [[ ${_PARALLEL_JOBS:-} -gt 1 ]]; then
        _OPENSSL="$(command -v openssl)" || command_not_found "openssl"
     fi
+    if [[ -z ${ANIMEPAHE_DL_PYTHON:-} ]]; then
+        _PYTHON="$(command -v python3 || command -v python || true)"
+    else
+        _PYTHON="$ANIMEPAHE_DL_PYTHON"
+    fi
 
-    _HOST="https://animepahe.si"
+    # ANIMEPAHE_DL_HOST points the script at another site, e.g. bench/fakepahe.py
+    _HOST="${ANIMEPAHE_DL_HOST:-https://animepahe.si}"
     _ANIME_URL="$_HOST/anime"
     _API_URL="$_HOST/api"
     _REFERER_URL="$_HOST"
@@ -50,12 +64,29 @@ set_var() {
     _SCRIPT_PATH=$(dirname "$(realpath "$0")")
     _ANIME_LIST_FILE="$_SCRIPT_PATH/anime.list"
     _SOURCE_FILE=".source.json"
+    _PAGE_JOBS=8
+    # Playlist links resolved ahead of the episode being downloaded
+    _PREFETCH_AHEAD="${ANIMEPAHE_DL_PREFETCH:-3}"
+    _PREFETCH_JOBS=2
+    _ENGINE_PATH="${ANIMEPAHE_DL_ENGINE:-$_SCRIPT_PATH/GUI}"
+    _PLAYLIST_CACHE_FILE="$_SCRIPT_PATH/.playlist.cache"
+
+    if [[ -z "$_NODE" ]] && ! has_engine; then
+        command_not_found "node"
+    fi
+    if [[ -n "${_AUTO_THREADS:-}" ]] && ! has_engine; then
+        print_warn "-t auto needs python, fallback to $_PARALLEL_JOBS threads"
+        _AUTO_THREADS=""
+    fi
+    if [[ -n "${ANIMEPAHE_DL_RATE:-}" && -z "${_LIST_LINK_ONLY:-}" ]] && { ! has_engine || [[ "$_PARALLEL_JOBS" -le 1 ]]; }; then
+        print_warn "Bandwidth limit needs python and -t, ignored"
+    fi
 }
 
 set_args() {
     expr "$*" : ".*--help" > /dev/null && usage
     _PARALLEL_JOBS=1
-    while getopts ":hlda:s:e:r:t:o:" opt; do
+    while getopts ":hldSa:s:e:r:t:o:b:" opt; do
         case $opt in
             a)
                 _INPUT_ANIME_NAME="$OPTARG"
@@ -69,18 +100,34 @@ set_args() {
             l)
                 _LIST_LINK_ONLY=true
                 ;;
+            S)
+                _STREAM_MUX=true
+                ;;
             r)
                 _ANIME_RESOLUTION="$OPTARG"
                 ;;
             t)
                 _PARALLEL_JOBS="$OPTARG"
+                if [[ "$_PARALLEL_JOBS" =~ ^auto(:([0-9]+)-([0-9]+))?$ ]]; then
+                    # Adaptive: the engine moves between min and max, the
+                    # rest of the script sees max
+                    _AUTO_THREADS="${BASH_REMATCH[2]:-2}-${BASH_REMATCH[3]:-32}"
+                    _PARALLEL_JOBS="${BASH_REMATCH[3]:-32}"
+                    if [[ "${BASH_REMATCH[2]:-2}" -eq 0 || "${BASH_REMATCH[2]:-2}" -gt "$_PARALLEL_JOBS" ]]; then
+                        print_error "-t auto:<min>-<max>: min must be positive and not above max"
+                    fi
+                fi
                 if [[ ! "$_PARALLEL_JOBS" =~ ^[0-9]+$ || "$_PARALLEL_JOBS" -eq 0 ]]; then
-                    print_error "-t <num>: Number must be a positive integer"
+                    print_error "-t <num>: Number must be a positive integer or auto"
                 fi
                 ;;
             o)
                 _ANIME_AUDIO="$OPTARG"
                 ;;
+            b)
+                # Read by pahe.ratelimit in the engine
+                export ANIMEPAHE_DL_RATE="$OPTARG"
+                ;;
             d)
                 _DEBUG_MODE=true
                 set -x
@@ -111,11 +158,77 @@ print_error() {
     exit 1
 }
 
+at_exit() {
+    # $1: command to run when the script exits, however it exits
+    # Hooks run in the order they were added; they must not fail if the
+    # thing they clean up is already gone
+    _EXIT_HOOKS+=("$1")
+    trap run_exit_hooks EXIT
+}
+
+run_exit_hooks() {
+    local h
+    for h in "${_EXIT_HOOKS[@]}"; do
+        eval "$h" || true
+    done
+}
+
 command_not_found() {
     # $1: command name
     print_error "$1 command not found!"
 }
 
+emit_event() {
+    # $1: event type
+    # $@: jq --arg/--argjson name value pairs for the event fields
+    # Appends a JSON line to $ANIMEPAHE_DL_EVENTS, see GUI/pahe/events.py
+    [[ -z "${ANIMEPAHE_DL_EVENTS:-}" ]] && return 0
+    local t="$1"
+    shift
+    "$_JQ" -nc --arg type "$t" "$@" '$ARGS.named + {t: now}' >> "$ANIMEPAHE_DL_EVENTS" || true
+}
+
+event_clock() {
+    # Print the current time for emit_phase, nothing when events are off
+    [[ -z "${ANIMEPAHE_DL_EVENTS:-}" ]] && return 0
+    "$_JQ" -n now
+}
+
+emit_phase() {
+    # $1: phase name, see PHASES in GUI/pahe/events.py
+    # $2: start time from event_clock
+    # $@: jq --arg/--argjson name value pairs for more fields
+    [[ -z "${ANIMEPAHE_DL_EVENTS:-}" || -z "${2:-}" ]] && return 0
+    local p="$1" s="$2"
+    shift 2
+    "$_JQ" -nc --arg type phase --arg phase "$p" --argjson start "$s" "$@" \
+        '$ARGS.named + {seconds: (now - $start), t: now} | del(.start)' >> "$ANIMEPAHE_DL_EVENTS" || true
+}
+
+start_metrics() {
+    # With ANIMEPAHE_DL_METRICS naming a directory, write the per-phase
+    # figures of this run there on exit, see GUI/pahe/metrics.py
+    [[ -z "${ANIMEPAHE_DL_METRICS:-}" ]] && return 0
+    if ! has_engine; then
+        print_warn "ANIMEPAHE_DL_METRICS needs python, ignored"
+        return 0
+    fi
+    if [[ -z "${ANIMEPAHE_DL_EVENTS:-}" ]]; then
+        ANIMEPAHE_DL_EVENTS="$(mktemp)"
+        export ANIMEPAHE_DL_EVENTS
+        _METRICS_EVENTS_TMP=1
+    fi
+    # Older runs in the same events file are not counted
+    _METRICS_OFFSET="$(wc -c < "$ANIMEPAHE_DL_EVENTS" 2>/dev/null || echo 0)"
+    at_exit write_metrics
+}
+
+write_metrics() {
+    run_pahe metrics write --offset "$_METRICS_OFFSET" "$ANIMEPAHE_DL_EVENTS" "$ANIMEPAHE_DL_METRICS" > /dev/null || true
+    [[ -n "${_METRICS_EVENTS_TMP:-}" ]] && rm -f "$ANIMEPAHE_DL_EVENTS"
+    return 0
+}
+
 get() {
     # $1: url
     "$_CURL" -sS -L "$1" -H "cookie: $_COOKIE" --compressed
@@ -128,10 +241,44 @@ set_cookie() {
 }
 
 download_anime_list() {
+    # $1: optional, "force" to fetch the list even if it is fresh
+    # The list is only fetched once it is older than $ANIMEPAHE_DL_LIST_TTL
+    # seconds (default a day); with python the page is asked for
+    # conditionally and merged by slug, see GUI/pahe/animelist.py
+    if has_engine; then
+        run_pahe client --root "$_SCRIPT_PATH" list ${1:+--force} > /dev/null || true
+        return 0
+    fi
+    local ttl t m
+    ttl="${ANIMEPAHE_DL_LIST_TTL:-86400}"
+    # mtime in seconds: GNU stat, else BSD stat
+    m="$(stat -c %Y "$_ANIME_LIST_FILE" 2>/dev/null || stat -f %m "$_ANIME_LIST_FILE" 2>/dev/null || echo 0)"
+    if [[ -z "${1:-}" && -s "$_ANIME_LIST_FILE" && $(( $(date +%s) - m )) -lt "$ttl" ]]; then
+        return 0
+    fi
+    t="$(mktemp "$_ANIME_LIST_FILE.XXXXXX")"
     get "$_ANIME_URL" \
     | grep "/anime/" \
     | sed -E 's/.*anime\//[/;s/" title="/] /;s/\">.*/   /;s/" title/]/' \
-    > "$_ANIME_LIST_FILE"
+    > "$t" || true
+    if [[ -s "$t" ]]; then
+        add_to_anime_list < "$t"
+    fi
+    rm -f "$t"
+}
+
+add_to_anime_list() {
+    # stdin: "[slug] title" lines, merged into $_ANIME_LIST_FILE one line per slug
+    if has_engine; then
+        run_pahe animelist --root "$_SCRIPT_PATH" add
+        return
+    fi
+    local t
+    t="$(mktemp "$_ANIME_LIST_FILE.XXXXXX")"
+    { cat; cat "$_ANIME_LIST_FILE" 2>/dev/null || true; } | awk '!seen[$1]++' > "$t"
+    # mktemp creates it 0600, give it the mode a new file would get
+    chmod "$(printf '%o' $(( 0666 & ~$(umask) )))" "$t"
+    mv "$t" "$_ANIME_LIST_FILE"
 }
 
 search_anime_by_name() {
@@ -142,9 +289,9 @@ search_anime_by_name() {
     if [[ "$n" -eq "0" ]]; then
         echo ""
     else
-        "$_JQ" -r '.data[] | "[\(.session)] \(.title)   "' <<< "$d" \
-            | tee -a "$_ANIME_LIST_FILE" \
-            | remove_slug
+        d="$("$_JQ" -r '.data[] | "[\(.session)] \(.title)   "' <<< "$d")"
+        add_to_anime_list <<< "$d"
+        remove_slug <<< "$d"
     fi
 }
 
@@ -155,25 +302,84 @@ get_episode_list() {
 }
 
 download_source() {
-    local d p n
+    # Fetch the release list into $_SOURCE_FILE. Pages after the first are
+    # fetched concurrently and merged in one jq pass. An existing source is
+    # reused: only the page holding its last episode and later ones are
+    # fetched again, set ANIMEPAHE_DL_FULL_REFRESH=1 to refetch everything.
+    # If any page fails, the existing source is left as it was.
+    local d p n i f src tmp per first=1 keep=0 old=/dev/null files=() pids=() failed=() t0
+    t0="$(event_clock)"
+    src="$_SCRIPT_PATH/$_ANIME_NAME/$_SOURCE_FILE"
     mkdir -p "$_SCRIPT_PATH/$_ANIME_NAME"
-    d="$(get_episode_list "$_ANIME_SLUG" "1")"
-    p="$("$_JQ" -r '.last_page' <<< "$d")"
 
-    if [[ "$p" -gt "1" ]]; then
-        for i in $(seq 2 "$p"); do
-            n="$(get_episode_list "$_ANIME_SLUG" "$i")"
-            d="$(echo "$d $n" | "$_JQ" -s '.[0].data + .[1].data | {data: .}')"
-        done
+    if [[ -s "$src" && -z "${ANIMEPAHE_DL_FULL_REFRESH:-}" ]] \
+        && [[ "$("$_JQ" -r '.slug // ""' "$src" 2>/dev/null)" == "$_ANIME_SLUG" ]]; then
+        n="$("$_JQ" -r '.data | length' "$src")"
+        per="$("$_JQ" -r '.per_page // 0' "$src")"
+        if [[ "$per" -gt 0 && "$n" -gt 0 ]]; then
+            first=$(( (n - 1) / per + 1 ))
+            keep=$(( (first - 1) * per ))
+            old="$src"
+        fi
+    fi
+
+    tmp="$(mktemp -d)"
+    at_exit "rm -rf $(printf '%q' "$tmp")"
+    get_episode_list "$_ANIME_SLUG" "$first" > "$tmp/$first.json" || failed+=("$first")
+    p="$("$_JQ" -r '.last_page // 1' "$tmp/$first.json" 2>/dev/null || echo "$first")"
+    files+=("$tmp/$first.json")
+    for (( i = first + 1; i <= p; i++ )); do
+        get_episode_list "$_ANIME_SLUG" "$i" > "$tmp/$i.json" &
+        pids+=("$!")
+        files+=("$tmp/$i.json")
+        if [[ ${#pids[@]} -ge "$_PAGE_JOBS" ]]; then
+            wait "${pids[0]}" || failed+=("$(( i - ${#pids[@]} + 1 ))")
+            pids=("${pids[@]:1}")
+        fi
+    done
+    for (( i = 0; i < ${#pids[@]}; i++ )); do
+        wait "${pids[$i]}" || failed+=("$(( p - ${#pids[@]} + i + 1 ))")
+    done
+
+    # An error body has no data: that page is missing, not empty
+    for f in "${files[@]}"; do
+        "$_JQ" -e '.data | type == "array"' "$f" > /dev/null 2>&1 || failed+=("$(basename "$f" .json)")
+    done
+    if [[ ${#failed[@]} -gt 0 ]]; then
+        rm -rf "$tmp"
+        print_error "Cannot fetch episode list page(s) $(printf '%s\n' "${failed[@]}" | sort -nu | paste -sd, -), $_SOURCE_FILE left unchanged"
     fi
 
-    echo "$d" > "$_SCRIPT_PATH/$_ANIME_NAME/$_SOURCE_FILE"
+    # Record the slug, so the library catalog maps it to this folder
+    "$_JQ" -s --arg s "$_ANIME_SLUG" --argjson k "$keep" --slurpfile old "$old" \
+        '{data: ((if $k > 0 then $old[0].data[:$k] else [] end) + [.[] | .data[]]),
+          per_page: .[0].per_page, slug: $s}' "${files[@]}" > "$tmp/source.json"
+    mv -f "$tmp/source.json" "$src"
+    rm -rf "$tmp"
+    emit_phase source "$t0" --argjson count "$("$_JQ" -r '.data | length' "$src")"
+}
+
+load_episode_index() {
+    # Map episode number -> session in one jq pass over $_SOURCE_FILE,
+    # instead of parsing it again for every lookup
+    local n s
+    declare -gA _EPISODE_SESSIONS=()
+    while IFS=$'\t' read -r n s; do
+        _EPISODE_SESSIONS["$n"]="$s"
+    done < <("$_JQ" -r '.data[] | "\(.episode | tonumber)\t\(.session)"' "$_SCRIPT_PATH/$_ANIME_NAME/$_SOURCE_FILE")
+}
+
+get_episode_session() {
+    # $1: episode number
+    local n="$1"
+    [[ "$n" =~ ^[0-9]+$ ]] && n=$((10#$n))
+    echo "${_EPISODE_SESSIONS[$n]:-}"
 }
 
 get_episode_link() {
     # $1: episode number
     local s o l r=""
-    s=$("$_JQ" -r '.data[] | select((.episode | tonumber) == ($num | tonumber)) | .session' --arg num "$1" < "$_SCRIPT_PATH/$_ANIME_NAME/$_SOURCE_FILE")
+    s=$(get_episode_session "$1")
     [[ "$s" == "" ]] && print_warn "Episode $1 not found!" && return
     o="$("$_CURL" --compressed -sSL -H "cookie: $_COOKIE" "${_HOST}/play/${_ANIME_SLUG}/${s}")"
     l="$(grep \<button <<< "$o" \
@@ -206,9 +412,19 @@ get_episode_link() {
 
 get_playlist_link() {
     # $1: episode link
-    local s l
-    s="$("$_CURL" --compressed -sS -H "Referer: $_REFERER_URL" -H "cookie: $_COOKIE" "$1" \
-        | grep "<script>eval(" \
+    local p s l=""
+    p="$("$_CURL" --compressed -sS -H "Referer: $_REFERER_URL" -H "cookie: $_COOKIE" "$1")"
+
+    # Unpack in-process with python, node is only the fallback
+    if has_engine; then
+        l="$(run_pahe kwik unpack <<< "$p" 2>/dev/null || true)"
+    fi
+    if [[ -n "$l" || -z "${_NODE:-}" ]]; then
+        echo "$l"
+        return
+    fi
+
+    s="$(grep "<script>eval(" <<< "$p" \
         | awk -F 'script>' '{print $2}'\
         | sed -E 's/document/process/g' \
         | sed -E 's/querySelector/exit/g' \
@@ -222,6 +438,90 @@ get_playlist_link() {
     echo "$l"
 }
 
+resolve_playlist() {
+    # $1: episode number
+    # Print the m3u8 link of an episode. Links are cached per episode
+    # session, resolution and audio for ANIMEPAHE_DL_CACHE_TTL seconds, so
+    # a retried batch skips the play page and kwik entirely.
+    local s k l t0 pl=""
+    s=$(get_episode_session "$1")
+    [[ "$s" == "" ]] && print_warn "Episode $1 not found!" && return
+    k="${s}|${_ANIME_RESOLUTION:-}|${_ANIME_AUDIO:-}"
+    if has_engine; then
+        pl="$(run_pahe kwik --cache "$_PLAYLIST_CACHE_FILE" cache-get "$k" || true)"
+    fi
+    if [[ -z "$pl" ]]; then
+        t0="$(event_clock)"
+        l=$(get_episode_link "$1")
+        [[ "$l" != *"/"* ]] && print_warn "Wrong download link or episode $1 not found!" && return
+        pl=$(get_playlist_link "$l")
+        [[ -z "${pl:-}" ]] && print_warn "Missing video list! Skip downloading!" && return
+        emit_phase link "$t0" --arg episode "$1" --argjson count 1
+        if has_engine; then
+            run_pahe kwik --cache "$_PLAYLIST_CACHE_FILE" cache-put "$k" "$pl" || true
+        fi
+    fi
+    echo "$pl"
+}
+
+start_prefetch() {
+    # $@: episode numbers, in download order
+    # Resolve playlist links in the background, up to $_PREFETCH_AHEAD
+    # episodes past the one being downloaded and $_PREFETCH_JOBS at a time,
+    # so the next episode's play page and kwik lookups are done by the
+    # time it starts. playlist_of hands the links out.
+    [[ "$_PREFETCH_AHEAD" -gt 0 && $# -gt 1 ]] || return 0
+    _PREFETCH_DIR="$(mktemp -d)"
+    # Also when a download ends the script through print_error or set -e
+    at_exit stop_prefetch
+    : > "$_PREFETCH_DIR/taken"
+    (
+        i=0
+        for e in "$@"; do
+            while [[ "$i" -ge $(( $(wc -l < "$_PREFETCH_DIR/taken") + _PREFETCH_AHEAD )) ]]; do
+                [[ -f "$_PREFETCH_DIR/stop" ]] || ! kill -0 "$$" 2>/dev/null && exit 0
+                sleep 0.1
+            done
+            {
+                resolve_playlist "$e" > "$_PREFETCH_DIR/$e.part" || true
+                mv -f "$_PREFETCH_DIR/$e.part" "$_PREFETCH_DIR/$e"
+            } &
+            [[ "$(jobs -rp | wc -l)" -ge "$_PREFETCH_JOBS" ]] && wait -n || true
+            i=$((i + 1))
+        done
+        wait
+    ) &
+    _PREFETCH_PID=$!
+}
+
+stop_prefetch() {
+    [[ -z "${_PREFETCH_DIR:-}" ]] && return 0
+    touch "$_PREFETCH_DIR/stop"
+    wait "$_PREFETCH_PID" || true
+    rm -rf "$_PREFETCH_DIR"
+    _PREFETCH_DIR=""
+}
+
+playlist_of() {
+    # $1: episode number
+    # The link start_prefetch resolved, or resolve it now
+    if [[ -z "${_PREFETCH_DIR:-}" ]]; then
+        resolve_playlist "$1"
+        return
+    fi
+    echo "$1" >> "$_PREFETCH_DIR/taken"
+    while [[ ! -f "$_PREFETCH_DIR/$1" ]]; do
+        if ! kill -0 "$_PREFETCH_PID" 2>/dev/null; then
+            # The prefetcher is gone: take what it left, else resolve here
+            [[ -f "$_PREFETCH_DIR/$1" ]] && break
+            resolve_playlist "$1"
+            return
+        fi
+        sleep 0.1
+    done
+    cat "$_PREFETCH_DIR/$1"
+}
+
 download_episodes() {
     # $1: episode number string
     local origel el uniqel
@@ -260,9 +560,75 @@ download_episodes() {
 
     [[ ${#uniqel[@]} == 0 ]] && print_error "Wrong episode number!"
 
+    start_prefetch "${uniqel[@]}"
+    if [[ ${#uniqel[@]} -gt 1 && -z ${_LIST_LINK_ONLY:-} && ${_PARALLEL_JOBS:-} -gt 1 ]] && has_engine; then
+        schedule_episodes "${uniqel[@]}"
+        stop_prefetch
+        return
+    fi
+
+    _FAILED_EPISODES=()
     for e in "${uniqel[@]}"; do
         download_episode "$e"
     done
+    stop_prefetch
+    if [[ ${#_FAILED_EPISODES[@]} -gt 0 ]]; then
+        print_error "Failed to download episode(s) ${_FAILED_EPISODES[*]}, run again to resume them"
+    fi
+}
+
+episode_failed() {
+    # $1: episode number
+    # $2: reason
+    print_warn "Episode $1 failed: $2"
+    emit_event episode_end --arg episode "$1" --arg error "$2" --argjson ok false
+    _FAILED_EPISODES+=("$1")
+}
+
+schedule_episodes() {
+    # $@: episode numbers
+    # Run the whole range as one job: pahe.scheduler asks for the next
+    # episode with a "next" line once it has room, so links are resolved
+    # ahead while earlier episodes download and mux.
+    local e pl sin sout spid ready=false erropt='' sopt=()
+    [[ -z "${_DEBUG_MODE:-}" ]] && erropt="-v error" || sopt+=("--keep")
+    [[ -n "${_STREAM_MUX:-}" ]] && sopt+=("--stream")
+
+    coproc _SCHEDULER {
+        run_pahe scheduler -t "$(engine_threads)" --ffmpeg "$_FFMPEG" --ffmpeg-args "$erropt" \
+            --referer "$_REFERER_URL" --cookie "$_COOKIE" "${sopt[@]}"
+    }
+    sout="${_SCHEDULER[0]}"
+    sin="${_SCHEDULER[1]}"
+    spid="$_SCHEDULER_PID"
+
+    print_info "Start parallel jobs with $(engine_threads) threads shared by ${#@} episodes"
+    for e in "$@"; do
+        if ! $ready; then
+            read -r _ <&"$sout" || break
+            ready=true
+        fi
+        pl=$(playlist_of "$e")
+        if [[ -z "${pl:-}" ]]; then
+            emit_event episode_end --arg episode "$e" --argjson ok false
+            continue
+        fi
+        printf '%s\t%s\t%s\t%s\n' "$e" "$pl" \
+            "$_SCRIPT_PATH/${_ANIME_NAME}/${e}.mp4" "$_SCRIPT_PATH/$_ANIME_NAME/${e}" >&"$sin"
+        ready=false
+    done
+
+    eval "exec ${sin}>&-"
+    wait "$spid" || print_error "Some episodes failed to download, run again to resume them"
+}
+
+engine_threads() {
+    # -t as passed to pahe.engine and pahe.scheduler
+    if [[ -n "${_AUTO_THREADS:-}" ]]; then
+        echo "auto:$_AUTO_THREADS"
+    else
+        echo "$_PARALLEL_JOBS"
+    fi
 }
 
 get_thread_number() {
@@ -279,15 +645,38 @@ get_thread_number() {
 download_file() {
     # $1: URL link
     # $2: output file
-    local s
-    s=$("$_CURL" -k -sS -H "Referer: $_REFERER_URL" -H "cookie: $_COOKIE" -C - "$1" -L -g -o "$2" \
-        --connect-timeout 5 \
-        --compressed \
-        || echo "$?")
-    if [[ "$s" -ne 0 ]]; then
-        print_warn "Download was aborted. Retry..."
-        download_file "$1" "$2"
-    fi
+    # Up to ANIMEPAHE_DL_RETRIES attempts (default 8) with exponential
+    # backoff and jitter; HTTP 4xx other than 408/425/429 is not retried
+    local c s n=1 ms max="${ANIMEPAHE_DL_RETRIES:-8}"
+    while true; do
+        s=0
+        c=$("$_CURL" -k -sS -H "Referer: $_REFERER_URL" -H "cookie: $_COOKIE" -C - "$1" -L -g -o "$2" \
+            --connect-timeout 5 \
+            --compressed \
+            -w '%{http_code}') || s=$?
+        if [[ "$s" -eq 0 && ( "$c" == 2* || "$c" == 416 ) ]]; then
+            return 0
+        fi
+        if [[ "$s" -eq 0 ]]; then
+            # The error page was written to the output, do not resume from it
+            rm -f "$2"
+            if [[ "$c" == 4* && "$c" != 408 && "$c" != 425 && "$c" != 429 ]]; then
+                print_warn "Download failed (HTTP $c): $1"
+                return 1
+            fi
+        fi
+        if [[ "$n" -ge "$max" ]]; then
+            print_warn "Download failed after $n attempts: $1"
+            return 1
+        fi
+        ms=$(( 500 << n ))
+        [[ "$ms" -gt 30000 ]] && ms=30000
+        ms=$(( RANDOM * ms / 32768 ))
+        [[ "$c" == 000 ]] && c=""
+        print_warn "Download was aborted (${c:+HTTP $c, }curl $s). Retry $n/$((max - 1)) in $((ms / 1000)).$((ms % 1000 / 100))s..."
+        sleep "$((ms / 1000)).$(printf '%03d' $((ms % 1000)))"
+        n=$((n + 1))
+    done
 }
 
 decrypt_file() {
@@ -297,16 +686,49 @@ decrypt_file() {
     "$_OPENSSL" aes-128-cbc -d -K "$2" -iv 0 -in "${1}" -out "${of}" 2>/dev/null
 }
 
+has_engine() {
+    [[ -n "${_PYTHON:-}" && -f "$_ENGINE_PATH/pahe/engine.py" ]]
+}
+
+run_pahe() {
+    # $1: module of the pahe package
+    # $@: its arguments
+    local m="$1"
+    shift
+    PYTHONPATH="$_ENGINE_PATH${PYTHONPATH:+:$PYTHONPATH}" "$_PYTHON" -m "pahe.$m" "$@"
+}
+
+run_engine() {
+    # $@: arguments of pahe.engine
+    run_pahe engine "$@"
+}
+
 download_segments() {
     # $1: playlist file
     # $2: output path
+    # $3: playlist URL
     local op="$2"
-    export _CURL _REFERER_URL op
+    if has_engine; then
+        run_engine -t "$(engine_threads)" --decrypt --base-url "$3" \
+            --referer "$_REFERER_URL" --cookie "$_COOKIE" "$1" "$op"
+        return
+    fi
+    export _CURL _REFERER_URL _COOKIE op
     export -f download_file print_warn
     xargs -I {} -P "$(get_thread_number "$1")" \
         bash -c 'url="{}"; file="${url##*/}.encrypted"; download_file "$url" "${op}/${file}"' < <(grep "^https" "$1")
 }
 
+stream_segments() {
+    # $1: playlist file
+    # $2: output path
+    # $3: playlist URL
+    # $4: video file
+    # $5: extra ffmpeg options
+    run_engine -t "$(engine_threads)" --stream "$4" --ffmpeg "$_FFMPEG" --ffmpeg-args "$5" \
+        --base-url "$3" --referer "$_REFERER_URL" --cookie "$_COOKIE" "$1" "$2"
+}
+
 generate_filelist() {
     # $1: playlist file
     # $2: output file
@@ -322,7 +744,7 @@ decrypt_segments() {
     local kf kl k
     kf="${2}/mon.key"
     kl=$(grep "#EXT-X-KEY:METHOD=" "$1" | awk -F '"' '{print $2}')
-    download_file "$kl" "$kf"
+    download_file "$kl" "$kf" || return 1
     k="$(od -A n -t x1 "$kf" | tr -d ' \n')"
 
     export _OPENSSL k
@@ -333,17 +755,23 @@ decrypt_segments() {
 
 download_episode() {
     # $1: episode number
-    local num="$1" l pl v erropt='' extpicky=''
+    local num="$1" pl v t0 erropt='' extpicky=''
     v="$_SCRIPT_PATH/${_ANIME_NAME}/${num}.mp4"
 
-    l=$(get_episode_link "$num")
-    [[ "$l" != *"/"* ]] && print_warn "Wrong download link or episode $1 not found!" && return
-
-    pl=$(get_playlist_link "$l")
-    [[ -z "${pl:-}" ]] && print_warn "Missing video list! Skip downloading!" && return
+    pl=$(playlist_of "$num")
+    if [[ -z "${pl:-}" ]]; then
+        emit_event episode_end --arg episode "$num" --argjson ok false
+        return
+    fi
 
     if [[ -z ${_LIST_LINK_ONLY:-} ]]; then
+        if episode_complete "$v" "$pl"; then
+            print_info "Episode $num is already downloaded, skip"
+            emit_event episode_end --arg episode "$num" --arg output "$v" --argjson ok true --argjson skipped true
+            return 0
+        fi
         print_info "Downloading Episode $1..."
+        emit_event episode_start --arg episode "$num"
 
         [[ -z "${_DEBUG_MODE:-}" ]] && erropt="-v error"
         if ffmpeg -h full 2>/dev/null| grep extension_picky >/dev/null; then
@@ -356,27 +784,94 @@ download_episode() {
             cpath="$(pwd)"
             opath="$_SCRIPT_PATH/$_ANIME_NAME/${num}"
             plist="${opath}/playlist.m3u8"
-            rm -rf "$opath"
+            # The native engine resumes from ${opath}/checkpoint.json, keep its segments
+            has_engine || rm -rf "$opath"
             mkdir -p "$opath"
-
-            download_file "$pl" "$plist"
-            print_info "Start parallel jobs with $(get_thread_number "$plist") threads"
-            download_segments "$plist" "$opath"
-            decrypt_segments "$plist" "$opath"
-            generate_filelist "$plist" "${opath}/$fname"
-
-            ! cd "$opath" && print_warn "Cannot change directory to $opath" && return
-            "$_FFMPEG" -f concat -safe 0 -i "$fname" -c copy $erropt -y "$v"
-            ! cd "$cpath" && print_warn "Cannot change directory to $cpath" && return
-            [[ -z "${_DEBUG_MODE:-}" ]] && rm -rf "$opath" || return 0
+            rm -f "$plist"
+
+            t0="$(event_clock)"
+            if ! download_file "$pl" "$plist"; then
+                episode_failed "$num" "cannot download playlist"
+                return 0
+            fi
+            emit_phase playlist "$t0" --arg episode "$num" --argjson bytes "$(wc -c < "$plist")" --argjson count 1
+            if [[ -n "${_AUTO_THREADS:-}" ]]; then
+                print_info "Start parallel jobs with $(engine_threads) threads"
+            else
+                print_info "Start parallel jobs with $(get_thread_number "$plist") threads"
+            fi
+            if [[ -n "${_STREAM_MUX:-}" ]] && has_engine; then
+                if ! stream_segments "$plist" "$opath" "$pl" "$v" "$erropt"; then
+                    episode_failed "$num" "some segments could not be downloaded"
+                    return 0
+                fi
+            else
+                [[ -n "${_STREAM_MUX:-}" ]] && print_warn "Streaming mux needs python, fallback to segment files"
+                # Failed segments stay out of the video: give up on the
+                # episode, a rerun resumes it
+                t0="$(event_clock)"
+                if ! download_segments "$plist" "$opath" "$pl"; then
+                    episode_failed "$num" "some segments could not be downloaded"
+                    return 0
+                fi
+                # The native engine times its own segments and decryption
+                if ! has_engine; then
+                    emit_phase segments "$t0" --arg episode "$num" \
+                        --argjson count "$(grep -c "^https" "$plist")" \
+                        --argjson bytes "$(cat "$opath"/*.encrypted | wc -c)"
+                    t0="$(event_clock)"
+                    if ! decrypt_segments "$plist" "$opath"; then
+                        episode_failed "$num" "cannot decrypt segments"
+                        return 0
+                    fi
+                    emit_phase decrypt "$t0" --arg episode "$num" --argjson count "$(grep -c "^https" "$plist")"
+                fi
+                generate_filelist "$plist" "${opath}/$fname"
+
+                ! cd "$opath" && print_warn "Cannot change directory to $opath" && return
+                t0="$(event_clock)"
+                "$_FFMPEG" -f concat -safe 0 -i "$fname" -c copy $erropt -y "$v"
+                emit_phase mux "$t0" --arg episode "$num"
+                ! cd "$cpath" && print_warn "Cannot change directory to $cpath" && return
+            fi
+            [[ -z "${_DEBUG_MODE:-}" ]] && rm -rf "$opath"
         else
+            # ffmpeg fetches and muxes in one go
+            t0="$(event_clock)"
             "$_FFMPEG" $extpicky -headers "Referer: $_REFERER_URL" -i "$pl" -c copy $erropt -y "$v"
+            emit_phase mux "$t0" --arg episode "$num"
+        fi
+        t0="$(event_clock)"
+        if ! record_episode "$v" "$pl"; then
+            episode_failed "$num" "the video is incomplete"
+            return 0
         fi
+        has_engine && emit_phase verify "$t0" --arg episode "$num"
+        emit_event episode_end --arg episode "$num" --arg output "$v" --argjson ok true
     else
         echo "$pl"
     fi
 }
 
+episode_complete() {
+    # $1: video file
+    # $2: playlist URL
+    # True when the video exists and its duration matches the playlist,
+    # see GUI/pahe/library.py; without python videos are never skipped
+    [[ -f "$1" ]] && has_engine \
+        && run_pahe library --ffmpeg "$_FFMPEG" check --playlist "$2" \
+            --referer "$_REFERER_URL" --cookie "$_COOKIE" "$1" 2>/dev/null
+}
+
+record_episode() {
+    # $1: video file
+    # $2: playlist URL
+    # Add a finished video to the library inventory, fails if it is truncated
+    has_engine || return 0
+    run_pahe library --ffmpeg "$_FFMPEG" record --playlist "$2" \
+        --referer "$_REFERER_URL" --cookie "$_COOKIE" "$1"
+}
+
 select_episodes_to_download() {
     [[ "$(grep 'data' -c "$_SCRIPT_PATH/$_ANIME_NAME/$_SOURCE_FILE")" -eq "0" ]] && print_error "No episode available!"
     "$_JQ" -r '.data[] | "[\(.episode | tonumber)] E\(.episode | tonumber) \(.created_at)"' "$_SCRIPT_PATH/$_ANIME_NAME/$_SOURCE_FILE" >&2
@@ -393,6 +888,20 @@ remove_slug() {
     awk -F'] ' '{print $2}'
 }
 
+use_daemon() {
+    # A running `pahe.daemon serve` for this library takes the download
+    # over, unless ANIMEPAHE_DL_DAEMON=off
+    [[ "${ANIMEPAHE_DL_DAEMON:-}" != "off" && -z "${_LIST_LINK_ONLY:-}" && -f "$_SCRIPT_PATH/.daemon.json" ]] \
+        && has_engine && run_pahe daemon --root "$_SCRIPT_PATH" ping
+}
+
+daemon_download() {
+    # Hands the episodes to the daemon and follows them, Ctrl-C cancels
+    print_info "Download handed to the daemon, its -t applies"
+    run_pahe daemon --root "$_SCRIPT_PATH" submit "$_ANIME_SLUG" -e "$_ANIME_EPISODE" \
+        -r "${_ANIME_RESOLUTION:-}" -o "${_ANIME_AUDIO:-}" --follow
+}
+
 get_slug_from_name() {
     # $1: anime name
     grep "] $1" "$_ANIME_LIST_FILE" | tail -1 | remove_brackets
@@ -402,12 +911,17 @@ main() {
     set_args "$@"
     set_var
     set_cookie
+    start_metrics
 
     if [[ -n "${_INPUT_ANIME_NAME:-}" ]]; then
         _ANIME_NAME=$("$_FZF" -1 <<< "$(search_anime_by_name "$_INPUT_ANIME_NAME")")
         _ANIME_SLUG="$(get_slug_from_name "$_ANIME_NAME")"
     else
         download_anime_list
+        if [[ -n "${_ANIME_SLUG:-}" ]] && ! grep -qF "[$_ANIME_SLUG]" "$_ANIME_LIST_FILE" 2>/dev/null; then
+            # A new anime is not in a list that is still fresh
+            download_anime_list force
+        fi
         if [[ -z "${_ANIME_SLUG:-}" ]]; then
             _ANIME_NAME=$("$_FZF" -1 <<< "$(remove_slug < "$_ANIME_LIST_FILE")")
             _ANIME_SLUG="$(get_slug_from_name "$_ANIME_NAME")"
@@ -423,11 +937,21 @@ main() {
 
     if [[ "$_ANIME_NAME" == "" ]]; then
         print_warn "Anime name not found! Try again."
-        download_anime_list
+        download_anime_list force
         exit 1
     fi
 
+    if use_daemon; then
+        if [[ -z "${_ANIME_EPISODE:-}" ]]; then
+            download_source
+            _ANIME_EPISODE=$(select_episodes_to_download)
+        fi
+        daemon_download
+        return
+    fi
+
     download_source
+    load_episode_index
 
     [[ -z "${_ANIME_EPISODE:-}" ]] && _ANIME_EPISODE=$(select_episodes_to_download)
     download_episodes "$_ANIME_EPISODE"
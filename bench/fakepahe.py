@@ -0,0 +1,302 @@
+"""Local stand-in for animepahe, kwik and their HLS host.
+
+Serves just enough for animepahe-dl.sh and the GUI to run end to end
+without network access:
+
+    /anime                              anime list page (download_anime_list), with an ETag
+    /api?m=search&q=...                 search API
+    /api?m=release&id=<slug>&page=N     release API, 30 episodes a page
+    /play/<slug>/<session>              play page with data-src buttons
+    /kwik/e/<session>-<res>             kwik page with a packed script
+
+and, on a second HTTPS listener when openssl is available (the script's
+fallback path only picks up "https" segment lines):
+
+    /hls/<session>-<res>/index.m3u8     AES-128 playlist
+    /hls/key                            its key
+    /hls/<session>-<res>/seg-N.ts       encrypted segments
+
+Every request waits `latency` seconds first, and segment requests are
+dropped without an answer with probability `error_rate`.
+
+    python bench/fakepahe.py --episodes 12 --segments 40 --segment-kb 512
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+SLUG = "00000000-bench-0000-0000-000000000000"
+TITLE = "Bench Anime"
+KEY = bytes(range(16))
+IV = bytes(16)
+PER_PAGE = 30
+RESOLUTIONS = ("720", "1080")
+_ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+_NULL_PACKET = b"\x47\x1f\xff\x10" + b"\xff" * 184
+
+
+def _encode(c, radix=62):
+    """The packer's e(c): base-radix digits 0-9a-zA-Z"""
+    s = ""
+    while True:
+        s = _ALPHABET[c % radix] + s
+        c //= radix
+        if not c:
+            return s
+
+
+def pack(source):
+    """Pack source the way kwik does, eval(function(p,a,c,k,e,d){...})"""
+    words = []
+    for w in re.findall(r"\b\w+\b", source):
+        if w not in words:
+            words.append(w)
+    codes = {w: _encode(i) for i, w in enumerate(words)}
+    payload = re.sub(r"\b\w+\b", lambda m: codes[m.group(0)], source).replace("\\", "\\\\").replace("'", "\\'")
+    return ("eval(function(p,a,c,k,e,d){e=function(c){return(c<a?'':e(parseInt(c/a)))+((c=c%a)>35?"
+            "String.fromCharCode(c+29):c.toString(36))};if(!''.replace(/^/,String)){while(c--){d[e(c)]=k[c]||e(c)}"
+            "k=[function(e){return d[e]}];e=function(){return'\\\\w+'};c=1};while(c--){if(k[c]){p=p.replace("
+            "new RegExp('\\\\b'+e(c)+'\\\\b','g'),k[c])}}return p}"
+            f"('{payload}',62,{len(words)},'{'|'.join(words)}'.split('|'),0,{{}}))")
+
+
+def encrypt(data):
+    """AES-128-CBC with PKCS#7 padding under KEY and IV"""
+    if Cipher is not None:
+        n = 16 - len(data) % 16
+        e = Cipher(algorithms.AES(KEY), modes.CBC(IV)).encryptor()
+        return e.update(data + bytes([n]) * n) + e.finalize()
+    proc = subprocess.run(["openssl", "aes-128-cbc", "-K", KEY.hex(), "-iv", IV.hex()],
+                          input=data, stdout=subprocess.PIPE, check=True)
+    return proc.stdout
+
+
+def make_segment(size, duration, ffmpeg=None):
+    """A playable MPEG-TS segment padded to about size bytes with null packets"""
+    data = b""
+    if ffmpeg:
+        proc = subprocess.run([ffmpeg, "-v", "error", "-f", "lavfi", "-i", "testsrc=size=320x240:rate=25",
+                               "-t", str(duration), "-c:v", "mpeg2video", "-f", "mpegts", "pipe:"],
+                              stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if proc.returncode == 0:
+            data = proc.stdout
+    missing = max(0, size - len(data))
+    return data + _NULL_PACKET * (-(-missing // len(_NULL_PACKET)))
+
+
+def _self_signed_cert(workdir):
+    openssl = shutil.which("openssl")
+    if not openssl:
+        return None
+    cert, key = os.path.join(workdir, "cert.pem"), os.path.join(workdir, "key.pem")
+    proc = subprocess.run([openssl, "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", key,
+                           "-out", cert, "-days", "1", "-subj", "/CN=127.0.0.1"],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return (cert, key) if proc.returncode == 0 else None
+
+
+class FakePahe:
+    def __init__(self, episodes=12, segments=40, segment_kb=512, duration=4.0, latency=0.0, error_rate=0.0,
+                 ffmpeg=None, tls=True, host="127.0.0.1"):
+        self.episodes = episodes
+        self.segments = segments
+        self.duration = duration
+        self.latency = latency
+        self.error_rate = error_rate
+        self.host = host
+        self.segment = encrypt(make_segment(segment_kb * 1024, duration, ffmpeg))
+        self.requests = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._workdir = tempfile.mkdtemp(prefix="fakepahe-")
+        self.site = ThreadingHTTPServer((host, 0), self._handler())
+        self.hls = self.site
+        cert = _self_signed_cert(self._workdir) if tls else None
+        if cert:
+            self.hls = ThreadingHTTPServer((host, 0), self._handler())
+            ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            ctx.load_cert_chain(*cert)
+            self.hls.socket = ctx.wrap_socket(self.hls.socket, server_side=True)
+        self._threads = []
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.site.server_address[1]}"
+
+    @property
+    def hls_url(self):
+        scheme = "http" if self.hls is self.site else "https"
+        return f"{scheme}://{self.host}:{self.hls.server_address[1]}"
+
+    def start(self):
+        for server in {self.site, self.hls}:
+            t = threading.Thread(target=server.serve_forever, daemon=True)
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def stop(self):
+        for server in {self.site, self.hls}:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(self._workdir, ignore_errors=True)
+
+    @staticmethod
+    def session(n):
+        return f"s{n:04d}"
+
+    def _release_page(self, page):
+        last = max(1, -(-self.episodes // PER_PAGE))
+        first = (page - 1) * PER_PAGE + 1
+        data = [{"episode": n, "session": self.session(n), "created_at": "2024-01-01 00:00:00"}
+                for n in range(first, min(self.episodes, first + PER_PAGE - 1) + 1)]
+        return {"total": self.episodes, "per_page": PER_PAGE, "current_page": page, "last_page": last,
+                "data": data}
+
+    def _playlist(self, name):
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{int(self.duration + 0.999)}",
+                 "#EXT-X-MEDIA-SEQUENCE:0",
+                 f'#EXT-X-KEY:METHOD=AES-128,URI="{self.hls_url}/hls/key",IV=0x{IV.hex()}']
+        for i in range(self.segments):
+            lines += [f"#EXTINF:{self.duration:.3f},", f"{self.hls_url}/hls/{name}/seg-{i}.ts"]
+        lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+
+    def route(self, path, query):
+        """Return (status, content type, body) or None to drop the connection"""
+        if path == "/anime":
+            return 200, "text/html", f'<div><a href="/anime/{SLUG}" title="{TITLE}">{TITLE}</a></div>\n'
+        if path == "/api":
+            m = query.get("m", [""])[0]
+            if m == "search":
+                return 200, "application/json", json.dumps(
+                    {"total": 1, "data": [{"session": SLUG, "title": TITLE}]})
+            if m == "release":
+                return 200, "application/json", json.dumps(self._release_page(int(query.get("page", ["1"])[0])))
+        parts = path.strip("/").split("/")
+        if parts[0] == "play" and len(parts) == 3:
+            buttons = "".join(
+                f'<button data-src="{self.url}/kwik/e/{parts[2]}-{r}" data-fansub="Bench" data-resolution="{r}" '
+                f'data-audio="jpn" data-av1="0">Bench &middot; {r}p</button>\n' for r in RESOLUTIONS)
+            return 200, "text/html", f"<html><body>\n{buttons}</body></html>\n"
+        if parts[0] == "kwik" and len(parts) == 3:
+            script = pack(f"const source='{self.hls_url}/hls/{parts[2]}/index.m3u8';"
+                          "const video=document.querySelector('video');")
+            return 200, "text/html", f"<html><body>\n<script>{script}\n</script>\n</body></html>\n"
+        if parts[0] == "hls":
+            if parts[1:] == ["key"]:
+                return 200, "application/octet-stream", KEY
+            if len(parts) == 3 and parts[2] == "index.m3u8":
+                return 200, "application/vnd.apple.mpegurl", self._playlist(parts[1])
+            if len(parts) == 3 and parts[2].startswith("seg-"):
+                if self.error_rate and random.random() < self.error_rate:
+                    return None
+                return 200, "video/mp2t", self.segment
+        return 404, "text/plain", "not found"
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with fake._lock:
+                    fake.requests += 1
+                if fake.latency:
+                    time.sleep(fake.latency)
+                url = urlsplit(self.path)
+                answer = fake.route(url.path, parse_qs(url.query))
+                if answer is None:
+                    with fake._lock:
+                        fake.dropped += 1
+                    self.close_connection = True
+                    return
+                status, ctype, body = answer
+                if isinstance(body, str):
+                    body = body.encode()
+                # The list page carries an ETag, as the site's does
+                etag = f'"{hashlib.md5(body).hexdigest()}"' if url.path == "/anime" else None
+                if etag and self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                start = 0
+                m = re.match(r"bytes=(\d+)-$", self.headers.get("Range") or "")
+                if status == 200 and m:
+                    start = int(m.group(1))
+                    if start >= len(body):
+                        self.send_response(416)
+                        self.send_header("Content-Range", f"bytes */{len(body)}")
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    status = 206
+                self.send_response(status)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(body) - start))
+                if etag:
+                    self.send_header("ETag", etag)
+                if status == 206:
+                    self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+                self.end_headers()
+                self.wfile.write(body[start:])
+
+        return Handler
+
+
+def add_server_args(parser):
+    parser.add_argument("--episodes", type=int, default=12, help="episodes of the fake anime (default: 12)")
+    parser.add_argument("--segments", type=int, default=40, help="segments per episode (default: 40)")
+    parser.add_argument("--segment-kb", type=int, default=512, help="segment size in KiB (default: 512)")
+    parser.add_argument("--latency-ms", type=float, default=0, help="delay before every answer (default: 0)")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of segment requests dropped (default: 0)")
+    parser.add_argument("--no-tls", action="store_true", help="serve the HLS host over plain http")
+
+
+def server_from_args(args, ffmpeg=None):
+    return FakePahe(args.episodes, args.segments, args.segment_kb, latency=args.latency_ms / 1000,
+                    error_rate=args.error_rate, ffmpeg=ffmpeg, tls=not args.no_tls)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a fake animepahe for offline runs")
+    add_server_args(parser)
+    parser.add_argument("--ffmpeg", default=shutil.which("ffmpeg"), help="ffmpeg used to make a playable segment")
+    args = parser.parse_args(argv)
+    server = server_from_args(args, args.ffmpeg).start()
+    print(f"ANIMEPAHE_DL_HOST={server.url}  (HLS on {server.hls_url}, slug {SLUG})", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
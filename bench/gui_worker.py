@@ -0,0 +1,45 @@
+"""Run one download through the GUI's DownloadWorker, without a window.
+
+Used by bench/run.py for the "gui" mode, from the library directory:
+
+    python bench/gui_worker.py -s <slug> -e 1-4 -r 1080 -o jpn -t 8
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "GUI"))
+
+from PyQt5.QtCore import QCoreApplication
+
+from animepahe_gui import DownloadWorker
+from pahe.client import parse_episodes
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="bench/gui_worker.py", description=__doc__.splitlines()[0])
+    parser.add_argument("-s", "--slug", required=True)
+    parser.add_argument("-e", "--episodes", required=True)
+    parser.add_argument("-r", "--resolution")
+    parser.add_argument("-o", "--audio")
+    parser.add_argument("-t", "--threads", default="auto")
+    args = parser.parse_args(argv)
+    job = {"slug": args.slug, "episodes": args.episodes, "resolution": args.resolution, "audio": args.audio,
+           "threads": args.threads}
+
+    app = QCoreApplication(sys.argv[:1])
+    worker = DownloadWorker(job, total_episodes=len(parse_episodes(args.episodes, [])))
+    stats = {}
+    worker.log_signal.connect(lambda line: print(line, file=sys.stderr))
+    worker.stats_signal.connect(stats.update)
+    worker.done_signal.connect(lambda ok: app.exit(0 if ok else 1))
+    worker.start()
+    rc = app.exec_()
+    worker.wait()
+    if stats:
+        print(f"[gui_worker] {stats['completed']} completed, {stats['failed']} failed", file=sys.stderr)
+    return rc
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
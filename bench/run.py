@@ -0,0 +1,263 @@
+"""Offline benchmark of animepahe-dl.sh and the GUI download path.
+
+Starts bench/fakepahe.py in-process, then for every mode and -t value
+downloads all episodes of the fake anime with a scratch copy of the
+script. Each case records wall time, CPU seconds and peak RSS of the
+processes it ran, peak scratch disk use, and episodes per minute and
+segments per second. Results are saved as JSON; `compare` lines two of
+them up to spot regressions between versions.
+
+    python bench/run.py --modes curl,engine,stream,gui -t 1,8,16,auto --episodes 4
+    python bench/run.py compare bench/results/old.json bench/results/new.json
+
+Modes:
+    curl    the original curl/openssl/node fan-out, python engine disabled
+    engine  pahe.engine, or pahe.scheduler for several episodes
+    stream  engine with -S, segments piped into ffmpeg
+    gui     the GUI's DownloadWorker: pahe.client lookups feeding pahe.scheduler
+
+Needs bash, curl, jq, fzf and ffmpeg on PATH like the script itself, plus
+openssl and node for the curl mode and PyQt5 for the gui mode. POSIX only
+(peak RSS comes from the resource module).
+"""
+import argparse
+import datetime
+import importlib.util
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from fakepahe import SLUG, add_server_args, server_from_args
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SCRIPT = os.path.join(REPO_DIR, "animepahe-dl.sh")
+MODES = ("curl", "engine", "stream", "gui")
+REQUIRED = {"curl": ("openssl", "node")}
+
+
+def git_version():
+    try:
+        rev = subprocess.run(["git", "-C", REPO_DIR, "describe", "--always", "--dirty"],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        return rev.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def measure(argv):
+    """`run.py _measure -- cmd...`: run cmd and print its resource usage as JSON.
+
+    Runs in its own process so ru_maxrss only covers this case.
+    """
+    proc = subprocess.run(argv, stdout=sys.stderr)
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    print(json.dumps({"exit_code": proc.returncode, "cpu_user_s": usage.ru_utime,
+                      "cpu_sys_s": usage.ru_stime, "peak_rss_bytes": rss}))
+    return 0
+
+
+class DiskSampler(threading.Thread):
+    """Tracks the peak size of scratch files (anything but *.mp4) under root"""
+
+    def __init__(self, root, interval=0.1):
+        super().__init__(daemon=True)
+        self.root = root
+        self.interval = interval
+        self.peak = 0
+        self.output = 0
+        self._finished = threading.Event()
+
+    def sample(self):
+        scratch = output = 0
+        for d, _, files in os.walk(self.root):
+            for name in files:
+                try:
+                    size = os.path.getsize(os.path.join(d, name))
+                except OSError:
+                    continue
+                if name.endswith(".mp4"):
+                    output += size
+                else:
+                    scratch += size
+        self.peak = max(self.peak, scratch)
+        self.output = output
+
+    def run(self):
+        while not self._finished.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self._finished.set()
+        self.join()
+        self.sample()
+
+
+def run_case(server, mode, threads, args):
+    workdir = tempfile.mkdtemp(prefix="pahe-bench-")
+    library = os.path.join(workdir, "library")
+    os.makedirs(library)
+    script = os.path.join(library, "animepahe-dl.sh")
+    shutil.copy2(SCRIPT, script)
+    env = dict(os.environ, ANIMEPAHE_DL_HOST=server.url, ANIMEPAHE_DL_CACHE_TTL="0",
+               ANIMEPAHE_DL_ENGINE=os.path.join(REPO_DIR, "GUI") if mode != "curl" else os.path.join(workdir, "none"))
+    cmd = ["bash", script, "-s", SLUG, "-e", f"1-{args.episodes}", "-r", "1080", "-o", "jpn", "-t", threads]
+    if mode == "stream":
+        cmd.append("-S")
+    if mode == "gui":
+        # The GUI talks to the site through pahe.client, the script is not run
+        cmd = [sys.executable, os.path.join(BENCH_DIR, "gui_worker.py")] + cmd[2:]
+        env.setdefault("QT_QPA_PLATFORM", "offscreen")
+    log_path = os.path.join(workdir, "run.log")
+
+    sampler = DiskSampler(library)
+    sampler.start()
+    started = time.perf_counter()
+    with open(log_path, "w", encoding="utf-8") as log:
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), "_measure", "--"] + cmd,
+                              cwd=library, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=log,
+                              text=True)
+    wall = time.perf_counter() - started
+    sampler.stop()
+    usage = json.loads(proc.stdout.strip().splitlines()[-1])
+
+    episodes = sum(1 for n in range(1, args.episodes + 1)
+                   if any(os.path.exists(os.path.join(d, f"{n}.mp4")) for d, _, _ in os.walk(library)))
+    segments = episodes * args.segments
+    result = {
+        "name": f"{mode}-t{threads}", "mode": mode, "threads": threads,
+        "exit_code": usage["exit_code"], "episodes": episodes, "complete": episodes == args.episodes,
+        "wall_s": round(wall, 3),
+        "episodes_per_min": round(episodes / wall * 60, 2),
+        "segments_per_s": round(segments / wall, 2),
+        "cpu_user_s": round(usage["cpu_user_s"], 3), "cpu_sys_s": round(usage["cpu_sys_s"], 3),
+        "peak_rss_mb": round(usage["peak_rss_bytes"] / 2 ** 20, 1),
+        "peak_scratch_mb": round(sampler.peak / 2 ** 20, 1),
+        "output_mb": round(sampler.output / 2 ** 20, 1),
+    }
+    if args.keep or not result["complete"]:
+        result["workdir"] = workdir
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def check_tools(modes):
+    missing = [t for t in ("bash", "curl", "jq", "fzf", "ffmpeg") if not shutil.which(t)]
+    for mode in modes:
+        missing += [t for t in REQUIRED.get(mode, ()) if not shutil.which(t) and t not in missing]
+    if "gui" in modes:
+        if importlib.util.find_spec("PyQt5") is None:
+            missing.append("PyQt5")
+    return missing
+
+
+def bench(args):
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    unknown = set(modes) - set(MODES)
+    if unknown:
+        print(f"Unknown mode(s): {', '.join(sorted(unknown))}", file=sys.stderr)
+        return 2
+    threads = [t.strip() for t in args.threads.split(",") if t.strip()]
+    missing = check_tools(modes)
+    if missing:
+        print(f"Missing: {', '.join(missing)}", file=sys.stderr)
+        return 2
+
+    server = server_from_args(args, shutil.which("ffmpeg")).start()
+    runs = []
+    try:
+        for mode in modes:
+            for t in threads:
+                for i in range(args.repeat):
+                    r = run_case(server, mode, t, args)
+                    r["repeat"] = i
+                    runs.append(r)
+                    print(f"{r['name']:<12} {r['wall_s']:>8.2f}s {r['episodes_per_min']:>8.2f} ep/min "
+                          f"{r['segments_per_s']:>8.2f} seg/s cpu {r['cpu_user_s'] + r['cpu_sys_s']:>7.2f}s "
+                          f"rss {r['peak_rss_mb']:>7.1f}MB scratch {r['peak_scratch_mb']:>7.1f}MB"
+                          + ("" if r["complete"] else f"  INCOMPLETE, see {r['workdir']}"), flush=True)
+        requests, dropped = server.requests, server.dropped
+    finally:
+        server.stop()
+
+    report = {
+        "version": git_version(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "config": {"episodes": args.episodes, "segments": args.segments, "segment_kb": args.segment_kb,
+                   "latency_ms": args.latency_ms, "error_rate": args.error_rate, "tls": not args.no_tls},
+        "server": {"requests": requests, "dropped": dropped},
+        "runs": runs,
+    }
+    output = args.output or os.path.join(
+        BENCH_DIR, "results", f"{datetime.datetime.now():%Y%m%d-%H%M%S}-{report['version'] or 'local'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved {output}")
+    return 0 if all(r["complete"] for r in runs) else 1
+
+
+def _medians(report):
+    by_name = {}
+    for r in report["runs"]:
+        by_name.setdefault(r["name"], []).append(r)
+    return {name: {k: statistics.median(r[k] for r in runs)
+                   for k in ("wall_s", "episodes_per_min", "segments_per_s", "cpu_user_s", "peak_rss_mb")}
+            for name, runs in by_name.items()}
+
+
+def compare(args):
+    with open(args.old, encoding="utf-8") as f:
+        old = json.load(f)
+    with open(args.new, encoding="utf-8") as f:
+        new = json.load(f)
+    if old["config"] != new["config"]:
+        print("Warning: the two runs used different server settings", file=sys.stderr)
+    a, b = _medians(old), _medians(new)
+    print(f"{old.get('version')} -> {new.get('version')}")
+    print(f"{'case':<12} {'wall_s':>18} {'episodes/min':>20} {'cpu_user_s':>18} {'peak_rss_mb':>18}")
+    for name in [n for n in b if n in a]:
+        cells = []
+        for key in ("wall_s", "episodes_per_min", "cpu_user_s", "peak_rss_mb"):
+            before, after = a[name][key], b[name][key]
+            change = (after - before) / before * 100 if before else 0.0
+            cells.append(f"{after:>9.2f} ({change:+6.1f}%)")
+        print(f"{name:<12} " + " ".join(f"{c:>18}" for c in cells))
+    return 0
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:2] == ["_measure", "--"]:
+        return measure(argv[2:])
+    if argv[:1] == ["compare"]:
+        parser = argparse.ArgumentParser(prog="bench/run.py compare", description="Compare two result files")
+        parser.add_argument("old")
+        parser.add_argument("new")
+        return compare(parser.parse_args(argv[1:]))
+
+    parser = argparse.ArgumentParser(prog="bench/run.py", description=__doc__.splitlines()[0])
+    add_server_args(parser)
+    parser.set_defaults(episodes=4)
+    parser.add_argument("--modes", default="engine,stream", help=f"comma separated, of {', '.join(MODES)}")
+    parser.add_argument("-t", "--threads", default="1,8,16,auto", help="comma separated -t values, auto included (default: 1,8,16,auto)")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per case (default: 1)")
+    parser.add_argument("-o", "--output", help="result file (default: bench/results/<date>-<version>.json)")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directories")
+    return bench(parser.parse_args(argv))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
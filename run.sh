@@ -9,14 +9,17 @@ BLUE='\033[0;34m'
 CYAN='\033[0;36m'
 NC='\033[0m'
 
-# Auto-refresh anime list
-echo "[INFO] Refreshing anime list..."
-./animepahe-dl.sh --list > /dev/null 2>&1
+# Refresh the anime list once it is stale (ANIMEPAHE_DL_LIST_TTL, a day by
+# default), and then only download it if the site's copy changed
+if PY=$(command -v python3 || command -v python); then
+    echo "[INFO] Checking anime list..."
+    PYTHONPATH="$(dirname "$(realpath "$0")")/GUI" "$PY" -m pahe.client list > /dev/null
+fi
 
 if [[ ! -f anime.list ]]; then
     echo "[ERROR] Failed to refresh anime list!"
 else
-    echo "[INFO] Anime list updated: $(wc -l < anime.list) entries"
+    echo "[INFO] Anime list: $(wc -l < anime.list) entries"
 fi
 
 
@@ -31,8 +34,13 @@ search_title() {
     echo -e "${BLUE}=== Anime Title Search ===${NC}"
     read -p "$(echo -e "${GREEN}Enter title keyword:${NC} ")" query
 
-    # Show matching lines
-    matches=$(grep -i "$query" "$LIST_FILE")
+    # Show matching lines: ranked and deduplicated through the title index
+    # when python is available, plain grep otherwise
+    if PY=$(command -v python3 || command -v python); then
+        matches=$(PYTHONPATH="$(dirname "$(realpath "$0")")/GUI" "$PY" -m pahe.titleindex --list "$LIST_FILE" search "$query")
+    else
+        matches=$(grep -i "$query" "$LIST_FILE")
+    fi
     
     if [[ -z "$matches" ]]; then
         echo -e "${RED}[ERROR] No matches found for '$query'.${NC}"
@@ -110,7 +118,13 @@ fetch_metadata() {
 
     ./animepahe-dl.sh -s "$KEY" -e 1 -r 360 -o jpn -t 1 -l >/dev/null 2>&1
 
-    ANIME_FOLDER=$(ls -d */ 2>/dev/null | grep -v "animepahe-dl" | head -1)
+    # The library catalog maps the key to its folder; without python fall
+    # back to the first folder found
+    if PY=$(command -v python3 || command -v python); then
+        ANIME_FOLDER=$(PYTHONPATH="$(dirname "$(realpath "$0")")/GUI" "$PY" -m pahe.catalog lookup "$KEY" | cut -f1)
+    else
+        ANIME_FOLDER=$(ls -d */ 2>/dev/null | grep -v "animepahe-dl" | head -1)
+    fi
     ANIME_FOLDER="${ANIME_FOLDER%/}"
 
     if [[ -z "$ANIME_FOLDER" ]]; then